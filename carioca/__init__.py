@@ -0,0 +1,23 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Carioca rules engine.
+
+Importing the package loads the engine only: no GUI or graphics library is
+imported until run_gui() is called, so that headless workers start fast.
+
+    >>> import carioca
+    >>> game_round = carioca.GameRound(4, 1, 1, 0)
+'''
+
+from carioca import (A, J, Q, K, JOKER, SUITS, SPADES, HEARTS, CLUBS, DIAMONDS,
+                     TURN_SETS, DECK, Card, C, Cs, card_repr, value, get_score,
+                     create_deck, is_trio, is_straight, is_royal_straight,
+                     InvalidRank, InvalidSuit, GameRoundException,
+                     InvalidMoveException, GameException, Hand, LazyStack,
+                     SetHandle, Board, GameRound, CariocaGame)
+
+
+def run_gui():
+    'Open the GTK game window (needs pygtk and pycairo)'
+    from gui import CariocaGUI
+    CariocaGUI().main()
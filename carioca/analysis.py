@@ -0,0 +1,110 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Draw odds and discard advice for one player, from what that player
+can see.
+
+A View holds the cards a player knows about: their own hand, the well,
+the sets lowered by everyone and any other card seen (for example one
+taken from the well by another player). Every other card of the nr_decks
+decks is unseen, and the next card of the stack is any of them with the
+same probability, so the odds below are exact counts over the unseen
+cards, not samples:
+
+>>> from carioca import Cs
+>>> view = View(hand=Cs(u'5♣ 5♦ 8♥ 8♣'), well=Cs(u'3♣'), lowered=[], seen=[],
+...             turn_set=(2, 0, 0), nr_decks=2)
+>>> unseen_counts(view)[CARD_CODES[C(u'5♣')]]
+1
+>>> round(improve_odds(view), 4)
+0.1553
+
+Distances are the ones of solver.missing_cards. All the hands evaluated
+for one View share a single search, so that the subproblems they have in
+common are only solved once.
+'''
+
+from collections import namedtuple
+
+from carioca import C, CARD_CODES, CARDS, CODE_VALUES, DECK, JOKER_CODE, NR_CODES
+from solver import _GapSearch, _counts
+
+View = namedtuple('View', 'hand well lowered seen turn_set nr_decks')
+
+class Discard(namedtuple('Discard', 'card distance odds expected_distance')):
+    '''Evaluation of dropping a card: distance of the hand left, odds that
+    the next stack draw shortens it, and the expected distance after that
+    draw'''
+    __slots__ = ()
+
+DECK_COUNTS = tuple(_counts(DECK))
+
+
+def view_of(game_round, player, seen=()):
+    'View of the given player of a GameRound'
+    lowered = [cards for cards in game_round.board.sets.itervalues()]
+    lowered.extend(cards for melds in game_round.lowered_royal_straights if melds
+                         for cards in melds)
+    return View(list(game_round.hands[player]), list(game_round.well), lowered,
+                list(seen), (game_round.nr_trios, game_round.nr_straights,
+                             game_round.nr_royal_straights),
+                game_round.nr_decks)
+
+def unseen_counts(view):
+    'Copies of each card code that the player has not seen'
+    counts = [view.nr_decks * n for n in DECK_COUNTS]
+    for cards in [view.hand, view.well, view.seen] + list(view.lowered):
+        for card in cards:
+            counts[CARD_CODES[card]] -= 1
+    if min(counts) < 0:
+        raise ValueError('The view has more copies of a card than the decks')
+    return counts
+
+
+class _Evaluator(object):
+    'Distances and useful cards of the hands that differ by one card'
+
+    def __init__(self, view):
+        self.counts = _counts(view.hand)
+        self.royal_straights = view.turn_set[2]
+        # The windows of the hand include the ones of any hand with a card less
+        self.search = _GapSearch(self.counts, view.turn_set)
+        self.unseen = unseen_counts(view)
+        self.total = sum(self.unseen)
+
+    def distance(self, counts):
+        return self.search.royal_straights(0, self.royal_straights,
+                                           tuple(counts[:JOKER_CODE]),
+                                           counts[JOKER_CODE])[0]
+
+    def odds(self, counts, missing):
+        if not self.total:
+            return 0.0
+        unseen = self.unseen
+        codes = self.search.useful_codes(tuple(counts[:JOKER_CODE]), counts[JOKER_CODE],
+                                         missing)
+        return float(sum(unseen[code] for code in codes)) / self.total
+
+
+def improve_odds(view):
+    '''Probability that the next card of the stack shortens the distance
+    to lowering of the hand of the view'''
+    evaluator = _Evaluator(view)
+    return evaluator.odds(evaluator.counts, evaluator.distance(evaluator.counts))
+
+def rank_discards(view):
+    '''Discards of every distinct card of the hand, as Discards from the
+    best to the worst: shortest expected distance after the next draw
+    first, then highest card value, so that less score stays in hand'''
+    evaluator = _Evaluator(view)
+    discards = []
+    for code in range(NR_CODES):
+        if not evaluator.counts[code]:
+            continue
+        counts = list(evaluator.counts)
+        counts[code] -= 1
+        missing = evaluator.distance(counts)
+        odds = evaluator.odds(counts, missing)
+        discards.append(Discard(CARDS[code], missing, odds, missing - odds))
+    discards.sort(key=lambda discard: (discard.expected_distance,
+                                       -CODE_VALUES[CARD_CODES[discard.card]]))
+    return discards
@@ -0,0 +1,196 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Streaming statistics over corpora of move logs.
+
+Logs are read one at a time, and each one is scanned from the hands of its
+initial position and its records, keeping only what the statistics need:
+the player in turn, the score and jokers of each hand and how many turns
+each player played. The results are per kind of round aggregates, which
+can be merged, so a corpus can be split over a process pool while memory
+stays bounded by the number of logs in flight:
+
+    $ python analytics.py --processes 4 logs/*.log
+'''
+
+import sys
+
+from carioca import CARD_CODES, CODE_VALUES, JOKER_CODE, TURN_SETS
+import codec
+import movelog
+
+
+class RoundStats(object):
+    'Aggregates of the logged rounds of one kind, which can be merged'
+
+    FIELDS = ('rounds', 'unfinished', 'turns', 'lowerings', 'lowering_turns',
+              'hands', 'residue', 'well_draws', 'stack_draws', 'recycles',
+              'jokers_lowered', 'jokers_given', 'jokers_dropped', 'jokers_left')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def merge(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        return self
+
+    def mean_lowering_turn(self):
+        return float(self.lowering_turns) / self.lowerings if self.lowerings else None
+
+    def mean_residue(self):
+        'Average score left in the hands of the finished rounds'
+        return float(self.residue) / self.hands if self.hands else None
+
+    def well_ratio(self):
+        draws = self.well_draws + self.stack_draws
+        return float(self.well_draws) / draws if draws else None
+
+    def as_dict(self):
+        result = dict((field, getattr(self, field)) for field in self.FIELDS)
+        result.update(mean_lowering_turn=self.mean_lowering_turn(),
+                      mean_residue=self.mean_residue(), well_ratio=self.well_ratio())
+        return result
+
+
+class CorpusStats(object):
+    '''RoundStats for each kind of round, keyed by (trios, straights,
+    royal straights); every entry of TURN_SETS is always there'''
+
+    def __init__(self):
+        self.rounds = dict((turn_set, RoundStats()) for turn_set in TURN_SETS)
+
+    def merge(self, other):
+        for turn_set, theirs in other.rounds.iteritems():
+            self.rounds.setdefault(turn_set, RoundStats()).merge(theirs)
+        return self
+
+    def add(self, log):
+        'Scan a MoveLog'
+        header, hands = codec.decode_hands(log.initial)
+        turn_set = (header.nr_trios, header.nr_straights, header.nr_royal_straights)
+        stats = self.rounds.setdefault(turn_set, RoundStats())
+        _scan(stats, header, hands, log)
+
+    def as_dict(self):
+        return dict((u'%dT %dE %dER' % turn_set, stats.as_dict())
+                    for turn_set, stats in self.rounds.iteritems())
+
+
+def _scan(stats, header, hands, records):
+    nr_players = header.nr_players
+    player = header.player_in_turn
+    scores = [sum(CODE_VALUES[code] for code in hand) for hand in hands]
+    sizes = map(len, hands)
+    jokers = [hand.count(JOKER_CODE) for hand in hands]
+    turns = [0] * nr_players
+
+    for record in records:
+        kind = record[0]
+        if kind in ('well', 'stack'):
+            code = CARD_CODES[record[1]]
+            scores[player] += CODE_VALUES[code]
+            sizes[player] += 1
+            jokers[player] += code == JOKER_CODE
+            if kind == 'well':
+                stats.well_draws += 1
+            else:
+                stats.stack_draws += 1
+        elif kind == 'lower':
+            codes = [CARD_CODES[card] for melds in record[2:]
+                                      for cards in melds for card in cards]
+            scores[player] -= sum(CODE_VALUES[code] for code in codes)
+            sizes[player] -= len(codes)
+            lowered_jokers = codes.count(JOKER_CODE)
+            jokers[player] -= lowered_jokers
+            stats.jokers_lowered += lowered_jokers
+            stats.lowerings += 1
+            stats.lowering_turns += turns[player] + 1
+        elif kind == 'recycle':
+            stats.recycles += 1
+        else:
+            code = CARD_CODES[record[1]]
+            scores[player] -= CODE_VALUES[code]
+            sizes[player] -= 1
+            if code == JOKER_CODE:
+                jokers[player] -= 1
+                if kind == 'give':
+                    stats.jokers_given += 1
+                else:
+                    stats.jokers_dropped += 1
+            if kind == 'drop':
+                turns[player] += 1
+                stats.turns += 1
+                player = (player + 1) % nr_players
+
+    stats.rounds += 1
+    if 0 in sizes:
+        stats.hands += nr_players
+        stats.residue += sum(scores)
+        stats.jokers_left += sum(jokers)
+    else:
+        stats.unfinished += 1
+
+
+def iter_logs(paths):
+    'Generate the logs stored in the given files, one at a time'
+    for path in paths:
+        yield movelog.load(path)
+
+def analyze(logs):
+    'Statistics of an iterable of MoveLogs'
+    stats = CorpusStats()
+    for log in logs:
+        stats.add(log)
+    return stats
+
+def _analyze_files(paths):
+    return analyze(iter_logs(paths))
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def analyze_files(paths, processes=None, chunk_size=100):
+    '''Statistics of the logs stored in the given files (any iterable of
+    paths), spread over a pool of processes. At most two chunks of paths
+    per process are in flight at any time.'''
+
+    if processes == 1:
+        return _analyze_files(paths)
+    from multiprocessing import Pool, cpu_count
+    stats = CorpusStats()
+    pool = Pool(processes)
+    in_flight = []
+    limit = 2 * (processes or cpu_count())
+    try:
+        for chunk in _chunks(paths, chunk_size):
+            in_flight.append(pool.apply_async(_analyze_files, (chunk,)))
+            if len(in_flight) >= limit:
+                stats.merge(in_flight.pop(0).get())
+        for result in in_flight:
+            stats.merge(result.get())
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+
+if __name__ == '__main__':
+    import json
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] LOG...')
+    parser.add_option('-j', '--processes', type='int', default=None)
+    parser.add_option('-c', '--chunk-size', type='int', default=100)
+    options, args = parser.parse_args()
+
+    stats = analyze_files(args, options.processes, options.chunk_size)
+    json.dump(stats.as_dict(), sys.stdout, indent=2, sort_keys=True)
+    print
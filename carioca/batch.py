@@ -0,0 +1,102 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Vectorized meld validation with NumPy.
+
+Each function takes an (N, k) integer array of card codes (see
+carioca.encode_card), one candidate per row, and returns a boolean array
+of length N with the same answers as the functions in carioca.py.
+
+>>> import intcards
+>>> is_straight_batch([intcards.Cs(u'jkr 7♠ 8♠ 9♠'), intcards.Cs(u'7♣ 8♣ jkr 9♣')])
+array([ True, False])
+'''
+
+import numpy as np
+
+from carioca import JOKER_CODE
+
+# Marks the unused tail of a row in can_give_batch
+PAD = -1
+
+def _as_codes(codes):
+    codes = np.asarray(codes, dtype=np.int16)
+    if codes.ndim != 2:
+        raise ValueError('Expected an (N, k) array of card codes')
+    return codes
+
+def _all_equal(values, mask):
+    'Rows where values[mask] holds at most one distinct value'
+    big = np.iinfo(values.dtype).max
+    small = np.iinfo(values.dtype).min
+    highest = np.where(mask, values, small).max(axis=1)
+    lowest = np.where(mask, values, big).min(axis=1)
+    return (highest == lowest) | ~mask.any(axis=1)
+
+def _naturals(codes):
+    return (codes != JOKER_CODE) & (codes != PAD)
+
+def _are_ranks_equal(codes):
+    return _all_equal(codes % 13, _naturals(codes))
+
+def _are_suits_equal(codes):
+    return _all_equal(codes // 13, _naturals(codes))
+
+def _are_ranks_consecutive(codes):
+    positions = np.arange(codes.shape[1], dtype=codes.dtype)
+    return _all_equal((codes % 13 - positions) % 13, _naturals(codes))
+
+def _count_jokers(codes):
+    return (codes == JOKER_CODE).sum(axis=1)
+
+def _has_jokers_too_close(codes):
+    jokers = codes == JOKER_CODE
+    close = np.zeros(len(codes), dtype=bool)
+    for distance in (1, 2):
+        if codes.shape[1] > distance:
+            close |= (jokers[:, distance:] & jokers[:, :-distance]).any(axis=1)
+    return close
+
+def is_trio_batch(codes):
+    codes = _as_codes(codes)
+    if codes.shape[1] != 3:
+        return np.zeros(len(codes), dtype=bool)
+    return (_count_jokers(codes) <= 1) & _are_ranks_equal(codes)
+
+def is_straight_batch(codes):
+    codes = _as_codes(codes)
+    if codes.shape[1] != 4:
+        return np.zeros(len(codes), dtype=bool)
+    return ((_count_jokers(codes) <= 1) & _are_suits_equal(codes) &
+            _are_ranks_consecutive(codes))
+
+def can_give_batch(cards, sets, where=None):
+    '''Whether each card can be given to the lowered set in the same row.
+
+    sets is an (N, k) array; rows of sets shorter than k are filled with
+    PAD at the end. where is 'trio', 'left' or 'right' as in the
+    can_give_to_* functions, or None for any of them, like
+    GameRound.give_to does.
+    '''
+    cards = np.asarray(cards, dtype=np.int16)
+    sets = _as_codes(sets)
+    if where is None:
+        return (can_give_batch(cards, sets, 'trio') |
+                can_give_batch(cards, sets, 'left') |
+                can_give_batch(cards, sets, 'right'))
+
+    rows = np.arange(len(sets))
+    extended = np.empty((sets.shape[0], sets.shape[1] + 1), dtype=np.int16)
+    if where == 'left':
+        extended[:, 0] = cards
+        extended[:, 1:] = sets
+    elif where in ('right', 'trio'):
+        extended[:, :-1] = sets
+        extended[:, -1] = PAD
+        extended[rows, (sets != PAD).sum(axis=1)] = cards
+    else:
+        raise ValueError('where must be one of trio, left, right or None')
+
+    if where == 'trio':
+        return _are_ranks_equal(extended)
+    return (~_has_jokers_too_close(extended) & _are_suits_equal(extended) &
+            _are_ranks_consecutive(extended))
@@ -0,0 +1,286 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Micro and macro benchmarks of the rules engine.
+
+Every benchmark builds its inputs from a fixed seed, so that runs can be
+compared with each other. Results are the best time per operation over a
+few repetitions, and can be saved as JSON and compared with a saved
+baseline: any benchmark slower than the baseline by more than the
+tolerance makes the run fail.
+
+    $ python benchmarks.py --save baseline.json
+    $ python benchmarks.py --baseline baseline.json --tolerance 0.2
+'''
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from carioca import (GameRound, C, Card, Cs, JOKER_CARD, card_repr, create_deck,
+                     is_card_subset, is_royal_straight, is_straight, is_trio)
+import simulation
+try:
+    import numpy
+    import roundbatch
+except ImportError:
+    roundbatch = None
+
+SEED = 1234
+BENCHMARKS = []
+
+# What a headless worker imports
+ENGINE_MODULES = ('carioca', 'moves', 'solver', 'simulation')
+
+
+class Benchmark(object):
+    '''A function that runs an operation number times on inputs built from
+    a random generator, and returns the seconds spent in the operations'''
+
+    def __init__(self, name, kind, number, function):
+        self.name = name
+        self.kind = kind
+        self.number = number
+        self.function = function
+
+    def run(self, repeat=3, scale=1.0):
+        'Best seconds per operation'
+        number = max(1, int(self.number * scale))
+        best = None
+        for n in range(repeat):
+            elapsed = self.function(number, random.Random(SEED))
+            if best is None or elapsed < best:
+                best = elapsed
+        return best / number
+
+def benchmark(kind, number):
+    def register(function):
+        BENCHMARKS.append(Benchmark(function.__name__[len('bench_'):], kind, number, function))
+        return function
+    return register
+
+def _timed(operation, inputs):
+    start = time.time()
+    for args in inputs:
+        operation(*args)
+    return time.time() - start
+
+def _random_melds(rng, number, size, straight):
+    deck = create_deck()
+    melds = []
+    for n in range(number):
+        start = rng.choice(deck[:-2])
+        if straight:
+            melds.append([Card((start.rank - 1 + k) % 13 + 1, start.suit) for k in range(size)])
+        else:
+            melds.append([card for card in deck if card.rank == start.rank][:size])
+        if rng.random() < 0.3:
+            melds[-1][rng.randrange(size)] = JOKER_CARD
+        if rng.random() < 0.3:
+            rng.shuffle(melds[-1])
+    return melds
+
+
+#########
+# Micro #
+#########
+@benchmark('micro', 20000)
+def bench_C(number, rng):
+    reprs = [card_repr(rng.choice(create_deck())) for n in range(number)]
+    return _timed(C, [(r,) for r in reprs])
+
+@benchmark('micro', 5000)
+def bench_Cs(number, rng):
+    deck = create_deck()
+    hands = [u' '.join(card_repr(card) for card in rng.sample(deck, 12)) for n in range(number)]
+    return _timed(Cs, [(r,) for r in hands])
+
+@benchmark('micro', 20000)
+def bench_is_trio(number, rng):
+    return _timed(is_trio, [(meld,) for meld in _random_melds(rng, number, 3, False)])
+
+@benchmark('micro', 20000)
+def bench_is_straight(number, rng):
+    return _timed(is_straight, [(meld,) for meld in _random_melds(rng, number, 4, True)])
+
+@benchmark('micro', 5000)
+def bench_is_royal_straight(number, rng):
+    return _timed(is_royal_straight, [(meld,) for meld in _random_melds(rng, number, 13, True)])
+
+@benchmark('micro', 10000)
+def bench_is_card_subset(number, rng):
+    deck = 2 * create_deck()
+    inputs = []
+    for n in range(number):
+        superset = rng.sample(deck, 12)
+        inputs.append((rng.sample(superset, 7) + rng.sample(deck, 1), superset))
+    return _timed(is_card_subset, inputs)
+
+@benchmark('micro', 2000)
+def bench_GameRound_init(number, rng):
+    deal_rng = random.Random(rng.random())
+    return _timed(lambda *args: GameRound(*args, rng=deal_rng), [(4, 2, 0, 0)] * number)
+
+@benchmark('micro', 2000)
+def bench_GameRound_init_lazy(number, rng):
+    deal_rng = random.Random(rng.random())
+    return _timed(lambda *args: GameRound(*args, lazy=True, rng=deal_rng), [(4, 2, 0, 0)] * number)
+
+def _ready_to_lower(number):
+    'Rounds where player 0 is about to lower a trio and a straight'
+    rounds = []
+    for n in range(number):
+        game_round = GameRound.from_cards(
+                2, 1, 1, 0, stack=Cs(u'3♣ 4♦'), well=Cs(u'K♥'),
+                hands=[Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ 9♣ 4♣ 2♦ jkr'),
+                       Cs(u'3♥ 4♥ 5♥ 6♥  A♠ A♣ A♥  7♠ 7♣ 7♦ 10♥ K♦')])
+        game_round.played_first_turn[0] = True
+        game_round.take_from_stack()
+        rounds.append(game_round)
+    return rounds
+
+@benchmark('micro', 2000)
+def bench_lower(number, rng):
+    rounds = _ready_to_lower(number)
+    melds = dict(trios=Cs(u'2♥ 2♠ jkr'), straights=Cs(u'5♣ 6♣ 7♣ 8♣'))
+    start = time.time()
+    for game_round in rounds:
+        game_round.lower(trios=[list(melds['trios'])], straights=[list(melds['straights'])])
+    return time.time() - start
+
+@benchmark('micro', 2000)
+def bench_give_to(number, rng):
+    rounds = _ready_to_lower(number)
+    for game_round in rounds:
+        game_round.lower(trios=[Cs(u'2♥ 2♠ jkr')], straights=[Cs(u'5♣ 6♣ 7♣ 8♣')])
+    card, straight = C(u'9♣'), Cs(u'5♣ 6♣ 7♣ 8♣')
+    start = time.time()
+    for game_round in rounds:
+        game_round.give_to(card, 0, straight)
+    return time.time() - start
+
+
+#########
+# Macro #
+#########
+@benchmark('macro', 20)
+def bench_simulated_round(number, rng):
+    rounds = [GameRound(4, 1, 1, 0, rng=random.Random(rng.random())) for n in range(number)]
+    policies = [simulation.RandomPolicy(rng.random()) for n in range(4)]
+    start = time.time()
+    for game_round in rounds:
+        simulation.play_round(game_round, policies)
+    return time.time() - start
+
+def _bench_turns(nr_players, nr_decks):
+    'Turns of random play at a table of the given size'
+    def bench(number, rng):
+        policies = [simulation.RandomPolicy(rng.random()) for n in range(nr_players)]
+        turns = 0
+        elapsed = 0.0
+        while turns < number:
+            game_round = GameRound(nr_players, 1, 1, 0, nr_decks=nr_decks,
+                                   rng=random.Random(rng.random()))
+            start = time.time()
+            played, blocked = simulation.play_round(game_round, policies, number - turns)
+            elapsed += time.time() - start
+            turns += played
+        return elapsed
+    bench.__name__ = 'bench_turns_%dp_%dd' % (nr_players, nr_decks)
+    return bench
+
+# The cost of a turn should stay the same as tables and decks grow
+for _size in ((4, 2), (6, 3), (8, 4)):
+    benchmark('macro', 2000)(_bench_turns(*_size))
+
+if roundbatch is not None:
+    @benchmark('macro', 200000)
+    def bench_batch_moves(number, rng):
+        # 100 steps of number / 100 rounds
+        rounds = roundbatch.GameRoundBatch(max(1, number // 100), 4, 2, seed=rng.randrange(1 << 30))
+        numpy_rng = numpy.random.RandomState(rng.randrange(1 << 30))
+        start = time.time()
+        for step in range(100):
+            roundbatch.random_step(rounds, numpy_rng)
+        return time.time() - start
+
+@benchmark('macro', 10)
+def bench_import_engine(number, rng):
+    # In a fresh interpreter each time, as a new worker process would
+    code = ('import time; start = time.time(); import %s; print time.time() - start'
+            % ', '.join(ENGINE_MODULES))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return sum(float(subprocess.check_output([sys.executable, '-c', code], cwd=directory))
+               for n in range(number))
+
+@benchmark('macro', 3)
+def bench_game(number, rng):
+    seeds = [rng.randrange(1 << 30) for n in range(number)]
+    start = time.time()
+    for seed in seeds:
+        simulation.play_game([simulation.RandomPolicy(seed + n) for n in range(4)], seed)
+    return time.time() - start
+
+
+##########
+# Runner #
+##########
+def run(names=None, repeat=3, scale=1.0):
+    'Results of the benchmarks (all of them by default), as a JSON-ready dict'
+    results = {}
+    for bench in BENCHMARKS:
+        if names and bench.name not in names:
+            continue
+        seconds = bench.run(repeat, scale)
+        results[bench.name] = {'kind': bench.kind, 'seconds_per_op': seconds,
+                               'ops_per_second': 1.0 / seconds if seconds else None}
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'seed': SEED, 'results': results}
+
+def compare(report, baseline, tolerance=0.2):
+    '''Benchmarks slower than in the baseline by more than tolerance (a
+    fraction), as (name, baseline seconds, current seconds) tuples'''
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if result['seconds_per_op'] > before['seconds_per_op'] * (1 + tolerance):
+            regressions.append((name, before['seconds_per_op'], result['seconds_per_op']))
+    return regressions
+
+def main(argv):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [BENCHMARK...]')
+    parser.add_option('--save', help='write the results to this JSON file')
+    parser.add_option('--baseline', help='fail if slower than the results in this JSON file')
+    parser.add_option('--tolerance', type='float', default=0.2)
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='multiply the number of operations of each benchmark')
+    options, names = parser.parse_args(argv)
+
+    report = run(names, options.repeat, options.scale)
+    for name, result in sorted(report['results'].items()):
+        print '%-24s %-6s %12.2f us/op %12.0f op/s' % (
+                name, result['kind'], 1e6 * result['seconds_per_op'], result['ops_per_second'])
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(report, json.load(f), options.tolerance)
+        for name, before, now in regressions:
+            print 'REGRESSION %s: %.2f us/op -> %.2f us/op (%+.0f%%)' % (
+                    name, 1e6 * before, 1e6 * now, 100 * (now / before - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,17 @@
 # encoding: utf-8
+import os
+
 import cairo
 import gtk
 
 from carioca import HEARTS, CLUBS, DIAMONDS, SPADES
 from collections import namedtuple
 
+# Card faces, from A to K horizontally and one suit per row; can be
+# overridden with CARIOCA_CARDS_SVG
+CARDS_SVG = os.environ.get('CARIOCA_CARDS_SVG',
+                           '/usr/share/gnome-games-common/cards/gnomangelo_bitmap.svg.unbranded')
+
 # Cards have a 9:14 ratio
 CARD_BASE_WIDTH  = 9
 CARD_BASE_HEIGHT = 14
@@ -146,7 +153,7 @@ class CardArea(gtk.DrawingArea):
 	def __initializeCards(self):
 
 		self.card_pixbuf = dict()
-		tmpbuf = gtk.gdk.pixbuf_new_from_file_at_size('/usr/share/gnome-games-common/cards/gnomangelo_bitmap.svg.unbranded', CARD_WIDTH*13, CARD_HEIGHT*5);
+		tmpbuf = gtk.gdk.pixbuf_new_from_file_at_size(CARDS_SVG, CARD_WIDTH*13, CARD_HEIGHT*5);
 
 		# SVG contains from A to K horizontally,
 		# and CL, DI, HE, SP and vertically
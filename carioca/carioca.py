@@ -1,7 +1,8 @@
 # vim: set fileencoding=utf-8 tabstop=4 expandtab:
 
+import os
 from collections import namedtuple, defaultdict
-from random import shuffle
+import random
 
 JOKER = 0
 A, J, Q, K = 1, 11, 12, 13
@@ -30,6 +31,57 @@ class InvalidRank(ValueError): pass
 class InvalidSuit(ValueError): pass
 class GameRoundException(StandardError): pass
 class InvalidMoveException(StandardError): pass
+class GameException(StandardError): pass
+
+##########################
+# Integer-encoded cards  #
+##########################
+# Every distinct card has a small integer code: suit_index * 13 + rank - 1
+# for ranked cards (0-51), and JOKER_CODE for jokers. Both jokers of a deck
+# are the same card, so they share a code.
+JOKER_CODE = 52
+NR_CODES = 53
+
+CARDS = tuple(Card(rank, suit) for suit in SUITS for rank in RANKS) + \
+        (Card(JOKER, None),)
+CARD_CODES = dict((card, code) for code, card in enumerate(CARDS))
+JOKER_CARD = CARDS[JOKER_CODE]
+
+def _card_names():
+    '''Every usual spelling of every card accepted by C, in upper and lower
+    case, mapped to its instance in CARDS'''
+    rank_names = dict((rank, [unicode(rank)]) for rank in RANKS)
+    for name, rank in LETTER_RANKS.iteritems():
+        rank_names[rank].append(name)
+    names = {}
+    for card in CARDS[:JOKER_CODE]:
+        for rank_name in rank_names[card.rank]:
+            names[rank_name + card.suit] = card
+    for name in (u'JOKER', u'JKR', u'JO', u'JK'):
+        names[name] = JOKER_CARD
+    names.update([(name.lower(), card) for name, card in names.items()])
+    return names
+
+# Shared Card instances by name, so that parsing a card is a dict lookup
+CARD_NAMES = _card_names()
+
+# A deck, made of the instances in CARDS, in the order create_deck gives it
+DECK = tuple(CARDS[CARD_CODES[Card(rank, suit)]] for rank in RANKS for suit in SUITS) + \
+       (JOKER_CARD,) * 2
+
+def encode_card(card):
+    'Integer code of a card'
+    return CARD_CODES[card]
+
+def decode_card(code):
+    'Card corresponding to an integer code'
+    return CARDS[code]
+
+def encode_cards(cards):
+    return [CARD_CODES[card] for card in cards]
+
+def decode_cards(codes):
+    return [CARDS[code] for code in codes]
 
 ############################
 # Convenience constructors #
@@ -47,9 +99,17 @@ def C(r):
     Card(rank=0, suit=None)
     '''
 
+    card = CARD_NAMES.get(r)
+    if card is not None:
+        return card
     r = unicode(r).strip().upper()
+    card = CARD_NAMES.get(r)
+    if card is not None:
+        return card
     if r.startswith((u'JO', u'JK')):
-        return Card(JOKER, None)
+        return JOKER_CARD
+    if not r:
+        raise InvalidRank(u'A card needs a rank and a suit')
     rank_repr, suit = r[:-1], r[-1]
     if suit not in SUITS:
         raise InvalidSuit(u'%s is not a valid suit' % suit)
@@ -60,12 +120,13 @@ def C(r):
     if rank not in RANKS:
         raise InvalidRank(u'%s is not a valid rank' % rank)
 
-    return Card(rank, suit)
+    return CARDS[CARD_CODES[Card(rank, suit)]]
 
 
 def Cs(r):
     'Convenient constructor for a list of cards'
-    return map(C, r.split())
+    names = CARD_NAMES
+    return [names.get(name) or C(name) for name in r.split()]
 
 
 #####################
@@ -117,8 +178,7 @@ def get_score(cards):
     return score
 
 def create_deck():
-    jokers = [Card(JOKER, None)] * 2
-    return [Card(rank, suit) for rank in RANKS for suit in SUITS] + jokers
+    return list(DECK)
 
 def are_ranks_consecutive(cards):
     straight_ranks = set((card.rank - n) % 13
@@ -188,6 +248,304 @@ def is_card_subset(subset, superset):
     return all(subset_counter[card] <= superset_counter[card]
                for card in subset_counter)
 
+CODE_RANKS = tuple(card.rank for card in CARDS)
+CODE_VALUES = tuple(value(card) for card in CARDS)
+
+class Hand(object):
+    '''Multiset of cards stored as per-code copy counts.
+
+    Membership, counting, adding and removing a card take constant time.
+    Iterating or indexing a Hand gives a list view of its cards, sorted by
+    code, which is rebuilt only after the hand changes.
+
+    Besides the per-code counts (a suit x rank matrix, row by row), a hand
+    keeps up to date its number of cards, the number of cards of each rank
+    (index 0 for jokers) and its score, so they can be read at any time.
+    '''
+
+    __slots__ = ('counts', 'rank_counts', 'size', 'score', '_view')
+
+    def __init__(self, cards=()):
+        self.counts = [0] * NR_CODES
+        self.rank_counts = [0] * 14
+        self.size = 0
+        self.score = 0
+        self._view = None
+        for card in cards:
+            self.add(card)
+
+    def add(self, card):
+        code = CARD_CODES[card]
+        self.counts[code] += 1
+        self.rank_counts[CODE_RANKS[code]] += 1
+        self.size += 1
+        self.score += CODE_VALUES[code]
+        self._view = None
+
+    # list compatibility
+    append = add
+
+    def remove(self, card):
+        code = CARD_CODES.get(card)
+        if code is None or not self.counts[code]:
+            raise ValueError('%s is not in hand' % card_repr(card))
+        self.counts[code] -= 1
+        self.rank_counts[CODE_RANKS[code]] -= 1
+        self.size -= 1
+        self.score -= CODE_VALUES[code]
+        self._view = None
+
+    def count(self, card):
+        code = CARD_CODES.get(card)
+        return 0 if code is None else self.counts[code]
+
+    def count_of(self, rank, suit):
+        'Copies of the card with the given rank and suit'
+        return self.counts[CARD_CODES[Card(rank, suit)]]
+
+    def contains_all(self, cards):
+        'Check whether all cards (with repetitions) are in the hand'
+        needed = defaultdict(int)
+        for card in cards:
+            code = CARD_CODES.get(card)
+            if code is None:
+                return False
+            needed[code] += 1
+        counts = self.counts
+        return all(counts[code] >= n for code, n in needed.iteritems())
+
+    def cards(self):
+        'List view of the hand'
+        if self._view is None:
+            self._view = [CARDS[code] for code, n in enumerate(self.counts)
+                                      for _ in xrange(n)]
+        return self._view
+
+    def __contains__(self, card):
+        code = CARD_CODES.get(card)
+        return code is not None and self.counts[code] > 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.cards())
+
+    def __getitem__(self, index):
+        return self.cards()[index]
+
+    def __getstate__(self):
+        # Needed by pickle protocols 0 and 1 because of __slots__
+        return (self.counts, self.rank_counts, self.size, self.score)
+
+    def __setstate__(self, state):
+        self.counts, self.rank_counts, self.size, self.score = state
+        self._view = None
+
+    def __repr__(self):
+        return '<Hand %s>' % card_set_repr(self.cards()).encode('utf-8')
+
+
+class LazyStack(object):
+    '''A shuffled stack of cards that is only shuffled as far as it is
+    read.
+
+    The order of the cards is drawn from the top (the end of the list)
+    down with the same Fisher-Yates steps as random.shuffle, stopping at
+    the deepest position read so far. Every order is as likely as with a
+    full shuffle, but taking k cards costs O(k) random numbers instead of
+    one per card of the decks. Behaves like the list that GameRound.stack
+    otherwise is. rng is a random.Random, the random module by default.
+    '''
+
+    __slots__ = ('_cards', '_hidden', '_rng')
+
+    def __init__(self, cards, rng=None):
+        self._cards = list(cards)
+        # Positions below _hidden hold the cards still to be shuffled
+        self._hidden = len(self._cards)
+        self._rng = rng
+
+    def _reveal(self, position):
+        'Shuffle the cards down to position'
+        cards = self._cards
+        random_ = (self._rng or random).random
+        hidden = self._hidden
+        while hidden > position:
+            other = int(random_() * hidden)
+            hidden -= 1
+            cards[hidden], cards[other] = cards[other], cards[hidden]
+        self._hidden = hidden
+
+    def take(self, n):
+        'Pop n cards, in the order pop would give them'
+        cards = self._cards
+        if n <= 0:
+            return []
+        self._reveal(len(cards) - n)
+        taken = cards[-1:-n - 1:-1]
+        del cards[-n:]
+        return taken
+
+    def pop(self):
+        cards = self._cards
+        self._reveal(len(cards) - 1)
+        return cards.pop()
+
+    def append(self, card):
+        self._cards.append(card)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._reveal(0)
+        elif self._cards:
+            self._reveal(index % len(self._cards))
+        return self._cards[index]
+
+    def __setitem__(self, index, value):
+        self._reveal(0)
+        self._cards[index] = value
+
+    def __len__(self):
+        return len(self._cards)
+
+    def __iter__(self):
+        self._reveal(0)
+        return iter(self._cards)
+
+    def __getstate__(self):
+        return (self._cards, self._hidden, self._rng)
+
+    def __setstate__(self, state):
+        self._cards, self._hidden, self._rng = state
+
+    def __repr__(self):
+        return '<LazyStack %d cards, %d shuffled>' % (len(self._cards),
+                                                      len(self._cards) - self._hidden)
+
+
+SetHandle = namedtuple('SetHandle', ['player', 'kind', 'index'])
+
+def straight_end_fits(straight, where):
+    '''Cards that can be given at the 'left' or 'right' end of a straight.
+
+    Looked up in the end tables of melds.py, where only the two cards at
+    that end decide it, so this stays cheap no matter how long the
+    straight has grown.
+    '''
+    from melds import left_extensions, right_extensions
+    codes = [CARD_CODES[card] for card in straight]
+    extensions = left_extensions(codes) if where == 'left' else right_extensions(codes)
+    return [CARDS[code] for code in sorted(extensions)]
+
+
+class Board(object):
+    '''Index of the sets lowered during a round, and of the cards that can
+    be given to each of them.
+
+    Every lowered trio or straight gets a stable SetHandle. For each rank,
+    the board knows which trios take it; for each card code, which straight
+    ends take it. Both are updated when sets are lowered or cards given.
+    '''
+
+    def __init__(self):
+        self.sets = {}
+        self._by_content = defaultdict(list)
+        self._trios_by_rank = defaultdict(list)
+        self._straight_ends = defaultdict(set)
+        self._ends = {}
+
+    @staticmethod
+    def _content_key(player, cards):
+        return player, tuple(sorted(CARD_CODES.get(card, -1) for card in cards))
+
+    def add(self, player, kind, index, cards):
+        handle = SetHandle(player, kind, index)
+        self.sets[handle] = cards
+        self._by_content[self._content_key(player, cards)].append(handle)
+        if kind == 'trio':
+            ranks = set(card.rank for card in cards if not is_joker(card))
+            for rank in ranks:
+                self._trios_by_rank[rank].append(handle)
+            self._trios_by_rank[JOKER].append(handle)
+        else:
+            self._index_ends(handle)
+        return handle
+
+    def _index_ends(self, handle):
+        for end in self._ends.pop(handle, ()):
+            self._straight_ends[end[0]].discard((handle, end[1]))
+        cards = self.sets[handle]
+        ends = [(CARD_CODES[card], where) for where in ('left', 'right')
+                                          for card in straight_end_fits(cards, where)]
+        for code, where in ends:
+            self._straight_ends[code].add((handle, where))
+        self._ends[handle] = ends
+
+    def find(self, player, cards):
+        'Handle of a set of the given player with the same cards, or None'
+        handles = self._by_content.get(self._content_key(player, cards))
+        return handles[0] if handles else None
+
+    def fits(self, card, handle, where=None):
+        '''Where the card can be given to the set: 'trio', 'left', 'right'
+        or None if it does not fit (or not at the requested end)'''
+        if handle.kind == 'trio':
+            rank = card.rank
+            return 'trio' if handle in self._trios_by_rank.get(rank, ()) else None
+        code = CARD_CODES.get(card)
+        ends = self._straight_ends.get(code, ())
+        for side in ('left', 'right'):
+            if where in (None, side) and (handle, side) in ends:
+                return side
+        return None
+
+    def places_for(self, card):
+        'Every (handle, where) pair where the card can be given'
+        places = [(handle, 'trio') for handle in self._trios_by_rank.get(card.rank, ())]
+        places.extend(self._straight_ends.get(CARD_CODES.get(card), ()))
+        return places
+
+    def _unindex_content(self, handle):
+        key = self._content_key(handle.player, self.sets[handle])
+        self._by_content[key].remove(handle)
+        if not self._by_content[key]:
+            del self._by_content[key]
+
+    def give(self, card, handle, where):
+        cards = self.sets[handle]
+        self._unindex_content(handle)
+        if where == 'left':
+            cards.insert(0, card)
+        else:
+            cards.append(card)
+        self._by_content[self._content_key(handle.player, cards)].append(handle)
+        if handle.kind == 'straight':
+            self._index_ends(handle)
+
+    def take_back(self, handle, where):
+        'Undo the last give to that end of the set, returning the card'
+        cards = self.sets[handle]
+        self._unindex_content(handle)
+        card = cards.pop(0) if where == 'left' else cards.pop()
+        self._by_content[self._content_key(handle.player, cards)].append(handle)
+        if handle.kind == 'straight':
+            self._index_ends(handle)
+        return card
+
+    def remove(self, handle):
+        'Forget a lowered set'
+        self._unindex_content(handle)
+        del self.sets[handle]
+        if handle.kind == 'trio':
+            for handles in self._trios_by_rank.itervalues():
+                if handle in handles:
+                    handles.remove(handle)
+        else:
+            for code, where in self._ends.pop(handle, ()):
+                self._straight_ends[code].discard((handle, where))
+
+
 class Player(object):
     def __init__(self, name):
         self.name = name
@@ -210,13 +568,21 @@ class Player(object):
 class GameRound(object):
     def __init__(self, nr_players,
                  nr_trios=0, nr_straights=0, nr_royal_straights=0,
-                 first_turn=0, nr_decks=2):
+                 first_turn=0, nr_decks=2, deal=True, lazy=False, rng=None,
+                 hand_size=12):
 
         self.nr_trios = nr_trios
         self.nr_straights = nr_straights
         self.nr_royal_straights = nr_royal_straights
         self.nr_players = nr_players
         self.nr_decks = nr_decks
+        self.hand_size = hand_size
+        # Shuffles the deal and the recycled well; the random module if None
+        self.rng = rng
+
+        if deal and nr_players * hand_size >= nr_decks * len(DECK):
+            raise GameRoundException('%d decks are not enough to deal %d cards to %d players'
+                                     % (nr_decks, hand_size, nr_players))
 
         # Information about lowered cards and players
         self.did_lower = [False for pl in range(nr_players)]
@@ -225,11 +591,20 @@ class GameRound(object):
         self.lowered_royal_straights = [None for pl in range(nr_players)]
 
         # Initialize the cards for this round
-        self.stack = nr_decks * create_deck()
-        shuffle(self.stack)
-        self.hands = [[self.stack.pop() for _ in range(12)]
-                      for player in range(nr_players)]
-        self.well = [self.stack.pop()]
+        if deal and lazy:
+            # Only the cards dealt and drawn get shuffled, see LazyStack
+            self.stack = LazyStack(nr_decks * DECK, rng)
+            self.hands = [Hand(self.stack.take(hand_size)) for player in range(nr_players)]
+            self.well = [self.stack.pop()]
+        elif deal:
+            self.stack = nr_decks * create_deck()
+            (rng or random).shuffle(self.stack)
+            self.hands = [Hand(self.stack.pop() for _ in range(hand_size))
+                          for player in range(nr_players)]
+            self.well = [self.stack.pop()]
+        else:
+            self.stack, self.well = [], []
+            self.hands = [Hand() for player in range(nr_players)]
 
         # Setup initial playing conditions
         self.played_first_turn = [False for pl in range(nr_players)]
@@ -237,6 +612,32 @@ class GameRound(object):
         self.card_taken = False
 
         self.scores = [None for pl in range(nr_players)]
+        self.board = Board()
+
+        # Undo records of the moves made so far, see undo()
+        self._journal = []
+        self.distances = None
+
+    @classmethod
+    def from_cards(cls, nr_players, nr_trios, nr_straights, nr_royal_straights,
+                   stack, well, hands, first_turn=0, nr_decks=2):
+        'Round with the given stack, well and hands instead of a shuffled deal'
+        game_round = cls(nr_players, nr_trios, nr_straights, nr_royal_straights,
+                         first_turn, nr_decks, deal=False)
+        game_round.stack = list(stack)
+        game_round.well = list(well)
+        game_round.hands = hands
+        return game_round
+
+    def _get_hands(self):
+        return self._hands
+
+    def _set_hands(self, hands):
+        self._hands = [hand if isinstance(hand, Hand) else Hand(hand)
+                       for hand in hands]
+
+    hands = property(_get_hands, _set_hands,
+                     doc='Hand of each player; plain lists are converted to Hand')
 
     def peek_well_card(self):
         'Peek the card can be taken from the well, without taking it'
@@ -249,22 +650,42 @@ class GameRound(object):
         if self.card_taken:
             raise InvalidMoveException('Cannot take another card, already took one')
 
-        taken_card = self.well.pop()
-        self.hands[self.player_in_turn].append(taken_card)
-        self.card_taken = True
+        taken_card = self.well[-1]
+        self.redo(('well', taken_card))
         return taken_card
 
+    def can_take_from_stack(self):
+        'Whether the stack has cards left, or can get them from the well'
+
+        return bool(self.stack) or len(self.well) > 1
+
     def take_from_stack(self):
-        'Make the player in turn take a card from the stack'
+        '''Make the player in turn take a card from the stack, recycling the
+        well first if the stack ran out'''
 
         if self.card_taken:
             raise InvalidMoveException('Cannot take another card, already took one')
 
-        taken_card = self.stack.pop()
-        self.hands[self.player_in_turn].append(taken_card)
-        self.card_taken = True
+        if not self.stack:
+            self.recycle_well()
+        taken_card = self.stack[-1]
+        self.redo(('stack', taken_card))
         return taken_card
 
+    def recycle_well(self):
+        '''Shuffle the cards of the well, but the top one, into the empty
+        stack. Each card is recycled at most once per time it is dropped,
+        so this costs O(1) per move over a round.'''
+
+        if self.stack:
+            raise GameRoundException('Cannot recycle the well, the stack is not empty')
+        if len(self.well) < 2:
+            raise GameRoundException('Cannot recycle the well, the stack and the well are empty')
+        recycled = self.well[:-1]
+        stack = list(recycled)
+        (self.rng or random).shuffle(stack)
+        self.redo(('recycle', tuple(recycled), tuple(stack)))
+
     def lower(self, trios=[], straights=[], royal_straights=[]):
         'Make the player in turn lower her hands'
 
@@ -279,38 +700,28 @@ class GameRound(object):
         if self.did_lower[player]:
             raise GameRoundException('Player %d already lowered' % player)
 
-        if self.nr_trios:
-            if any(not is_trio(cards) for cards in trios):
-                raise GameRoundException('Invalid trio in %s' % card_set_repr(cards))
-            if len(trios) != self.nr_trios:
-                raise GameRoundException('%d trios are needed, only %d provided' %
-                                         (self.nr_trios, len(trios)))
-        if self.nr_straights:
-            if any(not is_straight(cards) for cards in straights):
-                raise GameRoundException('Invalid straight in %s' % card_set_repr(cards))
-            if len(straights) != self.nr_straights:
-                raise GameRoundException('%d straights are needed, only %d provided' %
-                                         (self.nr_straights, len(straights)))
-        if self.nr_royal_straights:
-            if any(not is_royal_straight(cards) for cards in royal_straights):
-                raise GameRoundException('Invalid royal straight in %s' % card_set_repr(rcards))
-            if len(royal_straights) != self.nr_royal_straights:
-                raise GameRoundException('%d royal straights are needed, only %d provided' %
-                                         (self.nr_royal_straights, len(royal_straights)))
+        # Melds of a kind the round does not ask for are rejected too
+        for kind, check, melds, needed in (
+                ('trios', is_trio, trios, self.nr_trios),
+                ('straights', is_straight, straights, self.nr_straights),
+                ('royal straights', is_royal_straight, royal_straights,
+                 self.nr_royal_straights)):
+            if len(melds) != needed:
+                raise GameRoundException('%d %s are needed, %d provided' %
+                                         (needed, kind, len(melds)))
+            for cards in melds:
+                if not check(cards):
+                    raise GameRoundException('Invalid %s in %s' % (kind[:-1], card_set_repr(cards)))
 
         hand = self.hands[player]
 
         cards_to_lower = [card for item in (trios, straights, royal_straights)
                                for cards in item
                                for card in cards]
-        if not is_card_subset(cards_to_lower, hand):
+        if not hand.contains_all(cards_to_lower):
             raise GameRoundException('Not all cards are in hand')
-        self.lowered_trios[player] = trios
-        self.lowered_straights[player] = straights
-        for card in cards_to_lower:
-            hand.remove(card)
-        self.did_lower[player] = True
-
+        self.redo(('lower', player, tuple(map(tuple, trios)), tuple(map(tuple, straights)),
+                   tuple(map(tuple, royal_straights))))
 
     def drop_to_well(self, card):
         'Make the player in turn end his turn by dropping a card to the well'
@@ -321,15 +732,9 @@ class GameRound(object):
         if card not in hand:
             raise GameRoundException("%s is not in player %d's hand" % (card_repr(card), self.player_in_turn))
 
-        # drop the card
-        self.well.append(card)
-        hand.remove(card)
-
-        # end the turn
-        self.card_taken = False
-        self.played_first_turn[self.player_in_turn] = True
-        self.player_in_turn += 1
-        self.player_in_turn %= self.nr_players
+        # drop the card and end the turn
+        self.redo(('drop', card, self.player_in_turn,
+                   self.played_first_turn[self.player_in_turn]))
 
     def give_to(self, card, player, lowered_set, where=None):
         'Make the player in turn give one of her cards to a lowered hand'
@@ -347,42 +752,157 @@ class GameRound(object):
             raise GameRoundException("%s is not in player %d's hand" % (card_repr(card), self.player_in_turn))
 
         # Check that given lowered set in in the given player's lowered sets
-        found = False
-        if self.lowered_trios[player] is not None:
-            for sset in self.lowered_trios[player]:
-                if is_card_subset(lowered_set, sset) and len(lowered_set) == len(sset):
-                    lowered_set = sset
-                    found = True
-                    break
-        if not found:
-            if self.lowered_straights[player] is not None:
-                for sset in self.lowered_straights[player]:
-                    if is_card_subset(lowered_set, sset) and len(lowered_set) == len(sset):
-                        lowered_set = sset
-                        found = True
-                        break
-        if not found:
+        if isinstance(lowered_set, SetHandle):
+            handle = lowered_set if lowered_set in self.board.sets else None
+        else:
+            handle = self.board.find(player, lowered_set)
+        if handle is None or handle.player != player:
             raise GameRoundException("Given set of cards %s not in player %d's lowered sets" % (lowered_set, player))
 
         # Give card
-        if can_give_to_trio(card, lowered_set):
-            lowered_set.append(card)
-            hand.remove(card)
-        elif (where is None or where == 'left') and can_give_to_straight_at_left(card, lowered_set):
-            lowered_set.insert(0,card)
-            hand.remove(card)
-        elif (where is None or where == 'right') and can_give_to_straight_at_right(card, lowered_set):
-            lowered_set.append(card)
-            hand.remove(card)
+        fit = self.board.fits(card, handle, where)
+        if fit is None:
+            raise GameRoundException("Cannot put %s in the lowered set %s of player %d" % (card_repr(card), self.board.sets[handle], player))
+        self.redo(('give', card, handle, fit))
+
+    def legal_gives(self):
+        '''Every (card, handle, where) give available to the player in turn,
+        one entry per distinct card'''
+        if not self.card_taken or not self.did_lower[self.player_in_turn]:
+            return []
+        return [(card, handle, where)
+                for card in sorted(set(self._hands[self.player_in_turn]))
+                for handle, where in self.board.places_for(card)]
+
+    def legal_moves(self):
+        '''Generate the legal moves of the player in turn, see
+        moves.legal_moves'''
+        from moves import legal_moves
+        return legal_moves(self)
+
+    def track_distances(self):
+        '''Attach a distance.DistanceTracker to the round, which follows
+        every move from then on, and return it'''
+        from distance import DistanceTracker
+        if self.distances is None:
+            self.distances = DistanceTracker(self)
+        return self.distances
+
+    def checkpoint(self):
+        'Mark the current state of the round, to come back to it with rollback'
+        return len(self._journal)
+
+    def rollback(self, mark=0):
+        'Undo every move made since checkpoint() returned mark'
+        while len(self._journal) > mark:
+            self.undo()
+
+    def undo(self):
+        '''Undo the last draw, lowering, give, drop or recycling of the
+        well, in time proportional to the cards it moved'''
+
+        if not self._journal:
+            raise GameRoundException('There are no moves to undo')
+        record = self._journal.pop()
+        kind = record[0]
+        if kind == 'recycle':
+            # No hand changed, there is nothing for the distances either
+            self.stack[:] = []
+            self.well[:-1] = record[1]
+            return
+        if kind in ('well', 'stack'):
+            card = record[1]
+            self._hands[self.player_in_turn].remove(card)
+            (self.well if kind == 'well' else self.stack).append(card)
+            self.card_taken = False
+        elif kind == 'lower':
+            player = record[1]
+            for handle in [handle for handle in self.board.sets if handle.player == player]:
+                self.board.remove(handle)
+            for melds in record[2:]:
+                for cards in melds:
+                    for card in cards:
+                        self._hands[player].add(card)
+            self.lowered_trios[player] = None
+            self.lowered_straights[player] = None
+            self.lowered_royal_straights[player] = None
+            self.did_lower[player] = False
+        elif kind == 'give':
+            card, handle, where = record[1:]
+            self.board.take_back(handle, where)
+            self._hands[self.player_in_turn].add(card)
         else:
-            raise GameRoundException("Cannot put %s in the lowered set %s of player %d" % (card_repr(card), lowered_set, player))
-
+            card, player, played_first_turn = record[1:]
+            self.well.pop()
+            self._hands[player].add(card)
+            self.player_in_turn = player
+            self.played_first_turn[player] = played_first_turn
+            self.card_taken = True
+        if self.distances is not None:
+            self.distances.update(record, undone=True)
+
+    def redo(self, record):
+        '''Apply a move given as an undo record, without checking that it is
+        legal. The records are the ones returned by moves_since:
+
+        ('well', card) and ('stack', card), the card taken;
+        ('lower', player, trios, straights, royal_straights), melds as tuples;
+        ('give', card, handle, where), where is 'trio', 'left' or 'right';
+        ('drop', card, player, played_first_turn before dropping);
+        ('recycle', the well cards below the top one, the new stack), both
+        as tuples from the bottom up
+        '''
+
+        kind = record[0]
+        if kind == 'recycle':
+            del self.well[:-1]
+            self.stack[:] = record[2]
+            self._journal.append(record)
+            return
+        if kind in ('well', 'stack'):
+            card = (self.well if kind == 'well' else self.stack).pop()
+            self._hands[self.player_in_turn].add(card)
+            self.card_taken = True
+        elif kind == 'lower':
+            player, trios, straights, royal_straights = record[1:]
+            trios, straights = map(list, trios), map(list, straights)
+            self.lowered_trios[player] = trios
+            self.lowered_straights[player] = straights
+            self.lowered_royal_straights[player] = map(list, royal_straights)
+            for index, cards in enumerate(trios):
+                self.board.add(player, 'trio', index, cards)
+            for index, cards in enumerate(straights):
+                self.board.add(player, 'straight', index, cards)
+            hand = self._hands[player]
+            for melds in record[2:]:
+                for cards in melds:
+                    for card in cards:
+                        hand.remove(card)
+            self.did_lower[player] = True
+        elif kind == 'give':
+            card, handle, where = record[1:]
+            self.board.give(card, handle, where)
+            self._hands[self.player_in_turn].remove(card)
+        else:
+            card, player = record[1:3]
+            self.well.append(card)
+            self._hands[player].remove(card)
+            self.card_taken = False
+            self.played_first_turn[player] = True
+            self.player_in_turn = (player + 1) % self.nr_players
+        self._journal.append(record)
+        if self.distances is not None:
+            self.distances.update(record)
+
+    def moves_since(self, mark=0):
+        'Records of the moves made since checkpoint() returned mark'
+        return self._journal[mark:]
 
     def is_over(self):
         'Checks if the current game round is over'
 
-        for hand in self.hands:
-            if len(hand) == 0:
+        for hand in self._hands:
+            if not hand.size:
                 return True
         return False
 
@@ -393,7 +913,7 @@ class GameRound(object):
             raise GameRoundException('Round is not over yet, cannot calculate each player\'s score')
 
         for i in range(self.nr_players):
-            self.scores[i] = get_score(self.hands[i])
+            self.scores[i] = self._hands[i].score
 
     def __repr__(self):
         round = ('ER' if self.nr_royal_straights
@@ -409,15 +929,19 @@ finish it, and finally check that the game is over.
 '''
 class CariocaGame(object):
 
-    def __init__(self, nr_players, nr_decks=2):
+    def __init__(self, nr_players, nr_decks=2, lazy=False, rng=None, hand_size=12):
         self._nr_players = nr_players
+        self._hand_size = hand_size
+        self._lazy = lazy
+        # Deals the cards of every round; the random module if None
+        self._rng = rng
         self._current_round = None
         self._current_round_nr = 0
         self._nr_decks = nr_decks
         self._first_turn = 1 # random() % nr_players
 
     def is_over(self):
-        return (self._current_round_nr > len(TURN_SETS))
+        return (self._current_round_nr >= len(TURN_SETS))
 
     def go_to_next_round(self):
 
@@ -428,11 +952,18 @@ class CariocaGame(object):
         current_set = TURN_SETS[self._current_round_nr]
         self._current_round = GameRound(self._nr_players,
                                current_set[0], current_set[1], current_set[2],
-                               self._first_turn, self._nr_decks)
+                               self._first_turn, self._nr_decks, lazy=self._lazy,
+                               rng=self._rng, hand_size=self._hand_size)
         self._current_round_nr += 1
-        self._first_turn += 1
+        self._first_turn = (self._first_turn + 1) % self._nr_players
 
         return self._current_round
 
     def get_current_game(self):
         return self._current_round
+
+
+# Opt-in instrumentation of the hot paths, see instrumentation.py
+if os.environ.get('CARIOCA_INSTRUMENT'):
+    import instrumentation
+    instrumentation.enable()
@@ -0,0 +1,177 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Compact, versioned binary encoding of GameRound states.
+
+Cards are stored as one byte with their code (see carioca.encode_card).
+Version 1 of the layout, little endian:
+
+    header    magic 'CR', version, nr_players, nr_decks, nr_trios,
+              nr_straights, nr_royal_straights, player_in_turn, flags
+              (bit 0: a card was taken, bit 1: scores were calculated)
+    bitfields did_lower and played_first_turn, one bit per player
+    cards     stack, well and each hand: a 16-bit length and the codes
+    melds     for each player that lowered, the number of trios, straights
+              and royal straights, then each meld: a length byte and codes
+
+The undo journal is not stored: a decoded round cannot undo the moves
+played before it was encoded.
+
+>>> from carioca import GameRound
+>>> game_round = GameRound(4, 2, 0, 0)
+>>> data = encode(game_round)
+>>> len(data)
+132
+>>> map(list, decode(data).hands) == map(list, game_round.hands)
+True
+'''
+
+import struct
+
+from collections import namedtuple
+
+from carioca import CARD_CODES, CARDS, GameRound
+
+MAGIC = 'CR'
+VERSION = 1
+
+_HEADER = struct.Struct('<2s8B')
+_LENGTH = struct.Struct('<H')
+_CARD_TAKEN = 1
+_SCORED = 2
+
+class DecodeError(ValueError): pass
+
+Header = namedtuple('Header', ['nr_players', 'nr_decks', 'nr_trios', 'nr_straights',
+                               'nr_royal_straights', 'player_in_turn', 'flags'])
+
+
+def _bitfield(flags):
+    field = bytearray((len(flags) + 7) // 8)
+    for n, flag in enumerate(flags):
+        if flag:
+            field[n // 8] |= 1 << (n % 8)
+    return field
+
+def _append_cards(out, cards):
+    out += _LENGTH.pack(len(cards))
+    out.extend(CARD_CODES[card] for card in cards)
+
+def encode(game_round):
+    'Encode a round as a byte string'
+    flags = ((_CARD_TAKEN if game_round.card_taken else 0) |
+             (_SCORED if game_round.scores[0] is not None else 0))
+    out = bytearray(_HEADER.pack(
+            MAGIC, VERSION, game_round.nr_players, game_round.nr_decks,
+            game_round.nr_trios, game_round.nr_straights,
+            game_round.nr_royal_straights, game_round.player_in_turn, flags))
+    out += _bitfield(game_round.did_lower)
+    out += _bitfield(game_round.played_first_turn)
+
+    _append_cards(out, game_round.stack)
+    _append_cards(out, game_round.well)
+    for hand in game_round.hands:
+        out += _LENGTH.pack(hand.size)
+        out.extend(code for code, n in enumerate(hand.counts) for _ in xrange(n))
+
+    for player, lowered in enumerate(game_round.did_lower):
+        if not lowered:
+            continue
+        meld_lists = (game_round.lowered_trios[player],
+                      game_round.lowered_straights[player],
+                      game_round.lowered_royal_straights[player])
+        out.extend(len(melds) for melds in meld_lists)
+        for melds in meld_lists:
+            for cards in melds:
+                out.append(len(cards))
+                out.extend(CARD_CODES[card] for card in cards)
+    return bytes(out)
+
+
+class _Reader(object):
+    'Reads fields from a buffer in order, without copying it'
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def bitfield(self, nr_bits):
+        field = self.unpack('%dB' % ((nr_bits + 7) // 8))
+        return [bool(field[n // 8] & (1 << (n % 8))) for n in range(nr_bits)]
+
+    def cards(self, length):
+        return [CARDS[code] for code in self.unpack('%dB' % length)]
+
+    def card_list(self):
+        return self.cards(self.unpack('<H')[0])
+
+
+def _read_header(reader):
+    try:
+        header = reader.unpack(_HEADER.format)
+    except struct.error:
+        raise DecodeError('Truncated header')
+    magic, version = header[:2]
+    if magic != MAGIC:
+        raise DecodeError('Not an encoded round')
+    if version != VERSION:
+        raise DecodeError('Unsupported encoding version %d' % version)
+    return Header(*header[2:])
+
+def decode_hands(data):
+    '''Only the header and the card codes of each hand, without building a
+    GameRound'''
+    reader = _Reader(data)
+    header = _read_header(reader)
+    try:
+        reader.offset += 2 * ((header.nr_players + 7) // 8)
+        for skipped in range(2):
+            length = reader.unpack('<H')[0]
+            reader.offset += length
+        return header, [reader.unpack('%dB' % reader.unpack('<H')[0])
+                        for player in range(header.nr_players)]
+    except struct.error:
+        raise DecodeError('Truncated or corrupt round')
+
+def decode(data):
+    'Build the GameRound encoded in data (a string, bytearray or memoryview)'
+    reader = _Reader(data)
+    (nr_players, nr_decks, nr_trios, nr_straights, nr_royal_straights,
+     player_in_turn, flags) = _read_header(reader)
+    try:
+        did_lower = reader.bitfield(nr_players)
+        played_first_turn = reader.bitfield(nr_players)
+        stack = reader.card_list()
+        well = reader.card_list()
+        hands = [reader.card_list() for player in range(nr_players)]
+        game_round = GameRound.from_cards(nr_players, nr_trios, nr_straights,
+                                          nr_royal_straights, stack, well, hands,
+                                          player_in_turn, nr_decks)
+
+        for player, lowered in enumerate(did_lower):
+            if not lowered:
+                continue
+            counts = reader.unpack('3B')
+            trios, straights, royal_straights = [
+                    [reader.cards(reader.unpack('B')[0]) for _ in range(count)]
+                    for count in counts]
+            game_round.lowered_trios[player] = trios
+            game_round.lowered_straights[player] = straights
+            game_round.lowered_royal_straights[player] = royal_straights
+            for index, cards in enumerate(trios):
+                game_round.board.add(player, 'trio', index, cards)
+            for index, cards in enumerate(straights):
+                game_round.board.add(player, 'straight', index, cards)
+    except (struct.error, IndexError):
+        raise DecodeError('Truncated or corrupt round')
+
+    game_round.did_lower = did_lower
+    game_round.played_first_turn = played_first_turn
+    game_round.card_taken = bool(flags & _CARD_TAKEN)
+    if flags & _SCORED:
+        game_round.calculate_scores()
+    return game_round
@@ -0,0 +1,203 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Incremental "distance to lowering" of each player of a GameRound.
+
+The distance of a hand is the number of cards it still needs to lower
+(solver.missing_cards), and its useful cards are the ones that would
+shorten that distance by one (solver.useful_cards). A DistanceTracker
+follows the moves of its round and keeps both up to date for every
+player, solving a hand again only when the change cannot be derived:
+
+- when a useful card enters a hand the distance drops by one, and when
+  any other card enters it stays the same;
+- when a card leaves a hand, the distance stays the same as long as the
+  best partition known for the hand does not need that copy.
+
+Useful cards are searched on demand, together with the codes that the
+best partitions take from the hand and the codes that could fill a gap of
+a partition that misses one card more. They are kept across changes too:
+
+- a natural card that fills no gap of those partitions leaves the useful
+  cards as they are (it cannot be in a better partition);
+- a card that no best partition takes can leave the hand without changing
+  the useful cards, unless a joker is useful only by trying it.
+
+The gap search of a hand is kept as well, and used again (memo included)
+while the hand only holds codes that it already searched. Players that
+already lowered are at distance 0 and need no cards.
+
+>>> from carioca import GameRound, Cs
+>>> game_round = GameRound.from_cards(2, 2, 0, 0, stack=Cs(u'7♠ 5♥'), well=Cs(u'3♣'),
+...     hands=[Cs(u'5♣ 5♦ 8♥ 8♣'), Cs(u'2♠ 2♥ 9♣ J♦')])
+>>> tracker = game_round.track_distances()
+>>> tracker.distance(0), len(tracker.useful(0))
+(2, 9)
+>>> card = game_round.take_from_stack()    # 5♥
+>>> tracker.distance(0), tracker.solves
+(1, 1)
+'''
+
+from carioca import CARDS, CARD_CODES, JOKER_CARD, JOKER_CODE, NR_CODES
+from solver import _counts, _GapSearch, solve
+
+
+class _State(object):
+    'What is known about the hand of a player; None means unknown'
+
+    __slots__ = ('missing', 'needed', 'useful', 'support', 'near', 'extra', 'search')
+
+    def __init__(self):
+        self.missing = None
+        self.needed = None      # copies of each code the best partition uses
+        self.useful = None
+        self.support = None     # codes that some best partition takes
+        self.near = None        # codes that fill a gap missing one card more
+        self.extra = None       # code of a card drawn since near was searched
+        self.search = None      # _GapSearch of a hand with the same codes or more
+
+    def __getstate__(self):
+        # The search is only a cache, and cannot be pickled
+        return [getattr(self, name) for name in self.__slots__[:-1]]
+
+    def __setstate__(self, values):
+        self.__init__()
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+
+class DistanceTracker(object):
+    '''Distance to lowering and useful cards of the players of a round.
+
+    Use GameRound.track_distances() to attach one to a round, so that it
+    sees every move (and every undo) made on it.
+    '''
+
+    def __init__(self, game_round):
+        self.game_round = game_round
+        self.turn_set = (game_round.nr_trios, game_round.nr_straights,
+                         game_round.nr_royal_straights)
+        self.states = [_State() for player in range(game_round.nr_players)]
+        # Hands solved and useful card searches, for profiling
+        self.solves = 0
+        self.searches = 0
+
+    def distance(self, player):
+        'Number of cards the player still needs to lower'
+        if self.game_round.did_lower[player]:
+            return 0
+        state = self.states[player]
+        if state.missing is None:
+            self._solve(player)
+        return state.missing
+
+    def useful(self, player):
+        'Cards that would shorten the distance of the player, as a frozenset'
+        if self.game_round.did_lower[player]:
+            return frozenset()
+        state = self.states[player]
+        if state.useful is None:
+            missing = self.distance(player)
+            counts = self._hand_counts(player)
+            naturals, jokers = tuple(counts[:JOKER_CODE]), counts[JOKER_CODE]
+            search = state.search
+            if search is None or any(n and not searched for n, searched
+                                     in zip(naturals, search.naturals)):
+                search = state.search = _GapSearch(counts, self.turn_set)
+            self.searches += 1
+            codes = search.useful_codes(naturals, jokers, missing)
+            state.useful = frozenset(CARDS[code] for code in codes)
+            state.support = search.gaps(naturals, jokers)[1]
+            state.near = search.gaps(naturals, jokers, 1)[0]
+            state.extra = None
+        return state.useful
+
+    def forget(self, player=None):
+        'Solve again the hand of player (of everyone by default) when needed'
+        for state in (self.states if player is None else [self.states[player]]):
+            state.__init__()
+
+    def _hand_counts(self, player):
+        return _counts(self.game_round.hands[player])
+
+    def _solve(self, player):
+        state = self.states[player]
+        partition = solve(self.game_round.hands[player], self.turn_set)
+        self.solves += 1
+        needed = [0] * NR_CODES
+        for melds in (partition.trios, partition.straights, partition.royal_straights):
+            for cards in melds:
+                for card in cards:
+                    needed[CARD_CODES[card]] += 1
+        state.missing = partition.missing
+        state.needed = needed
+
+    ###########
+    # Changes #
+    ###########
+    def card_added(self, player, card):
+        state = self.states[player]
+        code = CARD_CODES[card]
+        if state.missing == 0:
+            # The known partition can still lower
+            pass
+        elif state.useful is not None and card in state.useful:
+            # The card fills a gap of some best partition, not necessarily
+            # the known one
+            self._unknown(state, state.missing - 1)
+        elif (state.near is not None and state.extra is None and
+              code != JOKER_CODE and code not in state.near):
+            # No partition missing one card more can take it, so the best
+            # ones and the cards that shorten them stay the same; near is
+            # still right for the hand without it
+            state.extra = code
+        elif state.useful is not None:
+            self._unknown(state, state.missing, state.needed)
+        else:
+            self._unknown(state)
+        if state.missing == 0:
+            state.useful = frozenset()
+
+    def card_removed(self, player, card):
+        state = self.states[player]
+        code = CARD_CODES[card]
+        counts = self._hand_counts(player)
+        if code == state.extra:
+            # Back to the hand that near was searched for
+            state.extra = None
+        elif (state.support is not None and code not in state.support and
+                not (JOKER_CARD in state.useful and
+                     (counts[JOKER_CODE] or self.turn_set[2]))):
+            # Neither the best partitions nor the ones that a useful card
+            # makes better take the card
+            if state.needed is not None and counts[code] < state.needed[code]:
+                state.needed = None
+        elif state.needed is not None and counts[code] >= state.needed[code]:
+            self._unknown(state, state.missing, state.needed)
+        else:
+            self._unknown(state)
+        if state.missing == 0:
+            state.useful = frozenset()
+
+    @staticmethod
+    def _unknown(state, missing=None, needed=None):
+        '''Forget what is known about the hand but the given missing and
+        needed (the search is kept)'''
+        state.missing, state.needed = missing, needed
+        state.useful = state.support = state.near = state.extra = None
+
+    def update(self, record, undone=False):
+        '''Follow a move given as an undo record (see GameRound.redo), just
+        made or, with undone, just undone'''
+        game_round = self.game_round
+        kind = record[0]
+        if kind in ('well', 'stack'):
+            changed = self.card_removed if undone else self.card_added
+            changed(game_round.player_in_turn, record[1])
+        elif kind == 'lower':
+            self.forget(record[1])
+        elif kind == 'give':
+            changed = self.card_added if undone else self.card_removed
+            changed(game_round.player_in_turn, record[1])
+        else:
+            changed = self.card_added if undone else self.card_removed
+            changed(record[2], record[1])
@@ -0,0 +1,169 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Opt-in call counters, latency histograms and exception counts for the
+GameRound methods and the rule predicates of carioca.py.
+
+While enabled, the instrumented functions are replaced by wrappers; when
+disabled the originals are put back, so there is no cost at all. Enable it
+for a block, for the whole process, or with CARIOCA_INSTRUMENT=1 in the
+environment:
+
+    >>> from carioca import GameRound
+    >>> with instrumented():
+    ...     game_round = GameRound(2, 1, 0, 0)
+    ...     card = game_round.take_from_stack()
+    >>> snapshot()['GameRound.take_from_stack']['calls']
+    1
+
+Only calls that go through the carioca module or the GameRound class are
+seen: a name imported with "from carioca import is_trio" before enabling
+keeps pointing at the original function.
+'''
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import carioca
+from carioca import GameRound, GameRoundException, InvalidMoveException
+
+METHODS = ('__init__', 'take_from_well', 'take_from_stack', 'lower', 'give_to',
+           'drop_to_well', 'legal_gives', 'legal_moves', 'undo', 'redo',
+           'is_over', 'calculate_scores')
+PREDICATES = ('C', 'Cs', 'is_trio', 'is_straight', 'is_royal_straight',
+              'can_give_to_trio', 'can_give_to_straight_at_left',
+              'can_give_to_straight_at_right', 'is_card_subset', 'get_score')
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+_clock = time.time
+
+
+class Metrics(object):
+    'What was measured for one function'
+
+    __slots__ = ('calls', 'seconds', 'buckets', 'invalid_moves', 'round_errors',
+                 'other_errors')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.invalid_moves = 0
+        self.round_errors = 0
+        self.other_errors = 0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'buckets': dict(zip(map(str, BUCKETS) + ['+Inf'], self.buckets)),
+                'exceptions': {'InvalidMoveException': self.invalid_moves,
+                               'GameRoundException': self.round_errors,
+                               'other': self.other_errors}}
+
+
+_metrics = {}
+_originals = {}
+
+def _wrap(name, function):
+    metrics = _metrics.setdefault(name, Metrics())
+
+    def wrapper(*args, **kwargs):
+        start = _clock()
+        try:
+            return function(*args, **kwargs)
+        except InvalidMoveException:
+            metrics.invalid_moves += 1
+            raise
+        except GameRoundException:
+            metrics.round_errors += 1
+            raise
+        except Exception:
+            metrics.other_errors += 1
+            raise
+        finally:
+            elapsed = _clock() - start
+            metrics.calls += 1
+            metrics.seconds += elapsed
+            metrics.buckets[bisect_left(BUCKETS, elapsed)] += 1
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+def _targets():
+    for name in METHODS:
+        yield GameRound, name, 'GameRound.' + name
+    for name in PREDICATES:
+        yield carioca, name, name
+
+def is_enabled():
+    return bool(_originals)
+
+def enable():
+    'Start measuring (does nothing if already enabled)'
+    if _originals:
+        return
+    for owner, attribute, name in _targets():
+        original = owner.__dict__[attribute]
+        _originals[name] = (owner, attribute, original)
+        setattr(owner, attribute, _wrap(name, original))
+
+def disable():
+    'Stop measuring, putting the original functions back'
+    for owner, attribute, original in _originals.itervalues():
+        setattr(owner, attribute, original)
+    _originals.clear()
+
+def reset():
+    'Forget what was measured so far'
+    for metrics in _metrics.itervalues():
+        metrics.__init__()
+
+@contextmanager
+def instrumented(reset_metrics=True):
+    'Measure the calls made inside a with block'
+    was_enabled = is_enabled()
+    if reset_metrics:
+        reset()
+    enable()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
+
+
+###########
+# Exports #
+###########
+def snapshot():
+    'Measures of each function called so far, as a dict'
+    return dict((name, metrics.as_dict()) for name, metrics in _metrics.iteritems()
+                if metrics.calls)
+
+def prometheus(prefix='carioca'):
+    'Measures in the Prometheus text exposition format'
+    measured = [('function="%s"' % name, metrics)
+                for name, metrics in sorted(_metrics.iteritems()) if metrics.calls]
+
+    lines = ['# TYPE %s_calls_total counter' % prefix]
+    for label, metrics in measured:
+        lines.append('%s_calls_total{%s} %d' % (prefix, label, metrics.calls))
+
+    lines.append('# TYPE %s_call_seconds histogram' % prefix)
+    for label, metrics in measured:
+        cumulative = 0
+        for bound, count in zip(map(repr, BUCKETS) + ['+Inf'], metrics.buckets):
+            cumulative += count
+            lines.append('%s_call_seconds_bucket{%s,le="%s"} %d' % (prefix, label, bound, cumulative))
+        lines.append('%s_call_seconds_sum{%s} %r' % (prefix, label, metrics.seconds))
+        lines.append('%s_call_seconds_count{%s} %d' % (prefix, label, metrics.calls))
+
+    lines.append('# TYPE %s_exceptions_total counter' % prefix)
+    for label, metrics in measured:
+        for kind, count in (('InvalidMoveException', metrics.invalid_moves),
+                            ('GameRoundException', metrics.round_errors),
+                            ('other', metrics.other_errors)):
+            lines.append('%s_exceptions_total{%s,type="%s"} %d' % (prefix, label, kind, count))
+    return '\n'.join(lines) + '\n'
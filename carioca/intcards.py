@@ -0,0 +1,149 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Rules engine working on integer-encoded cards.
+
+Cards are the codes defined in carioca.py (see encode_card), so the
+predicates below only do table lookups on small integers instead of
+reading attributes of Card tuples. Convert with encode_cards and
+decode_cards at the edges.
+
+>>> is_straight(Cs(u'9♠ 10♠ J♠ Q♠'))
+True
+'''
+
+import carioca
+from carioca import (JOKER_CODE, NR_CODES, CARDS, CARD_CODES, SUITS,
+                     encode_card, decode_card, encode_cards, decode_cards)
+
+# Per-code lookup tables. Jokers have rank 0 and no suit.
+RANK_OF = tuple(card.rank for card in CARDS)
+SUIT_OF = tuple(SUITS.index(card.suit) if card.suit else None for card in CARDS)
+VALUE_OF = tuple(carioca.value(card) for card in CARDS)
+REPR_OF = tuple(carioca.card_repr(card) for card in CARDS)
+DECK = tuple(encode_cards(carioca.create_deck()))
+
+############################
+# Convenience constructors #
+############################
+def C(r):
+    u'''Code of the card described by a string.
+
+    >>> C(u'2♥')
+    14
+    >>> C(u'JOKER')
+    52
+    '''
+    return CARD_CODES[carioca.C(r)]
+
+def Cs(r):
+    'Convenient constructor for a list of card codes'
+    return map(C, r.split())
+
+def create_deck():
+    return list(DECK)
+
+
+#####################
+# Auxiliary methods #
+#####################
+def is_joker(code):
+    return code == JOKER_CODE
+
+def card_repr(code):
+    return REPR_OF[code]
+
+def card_set_repr(codes):
+    return u'[' + ','.join(REPR_OF[code] for code in codes) + u']'
+
+def value(code):
+    return VALUE_OF[code]
+
+def get_score(codes):
+    '''Calculates the score corresponding to a set of card codes'''
+    return sum(map(VALUE_OF.__getitem__, codes))
+
+def count_jokers(codes):
+    return codes.count(JOKER_CODE)
+
+def are_ranks_consecutive(codes):
+    first = None
+    for n, code in enumerate(codes):
+        if code != JOKER_CODE:
+            r = (RANK_OF[code] - n) % 13
+            if first is None:
+                first = r
+            elif r != first:
+                return False
+    return True
+
+def are_suits_equal(codes):
+    suit = None
+    for code in codes:
+        if code != JOKER_CODE:
+            if suit is None:
+                suit = SUIT_OF[code]
+            elif SUIT_OF[code] != suit:
+                return False
+    return True
+
+def are_ranks_equal(codes):
+    rank = None
+    for code in codes:
+        if code != JOKER_CODE:
+            if rank is None:
+                rank = RANK_OF[code]
+            elif RANK_OF[code] != rank:
+                return False
+    return True
+
+def is_trio(codes):
+    return (len(codes) == 3 and codes.count(JOKER_CODE) <= 1 and
+            are_ranks_equal(codes))
+
+def is_straight(codes):
+    return (len(codes) == 4 and codes.count(JOKER_CODE) <= 1 and
+            are_suits_equal(codes) and are_ranks_consecutive(codes))
+
+def is_royal_straight(codes):
+    # Same ordering as carioca.is_royal_straight, without sorting in place
+    codes = sorted(codes, key=RANK_OF.__getitem__)
+    return (len(codes) == 13 and codes.count(JOKER_CODE) <= 1 and
+            are_suits_equal(codes) and are_ranks_consecutive(codes))
+
+def can_give_to_trio(code, trio):
+    return are_ranks_equal(trio + [code])
+
+def has_jokers_too_close(codes):
+    last_joker = None
+    for n, code in enumerate(codes):
+        if code == JOKER_CODE:
+            if last_joker is not None and n - last_joker <= 2:
+                return True
+            last_joker = n
+    return False
+
+def can_give_to_straight_at_left(code, straight):
+    codes = [code] + straight
+    return (not has_jokers_too_close(codes) and are_suits_equal(codes)
+            and are_ranks_consecutive(codes))
+
+def can_give_to_straight_at_right(code, straight):
+    codes = straight + [code]
+    return (not has_jokers_too_close(codes) and are_suits_equal(codes)
+            and are_ranks_consecutive(codes))
+
+def card_counts(codes):
+    'Number of copies of each card code'
+    counts = [0] * NR_CODES
+    for code in codes:
+        counts[code] += 1
+    return counts
+
+def is_card_subset(subset, superset):
+    '''Check whether all card codes in subset are in superset'''
+    counts = card_counts(superset)
+    for code in subset:
+        counts[code] -= 1
+        if counts[code] < 0:
+            return False
+    return True
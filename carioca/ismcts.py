@@ -0,0 +1,247 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Information-set Monte Carlo Tree Search player.
+
+On each decision the bot samples the cards it cannot see (the stack and the
+other players' hands) from the cards that are not in its hand, the well or
+the board, and searches the moves of moves.legal_moves on that guess. Each
+iteration uses a new guess, and the statistics of a move are shared by all
+the guesses where it was legal (single observer ISMCTS). Cards that other
+players took from the well are not tracked, they are guessed like the rest.
+
+The search works on a single copy of the round: a guess is dealt in place,
+and the moves played on it are taken back with GameRound.rollback.
+
+    >>> from carioca import GameRound
+    >>> bot = ISMCTSBot(iterations=50, seed=1)
+    >>> game_round = GameRound(3, 2, 0, 0)
+    >>> bot.choose(game_round) in list(game_round.legal_moves())
+    True
+'''
+
+import copy
+import random
+import time
+from math import log, sqrt
+
+from carioca import Hand
+import solver
+
+# Added to the hand score of players that have not lowered yet, when a
+# rollout stops before the end of the round
+UNLOWERED_PENALTY = 50
+
+
+class Node(object):
+    'Statistics of a move, in the context of the moves that led to it'
+
+    __slots__ = ('move', 'player', 'parent', 'children', 'visits', 'reward', 'available')
+
+    def __init__(self, move=None, player=None, parent=None):
+        self.move = move
+        self.player = player
+        self.parent = parent
+        self.children = {}
+        self.visits = 0
+        self.reward = 0.0
+        self.available = 1
+
+    def ucb(self, exploration):
+        return (self.reward / self.visits +
+                exploration * sqrt(log(self.available) / self.visits))
+
+
+class Determinizer(object):
+    '''Deals guesses of the hidden cards of a round, as seen by one player,
+    on a private copy of the round'''
+
+    def __init__(self, game_round, observer):
+        self.round = copy.deepcopy(game_round)
+        self.observer = observer
+        self.others = [player for player in range(game_round.nr_players)
+                              if player != observer]
+        self.hidden = list(game_round.stack)
+        for player in self.others:
+            self.hidden.extend(game_round.hands[player])
+        self.mark = self.round.checkpoint()
+
+    def sample(self, rng):
+        'Go back to the original position, and deal a new guess'
+        game_round = self.round
+        game_round.rollback(self.mark)
+        # Recycling the well in the rollouts shuffles with rng too
+        game_round.rng = rng
+        rng.shuffle(self.hidden)
+        start = len(game_round.stack)
+        game_round.stack[:] = self.hidden[:start]
+        for player in self.others:
+            end = start + len(game_round.hands[player])
+            game_round.hands[player] = Hand(self.hidden[start:end])
+            start = end
+        return game_round
+
+
+def _rewards(game_round):
+    '''Reward of each player in [0, 1]: the share of opponents with a worse
+    hand score, counting ties as half'''
+    if not game_round.is_over():
+        estimates = [hand.score + (0 if game_round.did_lower[player] else UNLOWERED_PENALTY)
+                     for player, hand in enumerate(game_round.hands)]
+    else:
+        estimates = [hand.score for hand in game_round.hands]
+    opponents = float(len(estimates) - 1)
+    return [(sum(other > estimate for other in estimates) +
+             0.5 * (estimates.count(estimate) - 1)) / opponents
+            for estimate in estimates]
+
+def _rollout(game_round, rng, turns):
+    'Play quick random turns, lowering and giving when possible'
+    turn_set = (game_round.nr_trios, game_round.nr_straights,
+                game_round.nr_royal_straights)
+    for turn in xrange(turns):
+        if game_round.is_over():
+            break
+        player = game_round.player_in_turn
+        hand = game_round.hands[player]
+        if not game_round.card_taken:
+            if game_round.well and (not game_round.stack or rng.random() < 0.3):
+                game_round.take_from_well()
+            elif game_round.can_take_from_stack():
+                game_round.take_from_stack()
+            else:
+                break
+        if not game_round.did_lower[player] and game_round.played_first_turn[player]:
+            if solver.can_lower(hand, turn_set):
+                partition = solver.solve(hand, turn_set)
+                game_round.lower(partition.trios, partition.straights,
+                                 partition.royal_straights)
+        if game_round.did_lower[player]:
+            gives = game_round.legal_gives()
+            while gives and hand.size:
+                card, handle, where = gives[0]
+                game_round.give_to(card, handle.player, handle, where)
+                gives = game_round.legal_gives()
+        if hand.size:
+            game_round.drop_to_well(rng.choice(hand.cards()))
+    return _rewards(game_round)
+
+
+def search(game_round, iterations=1000, time_limit=None, exploration=0.7,
+           rollout_turns=None, seed=None):
+    '''Search the moves of the player in turn, until running out of
+    iterations or of time_limit seconds (whichever comes first; None means
+    no limit). Returns a dict of move -> (visits, total reward).'''
+
+    if iterations is None and time_limit is None:
+        raise ValueError('Either iterations or time_limit must be given')
+    rng = random.Random(seed)
+    if rollout_turns is None:
+        rollout_turns = 2 * game_round.nr_players
+    determinizer = Determinizer(game_round, game_round.player_in_turn)
+    deadline = None if time_limit is None else time.time() + time_limit
+    root = Node()
+
+    done = 0
+    while iterations is None or done < iterations:
+        if deadline is not None and time.time() >= deadline:
+            break
+        done += 1
+        guess = determinizer.sample(rng)
+        node = root
+
+        # Selection down the known moves, expanding the first unknown one
+        while not guess.is_over():
+            legal = list(guess.legal_moves())
+            if not legal:
+                break
+            children = node.children
+            untried = []
+            for move in legal:
+                if move in children:
+                    children[move].available += 1
+                else:
+                    untried.append(move)
+            if untried:
+                move = rng.choice(untried)
+                node = children[move] = Node(move, guess.player_in_turn, node)
+                move.apply(guess)
+                break
+            node = max((children[move] for move in legal),
+                       key=lambda child: child.ucb(exploration))
+            node.move.apply(guess)
+
+        rewards = _rollout(guess, rng, rollout_turns)
+        while node is not root:
+            node.visits += 1
+            node.reward += rewards[node.player]
+            node = node.parent
+
+    return dict((move, (child.visits, child.reward))
+                for move, child in root.children.iteritems())
+
+def _search_task(args):
+    return search(*args)
+
+
+class ISMCTSBot(object):
+    '''Chooses the moves of the player in turn with ISMCTS.
+
+    The budget of each decision is given in iterations, in seconds, or both.
+    With processes > 1, that many independent searches run in a pool (root
+    parallelization) and their statistics are added up.
+    '''
+
+    def __init__(self, iterations=1000, time_limit=None, processes=1,
+                 exploration=0.7, rollout_turns=None, seed=None):
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.processes = processes
+        self.exploration = exploration
+        self.rollout_turns = rollout_turns
+        self.rng = random.Random(seed)
+        self._pool = None
+
+    def statistics(self, game_round):
+        'Visits and total reward of each move, merged over the searches'
+        tasks = [(game_round, self.iterations, self.time_limit, self.exploration,
+                  self.rollout_turns, self.rng.getrandbits(32))
+                 for _ in range(self.processes)]
+        if self.processes == 1:
+            results = map(_search_task, tasks)
+        else:
+            if self._pool is None:
+                from multiprocessing import Pool
+                self._pool = Pool(self.processes)
+            results = self._pool.map(_search_task, tasks)
+        merged = {}
+        for result in results:
+            for move, (visits, reward) in result.iteritems():
+                total = merged.get(move, (0, 0.0))
+                merged[move] = (total[0] + visits, total[1] + reward)
+        return merged
+
+    def choose(self, game_round):
+        'The most visited move, or None if there is no legal move'
+        legal = list(game_round.legal_moves())
+        if len(legal) <= 1:
+            return legal[0] if legal else None
+        stats = self.statistics(game_round)
+        return max(legal, key=lambda move: stats.get(move, (0, 0.0)))
+
+    def play_turn(self, game_round):
+        'Play moves until the turn passes to another player or the round ends'
+        player = game_round.player_in_turn
+        played = []
+        while game_round.player_in_turn == player and not game_round.is_over():
+            move = self.choose(game_round)
+            if move is None:
+                break
+            move.apply(game_round)
+            played.append(move)
+        return played
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
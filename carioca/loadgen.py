@@ -0,0 +1,148 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Load generator for server.py.
+
+Opens one connection per seat of many tables, and plays every seat with a
+trivial policy (draw from the stack, drop the highest card) as fast as the
+server answers. Reports the moves per second and the latency of the
+answers to the moves:
+
+    $ python loadgen.py --tables 500 --players 4 --duration 10
+
+With --local, a server is started in a thread of the same process.
+'''
+
+import asynchat
+import asyncore
+import json
+import socket
+import threading
+import time
+
+from carioca import C, value
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.moves = 0
+        self.errors = 0
+        self.games = 0
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def moves_per_second(self):
+        return self.moves / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        return ('<LoadStats %d moves, %.0f moves/s, p50 %.2f ms, p99 %.2f ms, '
+                '%d errors, %d games>' % (self.moves, self.moves_per_second(),
+                                          1000 * (p50 or 0), 1000 * (p99 or 0),
+                                          self.errors, self.games))
+
+
+class Client(asynchat.async_chat):
+    'One seat of a table'
+
+    def __init__(self, address, table, nr_players, stats, socket_map):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        self.set_terminator('\n')
+        self.buffer = []
+        self.stats = stats
+        self.seat = None
+        self.sent_at = None
+        self.request({'op': 'join', 'table': table, 'players': nr_players})
+
+    def request(self, message):
+        if message.get('op') == 'move':
+            self.sent_at = time.time()
+        self.push(json.dumps(message) + '\n')
+
+    def handle_connect(self):
+        pass
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        message = json.loads(''.join(self.buffer))
+        self.buffer = []
+        kind = message['type']
+        if kind == 'joined':
+            self.seat = message['seat']
+        elif kind == 'turn' and message['player'] == self.seat:
+            self.request({'op': 'move', 'move': 'stack'})
+        elif kind in ('result', 'error'):
+            if self.sent_at is not None:
+                self.stats.latencies.append(time.time() - self.sent_at)
+                self.sent_at = None
+            if kind == 'error':
+                self.stats.errors += 1
+                return
+            self.stats.moves += 1
+            if message['in_turn'] and message['hand']:
+                card = max(message['hand'], key=lambda r: value(C(r)))
+                self.request({'op': 'move', 'move': 'drop', 'card': card})
+        elif kind == 'game_over':
+            if self.seat == 0:
+                self.stats.games += 1
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+
+def run(address, nr_tables=100, nr_players=4, duration=10.0, prefix='load'):
+    'Play nr_tables tables against the server for duration seconds'
+    stats = LoadStats()
+    socket_map = {}
+    for table in range(nr_tables):
+        for seat in range(nr_players):
+            Client(address, '%s-%d' % (prefix, table), nr_players, stats, socket_map)
+    start = time.time()
+    while socket_map and time.time() - start < duration:
+        asyncore.loop(timeout=0.05, use_poll=True, map=socket_map, count=1)
+    stats.elapsed = time.time() - start
+    for client in socket_map.values():
+        client.close()
+    return stats
+
+def run_local(nr_tables=100, nr_players=4, duration=10.0):
+    'Start a server in a thread, and run the load against it'
+    import server
+    local = server.Server(port=0)
+    thread = threading.Thread(target=local.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        return run(local.address, nr_tables, nr_players, duration)
+    finally:
+        local.shutdown()
+        thread.join()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('-p', '--port', type='int', default=7788)
+    parser.add_option('--local', action='store_true', default=False)
+    parser.add_option('-t', '--tables', type='int', default=100)
+    parser.add_option('-n', '--players', type='int', default=4)
+    parser.add_option('-d', '--duration', type='float', default=10.0)
+    options, args = parser.parse_args()
+
+    if options.local:
+        print run_local(options.tables, options.players, options.duration)
+    else:
+        print run((options.host, options.port), options.tables, options.players,
+                  options.duration)
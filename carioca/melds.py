@@ -0,0 +1,100 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Table-driven meld validation on integer-encoded cards.
+
+Every legal ordered trio and straight, and the cards that can extend each
+end of a straight, are computed once at import time from the reference
+predicates in intcards.py. Afterwards each check is a single lookup.
+
+>>> is_straight(Cs(u'jkr 7♠ 8♠ 9♠'))
+True
+>>> sorted(map(card_repr, right_extensions(Cs(u'6♦ 7♦ 8♦ 9♦'))))
+[u'10\\u2666', u'JOKER']
+'''
+
+import intcards
+from intcards import JOKER_CODE, RANK_OF, Cs, card_repr
+
+EMPTY = frozenset()
+
+def _candidate_trios():
+    for rank in range(13):
+        cards = [suit * 13 + rank for suit in range(4)] + [JOKER_CODE]
+        for a in cards:
+            for b in cards:
+                for c in cards:
+                    yield (a, b, c)
+
+def _candidate_straights():
+    # Each window of four ranks of a suit, with any position as a joker
+    for suit in range(4):
+        for start in range(13):
+            window = [suit * 13 + (start + n) % 13 for n in range(4)]
+            for mask in range(16):
+                yield tuple(JOKER_CODE if mask & (1 << n) else code
+                            for n, code in enumerate(window))
+
+def _end_pairs():
+    'Pairs of cards that can be found at either end of a legal straight'
+    pairs = set()
+    for straight in STRAIGHTS:
+        pairs.add(straight[:2])
+        pairs.add(straight[-2:])
+    return pairs
+
+def _suit_candidates(pair):
+    suit = [code for code in pair if code != JOKER_CODE][0] // 13
+    return [suit * 13 + rank for rank in range(13)] + [JOKER_CODE]
+
+TRIOS = frozenset(cards for cards in _candidate_trios()
+                        if intcards.is_trio(list(cards)))
+STRAIGHTS = frozenset(cards for cards in _candidate_straights()
+                            if intcards.is_straight(list(cards)))
+
+# Indexed by the two cards at the end of a (legal) straight, of any length:
+# those are the only ones that decide which cards fit there.
+LEFT_EXTENSIONS = {}
+RIGHT_EXTENSIONS = {}
+for pair in _end_pairs():
+    LEFT_EXTENSIONS[pair] = frozenset(
+        code for code in _suit_candidates(pair)
+             if intcards.can_give_to_straight_at_left(code, list(pair)))
+    RIGHT_EXTENSIONS[pair] = frozenset(
+        code for code in _suit_candidates(pair)
+             if intcards.can_give_to_straight_at_right(code, list(pair)))
+del pair
+
+# Indexed by rank: any card of that rank, and jokers, fit a trio
+TRIO_EXTENSIONS = dict((rank, frozenset([JOKER_CODE] + range(rank - 1, 52, 13)))
+                       for rank in range(1, 14))
+
+
+def is_trio(codes):
+    return tuple(codes) in TRIOS
+
+def is_straight(codes):
+    return tuple(codes) in STRAIGHTS
+
+def left_extensions(straight):
+    'Cards that can be put at the left of a legal straight'
+    return LEFT_EXTENSIONS.get((straight[0], straight[1]), EMPTY)
+
+def right_extensions(straight):
+    'Cards that can be put at the right of a legal straight'
+    return RIGHT_EXTENSIONS.get((straight[-2], straight[-1]), EMPTY)
+
+def trio_extensions(trio):
+    'Cards that can be given to a legal trio'
+    for code in trio:
+        if code != JOKER_CODE:
+            return TRIO_EXTENSIONS[RANK_OF[code]]
+    return EMPTY
+
+def can_give_to_trio(code, trio):
+    return code in trio_extensions(trio)
+
+def can_give_to_straight_at_left(code, straight):
+    return code in left_extensions(straight)
+
+def can_give_to_straight_at_right(code, straight):
+    return code in right_extensions(straight)
@@ -0,0 +1,280 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Append-only logs of the moves of a round, and their replay.
+
+A log holds the position where it was started, encoded with codec (for a
+new round, that is the shuffled deal), followed by one record for each
+take_from_well, take_from_stack, lower, give_to and drop_to_well call. The
+records are the ones of GameRound.moves_since. As a file, a log is:
+
+    header   magic 'CL', version, 32-bit length of the initial position
+    initial  the position, as written by codec.encode
+    records  one after the other, starting with a kind byte:
+             'W' or 'S' and the card taken,
+             'L', the player, the number of trios, straights and royal
+                  straights, then each meld: a length byte and the cards,
+             'G', the card, the player, kind ('t' or 's') and index of the
+                  set, and where ('t', 'l' or 'r'),
+             'D', the card, the player and whether it was not his first turn,
+             'R', a 16-bit number of cards, the well cards recycled and
+                  then the stack they were shuffled into
+
+>>> from carioca import GameRound
+>>> game_round = GameRound(3, 2, 0, 0)
+>>> log = MoveLog.start(game_round)
+>>> card = game_round.take_from_stack()
+>>> game_round.drop_to_well(card)
+>>> log.update(game_round)
+2
+>>> replay(loads(dumps(log))).well == game_round.well
+True
+'''
+
+import struct
+from itertools import chain, islice
+
+from carioca import (CARD_CODES, CARDS, GameRoundException, InvalidMoveException,
+                     SetHandle)
+import codec
+
+MAGIC = 'CL'
+VERSION = 1
+
+_HEADER = struct.Struct('<2sBI')
+_TAKE = struct.Struct('<cB')
+_LOWER = struct.Struct('<cB3B')
+_GIVE = struct.Struct('<cBBcBc')
+_DROP = struct.Struct('<cBBB')
+_RECYCLE = struct.Struct('<cH')
+
+_TAKE_KINDS = {'well': 'W', 'stack': 'S', 'W': 'well', 'S': 'stack'}
+_SET_KINDS = {'trio': 't', 'straight': 's', 't': 'trio', 's': 'straight'}
+_ENDS = {'trio': 't', 'left': 'l', 'right': 'r', 't': 'trio', 'l': 'left', 'r': 'right'}
+
+class ReplayError(ValueError): pass
+
+
+#################
+# Record format #
+#################
+def encode_record(record):
+    kind = record[0]
+    if kind in ('well', 'stack'):
+        return _TAKE.pack(_TAKE_KINDS[kind], CARD_CODES[record[1]])
+    if kind == 'lower':
+        out = bytearray(_LOWER.pack('L', record[1], *map(len, record[2:])))
+        for melds in record[2:]:
+            for cards in melds:
+                out.append(len(cards))
+                out.extend(CARD_CODES[card] for card in cards)
+        return bytes(out)
+    if kind == 'give':
+        card, handle, where = record[1:]
+        return _GIVE.pack('G', CARD_CODES[card], handle.player,
+                          _SET_KINDS[handle.kind], handle.index, _ENDS[where])
+    if kind == 'recycle':
+        out = bytearray(_RECYCLE.pack('R', len(record[1])))
+        for cards in record[1:]:
+            out.extend(CARD_CODES[card] for card in cards)
+        return bytes(out)
+    card, player, played_first_turn = record[1:]
+    return _DROP.pack('D', CARD_CODES[card], player, played_first_turn)
+
+def decode_records(data, offset=0):
+    'Generate the records found in data, from offset to its end'
+    data = memoryview(data)
+    end = len(data)
+    try:
+        while offset < end:
+            kind = data[offset]
+            if kind in 'WS':
+                kind, code = _TAKE.unpack_from(data, offset)
+                offset += _TAKE.size
+                yield (_TAKE_KINDS[kind], CARDS[code])
+            elif kind == 'L':
+                fields = _LOWER.unpack_from(data, offset)
+                offset += _LOWER.size
+                meld_lists = []
+                for count in fields[2:]:
+                    melds = []
+                    for n in range(count):
+                        length = ord(data[offset])
+                        codes = struct.unpack_from('%dB' % length, data, offset + 1)
+                        melds.append(tuple(CARDS[code] for code in codes))
+                        offset += 1 + length
+                    meld_lists.append(tuple(melds))
+                yield ('lower', fields[1]) + tuple(meld_lists)
+            elif kind == 'G':
+                kind, code, player, set_kind, index, where = _GIVE.unpack_from(data, offset)
+                offset += _GIVE.size
+                yield ('give', CARDS[code], SetHandle(player, _SET_KINDS[set_kind], index),
+                       _ENDS[where])
+            elif kind == 'D':
+                kind, code, player, played_first_turn = _DROP.unpack_from(data, offset)
+                offset += _DROP.size
+                yield ('drop', CARDS[code], player, bool(played_first_turn))
+            elif kind == 'R':
+                kind, length = _RECYCLE.unpack_from(data, offset)
+                offset += _RECYCLE.size
+                codes = struct.unpack_from('%dB' % (2 * length), data, offset)
+                offset += 2 * length
+                yield ('recycle', tuple(CARDS[code] for code in codes[:length]),
+                       tuple(CARDS[code] for code in codes[length:]))
+            else:
+                raise ReplayError('Unknown record kind %r at offset %d' % (kind, offset))
+    except (struct.error, IndexError, KeyError):
+        raise ReplayError('Truncated or corrupt record at offset %d' % offset)
+
+
+###########
+# Logging #
+###########
+class MoveLog(object):
+    '''Initial position of a round (encoded with codec) and the moves played
+    since. A log read with loads decodes its records as it is iterated, and
+    only keeps them all once its records list is asked for.'''
+
+    def __init__(self, initial, records=(), encoded=None):
+        self.initial = initial
+        self._records = list(records)
+        # Encoded records following _records, not decoded yet
+        self._encoded = encoded
+        self._mark = None
+
+    @property
+    def records(self):
+        'Every record, as a list'
+        if self._encoded is not None:
+            self._records.extend(decode_records(self._encoded))
+            self._encoded = None
+        return self._records
+
+    def __iter__(self):
+        'Generate the records, decoding them on the way'
+        if self._encoded is None:
+            return iter(self._records)
+        return chain(self._records[:], decode_records(self._encoded))
+
+    @classmethod
+    def start(cls, game_round):
+        'Start logging the moves of a round from its current position'
+        log = cls(codec.encode(game_round))
+        log._mark = game_round.checkpoint()
+        return log
+
+    def update(self, game_round):
+        '''Append the moves played on the round since the last update, and
+        return how many records the log has'''
+        if self._mark is None:
+            raise ReplayError('This log was not started on a round')
+        logged = self._mark + len(self.records)
+        if game_round.checkpoint() < logged:
+            raise ReplayError('Logged moves were undone')
+        self.records.extend(game_round.moves_since(logged))
+        return len(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+class LogWriter(object):
+    '''Writes a log to a file as the round goes on: the header when created,
+    and the new records on each flush'''
+
+    def __init__(self, fileobj, game_round):
+        self.file = fileobj
+        self.round = game_round
+        self.log = MoveLog.start(game_round)
+        self.file.write(_HEADER.pack(MAGIC, VERSION, len(self.log.initial)))
+        self.file.write(self.log.initial)
+        self.written = 0
+
+    def flush(self):
+        self.log.update(self.round)
+        new = self.log.records[self.written:]
+        self.file.write(''.join(map(encode_record, new)))
+        self.written += len(new)
+        self.file.flush()
+
+
+def dumps(log):
+    return ''.join([_HEADER.pack(MAGIC, VERSION, len(log.initial)), log.initial] +
+                   map(encode_record, log.records))
+
+def loads(data):
+    try:
+        magic, version, length = _HEADER.unpack_from(data)
+    except struct.error:
+        raise ReplayError('Truncated header')
+    if magic != MAGIC:
+        raise ReplayError('Not a move log')
+    if version != VERSION:
+        raise ReplayError('Unsupported log version %d' % version)
+    start = _HEADER.size
+    initial = memoryview(data)[start:start + length].tobytes()
+    return MoveLog(initial, encoded=memoryview(data)[start + length:])
+
+def load(path):
+    'Read the log stored in a file'
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+##########
+# Replay #
+##########
+def _apply_checked(game_round, record):
+    'Apply a record through the public GameRound methods, which validate it'
+    kind = record[0]
+    if kind in ('well', 'stack'):
+        card = (game_round.take_from_well() if kind == 'well'
+                else game_round.take_from_stack())
+        if card != record[1]:
+            raise ReplayError('Took %r instead of %r' % (card, record[1]))
+    elif kind == 'give':
+        card, handle, where = record[1:]
+        game_round.give_to(card, handle.player, handle, where)
+    elif kind == 'recycle':
+        if game_round.stack or tuple(game_round.well[:-1]) != record[1]:
+            raise ReplayError('The well cannot be recycled as logged')
+        if sorted(record[1]) != sorted(record[2]):
+            raise ReplayError('The recycled stack is not the well')
+        game_round.redo(record)
+    else:
+        player = record[2] if kind == 'drop' else record[1]
+        if player != game_round.player_in_turn:
+            raise ReplayError('Player %d is not in turn' % player)
+        if kind == 'lower':
+            trios, straights, royal_straights = [map(list, melds) for melds in record[2:]]
+            game_round.lower(trios, straights, royal_straights)
+        else:
+            if record[3] != game_round.played_first_turn[player]:
+                raise ReplayError('Player %d has %s played his first turn' % (
+                                  player, 'already' if record[3] else 'not'))
+            game_round.drop_to_well(record[1])
+
+def _play(game_round, record, validate):
+    if not validate:
+        game_round.redo(record)
+        return
+    try:
+        _apply_checked(game_round, record)
+    except (GameRoundException, InvalidMoveException), e:
+        raise ReplayError(str(e))
+
+def iter_positions(log, validate=False):
+    '''Replay the log, generating the round after each move. The same round
+    object is updated and generated each time.'''
+    game_round = codec.decode(log.initial)
+    for record in log:
+        _play(game_round, record, validate)
+        yield game_round
+
+def replay(log, nr_moves=None, validate=False):
+    '''Rebuild the position after the first nr_moves records of the log
+    (all of them by default). Trusted logs are replayed without checking
+    the moves; validate=True plays them through the regular rules.'''
+    game_round = codec.decode(log.initial)
+    for record in islice(log, nr_moves):
+        _play(game_round, record, validate)
+    return game_round
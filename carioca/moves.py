@@ -0,0 +1,84 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Legal moves of the player in turn, as small objects that can be applied.
+
+Each move is a namedtuple with an apply(game_round) method that performs it
+through the regular GameRound methods. legal_moves generates them lazily,
+so a search can stop as soon as it finds what it is looking for:
+
+>>> from carioca import GameRound
+>>> game_round = GameRound(3, 2, 0, 0)
+>>> sorted(legal_moves(game_round))
+[Draw(source='stack'), Draw(source='well')]
+'''
+
+from collections import namedtuple
+
+import solver
+
+
+class Draw(namedtuple('Draw', ['source'])):
+    "Take a card from the 'well' or from the 'stack'"
+    __slots__ = ()
+
+    def apply(self, game_round):
+        if self.source == 'well':
+            return game_round.take_from_well()
+        return game_round.take_from_stack()
+
+
+class Lower(namedtuple('Lower', ['trios', 'straights', 'royal_straights'])):
+    '''Lower the melds required by the round. Melds are kept as tuples, so
+    that moves can be hashed; the lowered sets are lists of a new copy'''
+    __slots__ = ()
+
+    def apply(self, game_round):
+        return game_round.lower(map(list, self.trios), map(list, self.straights),
+                                map(list, self.royal_straights))
+
+
+class Give(namedtuple('Give', ['card', 'handle', 'where'])):
+    "Give a card to the lowered set of Board.sets[handle]"
+    __slots__ = ()
+
+    def apply(self, game_round):
+        return game_round.give_to(self.card, self.handle.player, self.handle, self.where)
+
+
+class Drop(namedtuple('Drop', ['card'])):
+    'Drop a card to the well, ending the turn'
+    __slots__ = ()
+
+    def apply(self, game_round):
+        return game_round.drop_to_well(self.card)
+
+
+def legal_moves(game_round):
+    '''Generate every legal move of the player in turn: the draws before
+    taking a card; afterwards every distinct lowering, then the gives and
+    the drops, one per distinct card'''
+
+    if game_round.is_over():
+        return
+    if not game_round.card_taken:
+        if game_round.well:
+            yield Draw('well')
+        if game_round.can_take_from_stack():
+            yield Draw('stack')
+        return
+
+    player = game_round.player_in_turn
+    hand = game_round.hands[player]
+    if not game_round.did_lower[player] and game_round.played_first_turn[player]:
+        turn_set = (game_round.nr_trios, game_round.nr_straights,
+                    game_round.nr_royal_straights)
+        for partition in solver.iter_lowerings(hand, turn_set):
+            yield Lower(tuple(map(tuple, partition.trios)),
+                        tuple(map(tuple, partition.straights)),
+                        tuple(map(tuple, partition.royal_straights)))
+
+    for card, handle, where in game_round.legal_gives():
+        yield Give(card, handle, where)
+
+    for card in sorted(set(hand)):
+        yield Drop(card)
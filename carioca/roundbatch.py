@@ -0,0 +1,342 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Many rounds of the same kind stepped together with NumPy.
+
+A GameRoundBatch keeps N rounds in arrays instead of N GameRound objects:
+the hands are an (N, players, NR_CODES) tensor of card counts, the stack
+and the well are (N, cards) arrays of card codes with their sizes, and the
+player in turn and the flags of the round are vectors. Each step applies
+at most one move to every round, checking the rules of GameRound for all
+of them at once:
+
+>>> rounds = GameRoundBatch(1000, nr_players=4, nr_trios=2, seed=1)
+>>> valid = rounds.step(np.full(1000, STACK))
+>>> valid.all(), rounds.card_taken.all()
+(True, True)
+
+A step gets the kind of move of each round (PASS to leave it alone) and,
+depending on the kind, the card, the melds to lower (trios, then
+straights, then royal straights, concatenated) or the set to give to.
+Moves that GameRound would refuse leave their round unchanged, and are
+reported as False in the returned vector. Rounds that are over take no
+more moves.
+
+Drawing from an empty stack shuffles the well, but its top card, into the
+stack first, as GameRound.take_from_stack does. The shuffle comes from the
+batch's own NumPy stream (seeded with derive_seed(seed, 'batch')), so a
+batch and GameRounds dealt from the same seed do not draw the same cards.
+
+Lowered sets are numbered per player in the same order as the melds, so
+that set nr_trios + k is GameRound's straight k. Sets can grow up to
+MAX_SET_SIZE cards.
+'''
+
+import numpy as np
+
+from carioca import DECK, CARD_CODES, CODE_VALUES, JOKER_CODE, NR_CODES
+from seeds import derive_seed
+from batch import (PAD, can_give_batch, is_straight_batch, is_trio_batch,
+                   _are_ranks_consecutive, _are_suits_equal, _count_jokers)
+
+# Kinds of moves
+PASS, WELL, STACK, LOWER, GIVE, DROP = range(6)
+# Where a card is given to a straight; trios ignore it
+ANYWHERE, LEFT, RIGHT = range(3)
+
+MAX_SET_SIZE = 16
+
+DECK_CODES = np.array([CARD_CODES[card] for card in DECK], dtype=np.int8)
+
+
+def _numpy_seed(seed):
+    'The 64-bit derive_seed of the batch as two words for RandomState'
+    if seed is None:
+        return None
+    return divmod(derive_seed(seed, 'batch'), 2 ** 32)
+
+
+def _is_royal_straight_batch(codes):
+    # Like carioca.is_royal_straight, which sorts jokers (rank 0) first
+    ranks = np.where(codes == JOKER_CODE, -1, codes % 13)
+    order = ranks.argsort(axis=1, kind='mergesort')
+    codes = codes[np.arange(len(codes))[:, None], order]
+    return (_count_jokers(codes) <= 1) & _are_suits_equal(codes) & \
+           _are_ranks_consecutive(codes)
+
+
+class GameRoundBatch(object):
+
+    def __init__(self, nr_rounds, nr_players,
+                 nr_trios=0, nr_straights=0, nr_royal_straights=0,
+                 first_turn=0, nr_decks=2, seed=None, deal=True, hand_size=12):
+
+        self.nr_rounds = nr_rounds
+        self.nr_players = nr_players
+        self.nr_trios = nr_trios
+        self.nr_straights = nr_straights
+        self.nr_royal_straights = nr_royal_straights
+        self.nr_decks = nr_decks
+        self.hand_size = hand_size
+        self.meld_sizes = [3] * nr_trios + [4] * nr_straights + [13] * nr_royal_straights
+        self.rows = np.arange(nr_rounds)
+
+        nr_cards = nr_decks * len(DECK)
+        self.counts = np.zeros((nr_rounds, nr_players, NR_CODES), dtype=np.int8)
+        self.stack = np.zeros((nr_rounds, nr_cards), dtype=np.int8)
+        self.stack_size = np.zeros(nr_rounds, dtype=np.int16)
+        self.well = np.zeros((nr_rounds, nr_cards), dtype=np.int8)
+        self.well_size = np.zeros(nr_rounds, dtype=np.int16)
+
+        self.player_in_turn = np.full(nr_rounds, first_turn, dtype=np.int8)
+        self.card_taken = np.zeros(nr_rounds, dtype=bool)
+        self.played_first_turn = np.zeros((nr_rounds, nr_players), dtype=bool)
+        self.did_lower = np.zeros((nr_rounds, nr_players), dtype=bool)
+
+        self.sets = np.full((nr_rounds, nr_players, len(self.meld_sizes), MAX_SET_SIZE),
+                            PAD, dtype=np.int8)
+        self.set_sizes = np.zeros((nr_rounds, nr_players, len(self.meld_sizes)), dtype=np.int8)
+
+        # Shuffles the deal and the recycled wells
+        self.rng = np.random.RandomState(_numpy_seed(seed))
+        if deal:
+            if nr_players * hand_size >= nr_cards:
+                raise ValueError('%d decks are not enough to deal %d cards to %d players'
+                                 % (nr_decks, hand_size, nr_players))
+            self._deal(nr_cards)
+
+    def _deal(self, nr_cards):
+        'Shuffle every deck and deal like GameRound, from the end of the stack'
+        order = self.rng.random_sample((self.nr_rounds, nr_cards)).argsort(axis=1)
+        self.stack[:] = np.tile(DECK_CODES, self.nr_decks)[order]
+        dealt = self.hand_size * self.nr_players
+        hands = self.stack[:, nr_cards - dealt:][:, ::-1].reshape(
+                self.nr_rounds, self.nr_players, self.hand_size)
+        self._add_counts(hands)
+        self.well[:, 0] = self.stack[:, nr_cards - dealt - 1]
+        self.well_size[:] = 1
+        self.stack_size[:] = nr_cards - dealt - 1
+
+    def _add_counts(self, hands):
+        'Add (N, players, k) card codes to the hands'
+        index = (self.rows[:, None, None] * self.nr_players +
+                 np.arange(self.nr_players)[None, :, None]) * NR_CODES + hands
+        self.counts += np.bincount(index.ravel(), minlength=self.counts.size).reshape(
+                self.counts.shape).astype(np.int8)
+
+    @classmethod
+    def from_rounds(cls, rounds, seed=None):
+        '''Batch with the state of GameRounds of the same kind in which
+        nobody lowered yet'''
+        first = rounds[0]
+        batch = cls(len(rounds), first.nr_players, first.nr_trios, first.nr_straights,
+                    first.nr_royal_straights, nr_decks=first.nr_decks, seed=seed,
+                    deal=False, hand_size=first.hand_size)
+        for n, game_round in enumerate(rounds):
+            if any(game_round.did_lower):
+                raise ValueError('Rounds with lowered sets cannot be copied')
+            for player, hand in enumerate(game_round.hands):
+                batch.counts[n, player] = hand.counts
+            for cards, array, sizes in ((game_round.stack, batch.stack, batch.stack_size),
+                                        (game_round.well, batch.well, batch.well_size)):
+                array[n, :len(cards)] = [CARD_CODES[card] for card in cards]
+                sizes[n] = len(cards)
+            batch.player_in_turn[n] = game_round.player_in_turn
+            batch.card_taken[n] = game_round.card_taken
+            batch.played_first_turn[n] = game_round.played_first_turn
+        return batch
+
+    def is_over(self):
+        'Rounds in which some hand is empty'
+        return (self.counts.sum(axis=2) == 0).any(axis=1)
+
+    def hands_in_turn(self):
+        'Card counts of the player in turn of every round, (N, NR_CODES)'
+        return self.counts[self.rows, self.player_in_turn]
+
+    def scores(self):
+        'Score left in every hand, (N, players)'
+        return self.counts.astype(np.int32).dot(np.array(CODE_VALUES, dtype=np.int32))
+
+    def can_take_from_stack(self):
+        'Rounds whose stack has cards left, or can get them from the well'
+        return (self.stack_size > 0) | (self.well_size > 1)
+
+    def _active(self, active):
+        if active is None:
+            active = np.ones(self.nr_rounds, dtype=bool)
+        return np.asarray(active, dtype=bool) & ~self.is_over()
+
+    def _holds(self, rows, players, cards):
+        inside = (cards >= 0) & (cards < NR_CODES)
+        codes = np.where(inside, cards, 0)
+        return inside & (self.counts[rows, players, codes] > 0)
+
+    #########
+    # Moves #
+    #########
+    def take_from_well(self, active=None):
+        return self._take(self.well, self.well_size, self._active(active))
+
+    def take_from_stack(self, active=None):
+        active = self._active(active)
+        self.recycle_wells(active & ~self.card_taken & (self.stack_size == 0))
+        return self._take(self.stack, self.stack_size, active)
+
+    def recycle_wells(self, rows):
+        '''Shuffle the wells, but their top cards, into the empty stacks of
+        the given rows, like GameRound.recycle_well'''
+        rows = self.rows[np.asarray(rows, dtype=bool) & (self.stack_size == 0) &
+                         (self.well_size > 1)]
+        if not len(rows):
+            return
+        recycled = self.well_size[rows] - 1
+        # Random keys for the recycled cards, the others sorted last
+        keys = self.rng.random_sample((len(rows), self.well.shape[1]))
+        keys[np.arange(self.well.shape[1])[None, :] >= recycled[:, None]] = 2
+        order = keys.argsort(axis=1)
+        self.stack[rows] = self.well[rows[:, None], order]
+        self.stack_size[rows] = recycled
+        self.well[rows, 0] = self.well[rows, recycled]
+        self.well_size[rows] = 1
+
+    def _take(self, pile, sizes, active):
+        valid = active & ~self.card_taken & (sizes > 0)
+        rows = self.rows[valid]
+        sizes[rows] -= 1
+        cards = pile[rows, sizes[rows]]
+        self.counts[rows, self.player_in_turn[rows], cards] += 1
+        self.card_taken[rows] = True
+        return valid
+
+    def drop_to_well(self, cards, active=None):
+        cards = np.asarray(cards)
+        valid = self._active(active) & self.card_taken & \
+                self._holds(self.rows, self.player_in_turn, cards)
+        rows = self.rows[valid]
+        players = self.player_in_turn[rows]
+        cards = cards[valid]
+        self.counts[rows, players, cards] -= 1
+        self.well[rows, self.well_size[rows]] = cards
+        self.well_size[rows] += 1
+        self.card_taken[rows] = False
+        self.played_first_turn[rows, players] = True
+        self.player_in_turn[rows] = (players + 1) % self.nr_players
+        return valid
+
+    def lower(self, melds, active=None):
+        '''Lower the melds of each row, an (N, k) array of the trios, then
+        the straights, then the royal straights of the round'''
+        melds = np.asarray(melds, dtype=np.int16).reshape(self.nr_rounds, -1)
+        if melds.shape[1] != sum(self.meld_sizes):
+            raise ValueError('Expected %d cards per round' % sum(self.meld_sizes))
+        players = self.player_in_turn
+        valid = self._active(active) & self.card_taken & \
+                self.played_first_turn[self.rows, players] & \
+                ~self.did_lower[self.rows, players] & \
+                ((melds >= 0) & (melds < NR_CODES)).all(axis=1)
+
+        start = 0
+        for size in self.meld_sizes:
+            meld = melds[:, start:start + size]
+            check = {3: is_trio_batch, 4: is_straight_batch, 13: _is_royal_straight_batch}[size]
+            valid &= check(meld)
+            start += size
+
+        codes = np.where(valid[:, None], melds, 0)
+        needed = np.bincount((self.rows[:, None] * NR_CODES + codes).ravel(),
+                             minlength=self.nr_rounds * NR_CODES).reshape(-1, NR_CODES)
+        valid &= (needed <= self.hands_in_turn()).all(axis=1)
+
+        rows = self.rows[valid]
+        players = players[rows]
+        self.counts[rows, players] -= needed[rows].astype(np.int8)
+        start = 0
+        for index, size in enumerate(self.meld_sizes):
+            meld = melds[rows, start:start + size]
+            if size == 13:
+                ranks = np.where(meld == JOKER_CODE, -1, meld % 13)
+                meld = meld[np.arange(len(meld))[:, None], ranks.argsort(axis=1, kind='mergesort')]
+            self.sets[rows, players, index, :size] = meld
+            self.set_sizes[rows, players, index] = size
+            start += size
+        self.did_lower[rows, players] = True
+        return valid
+
+    def give_to(self, cards, players, set_indexes, where=None, active=None):
+        '''Give a card of the player in turn of each row to the set of the
+        given player and index, at the given end (ANYWHERE by default)'''
+        cards, players, set_indexes = map(np.asarray, (cards, players, set_indexes))
+        where = np.full(self.nr_rounds, ANYWHERE) if where is None else np.asarray(where)
+        givable = self.nr_trios + self.nr_straights
+        valid = self._active(active) & self.card_taken & \
+                self.did_lower[self.rows, self.player_in_turn] & \
+                self._holds(self.rows, self.player_in_turn, cards) & \
+                (players >= 0) & (players < self.nr_players) & \
+                (set_indexes >= 0) & (set_indexes < givable)
+        rows = self.rows[valid]
+        targets, indexes = players[rows], set_indexes[rows]
+        valid[rows] &= self.did_lower[rows, targets] & \
+                       (self.set_sizes[rows, targets, indexes] < MAX_SET_SIZE)
+
+        rows = self.rows[valid]
+        targets, indexes, given = players[rows], set_indexes[rows], cards[rows]
+        sets = self.sets[rows, targets, indexes]
+        trio = indexes < self.nr_trios
+        left = can_give_batch(given, sets, 'left') & ~trio & (where[rows] != RIGHT)
+        right = can_give_batch(given, sets, 'right') & ~trio & (where[rows] != LEFT) & ~left
+        fits = (trio & can_give_batch(given, sets, 'trio')) | left | right
+        valid[rows] = fits
+
+        rows, sets, given, targets, indexes, left = (
+                rows[fits], sets[fits], given[fits], targets[fits], indexes[fits], left[fits])
+        sizes = self.set_sizes[rows, targets, indexes]
+        # Appended at the end, or everything shifted one place for the left end
+        shifted = np.concatenate([given[:, None], sets[:, :-1]], axis=1)
+        sets[np.arange(len(rows)), sizes] = given
+        sets = np.where(left[:, None], shifted, sets)
+        self.sets[rows, targets, indexes] = sets
+        self.set_sizes[rows, targets, indexes] += 1
+        self.counts[rows, self.player_in_turn[rows], given] -= 1
+        return valid
+
+    def step(self, kinds, cards=None, melds=None, players=None, set_indexes=None,
+             where=None):
+        '''Apply a move of the given kind to every round; returns which ones
+        were valid (PASS moves count as valid)'''
+        kinds = np.asarray(kinds)
+        valid = kinds == PASS
+        if (kinds == WELL).any():
+            valid |= self.take_from_well(kinds == WELL)
+        if (kinds == STACK).any():
+            valid |= self.take_from_stack(kinds == STACK)
+        if (kinds == LOWER).any():
+            valid |= self.lower(melds, kinds == LOWER)
+        if (kinds == GIVE).any():
+            valid |= self.give_to(cards, players, set_indexes, where, kinds == GIVE)
+        if (kinds == DROP).any():
+            valid |= self.drop_to_well(cards, kinds == DROP)
+        return valid
+
+
+############
+# Policies #
+############
+def random_cards(counts, rng):
+    'One card drawn at random from each row of (N, NR_CODES) counts, or -1'
+    totals = counts.sum(axis=1)
+    picks = (rng.random_sample(len(counts)) * totals).astype(np.int64)
+    cards = (counts.cumsum(axis=1) > picks[:, None]).argmax(axis=1)
+    return np.where(totals > 0, cards, -1)
+
+def random_step(rounds, rng, well_probability=0.5):
+    '''Draw (from the well with the given probability) in the rounds where
+    the player in turn has not drawn yet, and drop a random card in the
+    others; returns the moves made'''
+    kinds = np.where(rounds.card_taken, DROP,
+                     np.where(rng.random_sample(rounds.nr_rounds) < well_probability,
+                              WELL, STACK))
+    kinds[(kinds == STACK) & ~rounds.can_take_from_stack()] = WELL
+    kinds[rounds.is_over()] = PASS
+    cards = random_cards(rounds.hands_in_turn(), rng)
+    rounds.step(kinds, cards)
+    return kinds, cards
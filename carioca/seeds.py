@@ -0,0 +1,31 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Independent random streams split from a single seed.
+
+A stream is named by a root seed and a path of keys, for example
+(seed, 'game', 41, 'player', 2). Its seed is a hash of the whole path, so
+streams with different paths are unrelated to each other (unlike seeds
+such as seed + i, which overlap from one run to the next), and any of
+them can be built again on its own, in any process and in any order:
+
+>>> stream(7, 'game', 41).random() == stream(7, 'game', 41).random()
+True
+>>> derive_seed(7, 'game', 41) == derive_seed(7, 'game', 42)
+False
+
+Derived seeds can be split further, derive_seed(derive_seed(7, 'game', 41),
+'player', 2) being the seed of a stream under the one of game 41.
+'''
+
+import hashlib
+import random
+
+
+def derive_seed(seed, *keys):
+    'The 64-bit seed of the stream named by keys under seed'
+    path = u'\0'.join(unicode(key) for key in (seed,) + keys)
+    return int(hashlib.sha256(path.encode('utf-8')).hexdigest()[:16], 16)
+
+def stream(seed, *keys):
+    'A random.Random for the stream named by keys under seed'
+    return random.Random(derive_seed(seed, *keys))
@@ -0,0 +1,388 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Multi-table game server speaking line-delimited JSON.
+
+All tables run in a single asyncore event loop (polling, so that thousands
+of connections are fine), which also plays the turns that time out.
+Nothing is locked, so tables and connections must only be driven from the
+thread of serve_forever; shutdown() is the one call safe from other
+threads. Each connection sits at one seat of one table:
+
+    -> {"op": "join", "table": "t1", "players": 2}
+    <- {"type": "joined", "table": "t1", "seat": 0}
+    <- {"type": "turn", "player": 0, "round": 1, ...}      (to everybody)
+    -> {"op": "move", "move": "stack"}
+    <- {"type": "result", "hand": ["2♥", ...], "in_turn": true}
+    <- {"type": "move", "player": 0, "move": {"move": "stack"}}  (to the others)
+
+Moves are "well", "stack", "drop" (with a "card"), "lower" (with "trios",
+"straights" and "royal_straights", lists of lists of cards) and "give" (with
+"card", "player", "kind" of set, its "index" and optionally "where"). Cards
+are written as card_repr writes them. {"op": "state"} returns what the seat
+can see. Errors are answered with {"type": "error", "error": ...}.
+
+A player that does not finish his turn within the turn timeout gets it
+played for him: he draws from the stack and drops his highest card. When
+the stack runs out the well, but its top card, is shuffled back into it;
+if there is nothing left to recycle the round ends, scoring the hands as
+they are. A client that stops reading its messages is not read from
+either (so it cannot queue more work) until its pending output drains,
+and is disconnected if the output keeps growing.
+
+    $ python server.py --port 7788 --timeout 30
+
+With --seed, every table deals from its own random stream, named after the
+table (see seeds.py), so that its games can be replayed.
+'''
+
+import asynchat
+import asyncore
+import heapq
+import json
+import socket
+import time
+
+from carioca import (CariocaGame, GameRoundException, InvalidMoveException, SetHandle,
+                     C, card_repr, value)
+import seeds
+import moves
+
+# Pending output of a connection above which it is not read from, and
+# above which it is dropped
+HIGH_WATER = 64 * 1024
+MAX_PENDING = 1024 * 1024
+MAX_LINE = 64 * 1024
+
+class ProtocolError(ValueError): pass
+
+
+def _cards(reprs):
+    return [C(r) for r in reprs]
+
+def _reprs(cards):
+    return [card_repr(card) for card in cards]
+
+def parse_move(message):
+    'moves object for a move message'
+    kind = message.get('move')
+    try:
+        if kind in ('well', 'stack'):
+            return moves.Draw(kind)
+        if kind == 'drop':
+            return moves.Drop(C(message['card']))
+        if kind == 'lower':
+            return moves.Lower(*[tuple(tuple(_cards(meld)) for meld in message.get(name, ()))
+                                 for name in ('trios', 'straights', 'royal_straights')])
+        if kind == 'give':
+            handle = SetHandle(int(message['player']), message['kind'], int(message['index']))
+            return moves.Give(C(message['card']), handle, message.get('where'))
+    except (KeyError, TypeError, ValueError), e:
+        raise ProtocolError('Invalid %s move: %s' % (kind, e))
+    raise ProtocolError('Unknown move %r' % kind)
+
+def describe_move(move):
+    'Message describing a move, the inverse of parse_move'
+    if isinstance(move, moves.Draw):
+        return {'move': move.source}
+    if isinstance(move, moves.Drop):
+        return {'move': 'drop', 'card': card_repr(move.card)}
+    if isinstance(move, moves.Lower):
+        return {'move': 'lower', 'trios': map(_reprs, move.trios),
+                'straights': map(_reprs, move.straights),
+                'royal_straights': map(_reprs, move.royal_straights)}
+    return {'move': 'give', 'card': card_repr(move.card), 'player': move.handle.player,
+            'kind': move.handle.kind, 'index': move.handle.index, 'where': move.where}
+
+
+##########
+# Tables #
+##########
+class Table(object):
+    'A CariocaGame and the connections seated at it'
+
+    def __init__(self, server, name, nr_players, nr_decks=2, rng=None):
+        self.server = server
+        self.name = name
+        self.nr_players = nr_players
+        self.game = CariocaGame(nr_players, nr_decks, rng=rng)
+        self.round = None
+        self.round_nr = 0
+        self.totals = [0] * nr_players
+        self.seats = [None] * nr_players
+        self.turn_serial = 0
+
+    def sit(self, connection):
+        if None not in self.seats:
+            raise ProtocolError('Table %s is full' % self.name)
+        seat = self.seats.index(None)
+        self.seats[seat] = connection
+        return seat
+
+    def start_if_full(self):
+        if None not in self.seats and self.round is None and not self.game.is_over():
+            self._next_round()
+
+    def leave(self, connection):
+        for seat, seated in enumerate(self.seats):
+            if seated is connection:
+                self.seats[seat] = None
+
+    def broadcast(self, message, exclude=None):
+        for connection in self.seats:
+            if connection is not None and connection is not exclude:
+                connection.send_message(message)
+
+    def view(self, seat):
+        'What the player at the seat can see'
+        game_round = self.round
+        if game_round is None:
+            return {'type': 'state', 'table': self.name, 'started': False}
+        return {'type': 'state', 'table': self.name, 'started': True,
+                'round': self.round_nr, 'player_in_turn': game_round.player_in_turn,
+                'card_taken': game_round.card_taken,
+                'hand': _reprs(game_round.hands[seat]),
+                'hand_sizes': [hand.size for hand in game_round.hands],
+                'well': _reprs(game_round.well[-1:]), 'stack_size': len(game_round.stack),
+                'lowered': [{'player': handle.player, 'kind': handle.kind,
+                             'index': handle.index, 'cards': _reprs(cards)}
+                            for handle, cards in sorted(game_round.board.sets.items())],
+                'totals': self.totals}
+
+    def play(self, seat, move):
+        '''Apply a move of the player at the seat, and answer him with his
+        hand before anything that follows the move (a new turn or round)'''
+        game_round = self.round
+        if game_round is None:
+            raise InvalidMoveException('The game has not started')
+        if game_round.player_in_turn != seat:
+            raise InvalidMoveException('Player %d is not in turn' % seat)
+        move.apply(game_round)
+        result = {'type': 'result', 'hand': _reprs(game_round.hands[seat]),
+                  'in_turn': game_round.player_in_turn == seat}
+        if self.seats[seat] is not None:
+            self.seats[seat].send_message(result)
+        self.broadcast({'type': 'move', 'table': self.name, 'player': seat,
+                        'move': describe_move(move)}, exclude=self.seats[seat])
+        self._after_move(seat)
+
+    def _after_move(self, seat):
+        game_round = self.round
+        if game_round.is_over():
+            game_round.calculate_scores()
+            self._end_round(game_round.scores)
+        elif game_round.player_in_turn != seat:
+            if game_round.can_take_from_stack():
+                self._start_turn()
+            else:
+                # Nobody can draw any more, the round ends as it is
+                self._end_round([hand.score for hand in game_round.hands])
+
+    def _end_round(self, scores):
+        self.totals = [total + score for total, score in zip(self.totals, scores)]
+        self.broadcast({'type': 'round_over', 'table': self.name,
+                        'round': self.round_nr, 'scores': scores, 'totals': self.totals})
+        if self.game.is_over():
+            self.round = None
+            self.broadcast({'type': 'game_over', 'table': self.name, 'totals': self.totals})
+            self.server.close_table(self)
+        else:
+            self._next_round()
+
+    def _next_round(self):
+        self.round = self.game.go_to_next_round()
+        self.round_nr += 1
+        self._start_turn()
+
+    def _start_turn(self):
+        self.turn_serial += 1
+        self.server.schedule_timeout(self)
+        game_round = self.round
+        self.broadcast({'type': 'turn', 'table': self.name, 'round': self.round_nr,
+                        'player': game_round.player_in_turn,
+                        'well': _reprs(game_round.well[-1:]),
+                        'stack_size': len(game_round.stack)})
+
+    def time_out(self):
+        'Play the rest of the turn of the player in turn'
+        game_round = self.round
+        seat = game_round.player_in_turn
+        if not game_round.card_taken:
+            game_round.take_from_stack()
+        game_round.drop_to_well(max(game_round.hands[seat], key=value))
+        self.broadcast({'type': 'timeout', 'table': self.name, 'player': seat})
+        self._after_move(seat)
+
+
+###############
+# Connections #
+###############
+class Connection(asynchat.async_chat):
+    'A client, sitting at most at one table'
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.set_terminator('\n')
+        self.buffer = []
+        self.buffered = 0
+        self.pending = 0
+        self.table = None
+        self.seat = None
+
+    # Backpressure: count the bytes waiting to be sent
+    def push(self, data):
+        self.pending += len(data)
+        asynchat.async_chat.push(self, data)
+
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        self.pending -= sent
+        return sent
+
+    def readable(self):
+        return self.pending < HIGH_WATER
+
+    def send_message(self, message):
+        if self.pending > MAX_PENDING:
+            self.server.stats['dropped'] += 1
+            self.handle_close()
+            return
+        self.push(json.dumps(message) + '\n')
+
+    def collect_incoming_data(self, data):
+        self.buffered += len(data)
+        if self.buffered > MAX_LINE:
+            self.handle_close()
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if not line.strip():
+            return
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ProtocolError('Messages must be objects')
+            self.handle_message(message)
+        except (ValueError, KeyError, TypeError, GameRoundException,
+                InvalidMoveException), e:
+            self.server.stats['errors'] += 1
+            self.send_message({'type': 'error', 'error': unicode(e)})
+
+    def handle_message(self, message):
+        op = message.get('op')
+        if op == 'join':
+            if self.table is not None:
+                raise ProtocolError('Already sitting at table %s' % self.table.name)
+            table = self.server.get_table(unicode(message['table']),
+                                          int(message.get('players', 2)))
+            self.seat = table.sit(self)
+            self.table = table
+            self.send_message({'type': 'joined', 'table': table.name, 'seat': self.seat})
+            table.start_if_full()
+        elif op == 'state':
+            if self.table is None:
+                raise ProtocolError('Not sitting at any table')
+            self.send_message(self.table.view(self.seat))
+        elif op == 'move':
+            if self.table is None:
+                raise ProtocolError('Not sitting at any table')
+            self.table.play(self.seat, parse_move(message))
+            self.server.stats['moves'] += 1
+        else:
+            raise ProtocolError('Unknown op %r' % op)
+
+    def handle_close(self):
+        if self.table is not None:
+            self.table.leave(self)
+            self.table = None
+        self.close()
+
+
+##########
+# Server #
+##########
+class Server(asyncore.dispatcher):
+    'Accepts connections and runs the tables, see serve_forever'
+
+    def __init__(self, host='127.0.0.1', port=0, turn_timeout=30.0, nr_decks=2,
+                 seed=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+        self.address = self.socket.getsockname()
+        self.turn_timeout = turn_timeout
+        self.nr_decks = nr_decks
+        self.seed = seed
+        self.tables = {}
+        self.timeouts = []
+        # Set before serve_forever starts, so that a shutdown() called
+        # before it does is not lost
+        self.running = True
+        self.stats = {'moves': 0, 'errors': 0, 'timeouts': 0, 'dropped': 0}
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(self, pair[0])
+
+    def get_table(self, name, nr_players):
+        table = self.tables.get(name)
+        if table is None:
+            if not 2 <= nr_players <= 8:
+                raise ProtocolError('Tables have 2 to 8 players')
+            rng = None if self.seed is None else seeds.stream(self.seed, 'table', name)
+            table = self.tables[name] = Table(self, name, nr_players, self.nr_decks, rng)
+        return table
+
+    def close_table(self, table):
+        self.tables.pop(table.name, None)
+
+    def schedule_timeout(self, table):
+        if self.turn_timeout:
+            heapq.heappush(self.timeouts, (time.time() + self.turn_timeout,
+                                           id(table), table.turn_serial, table))
+
+    def check_timeouts(self):
+        now = time.time()
+        while self.timeouts and self.timeouts[0][0] <= now:
+            deadline, key, serial, table = heapq.heappop(self.timeouts)
+            # Turns that already ended have a newer serial
+            if serial == table.turn_serial and table.round is not None:
+                self.stats['timeouts'] += 1
+                table.time_out()
+
+    def serve_forever(self, poll_interval=0.05):
+        while self.running:
+            asyncore.loop(timeout=poll_interval, use_poll=True, map=self.map, count=1)
+            self.check_timeouts()
+        for dispatcher in self.map.values():
+            dispatcher.close()
+
+    def shutdown(self):
+        self.running = False
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('-p', '--port', type='int', default=7788)
+    parser.add_option('-t', '--timeout', type='float', default=30.0)
+    parser.add_option('-s', '--seed', type='int', default=None,
+                      help='deal the cards of each table from a stream of this seed')
+    options, args = parser.parse_args()
+
+    server = Server(options.host, options.port, options.timeout, seed=options.seed)
+    print 'Serving on %s:%d' % server.address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,280 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Headless self-play of complete carioca games.
+
+Players are driven by policies: objects that decide, for the player in
+turn, where to draw from, whether and how to lower, which cards to give
+and which card to drop. A game goes through the 9 rounds of CariocaGame,
+and many games can be spread over a pool of processes:
+
+    $ python simulation.py --games 1000 --players 4 --processes 4
+
+Every game draws from its own random streams (see seeds.py), split from
+the seed of the run by game number: the results are the same whatever the
+number of processes, and any game can be replayed alone with play_game.
+'''
+
+import random
+import time
+
+from carioca import CariocaGame, TURN_SETS, get_score, value
+import seeds
+import solver
+
+
+############
+# Policies #
+############
+class Policy(object):
+    '''Decisions of one player. The simulation calls, on each turn:
+
+    draw    -> 'well' or 'stack'
+    lower   -> a solver.Partition to lower, or None
+    give    -> (card, player, lowered_set, where) for give_to, or None;
+               called again after each give
+    discard -> the card to drop to the well
+    '''
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def draw(self, game_round):
+        raise NotImplementedError
+
+    def lower(self, game_round):
+        return None
+
+    def give(self, game_round):
+        return None
+
+    def discard(self, game_round):
+        raise NotImplementedError
+
+
+class RandomPolicy(Policy):
+    'Draws and drops at random, lowering as soon as the hand allows it'
+
+    def draw(self, game_round):
+        return self.rng.choice(('well', 'stack'))
+
+    def lower(self, game_round):
+        return _lowering(game_round)
+
+    def give(self, game_round):
+        return _first_give(game_round)
+
+    def discard(self, game_round):
+        return self.rng.choice(game_round.hands[game_round.player_in_turn].cards())
+
+
+class GreedyPolicy(Policy):
+    '''Takes the well card when it brings the hand closer to lowering,
+    lowers as soon as possible, gives every card it can, and drops the
+    highest card that is not part of the best partition of the hand'''
+
+    def draw(self, game_round):
+        player = game_round.player_in_turn
+        if game_round.did_lower[player] or not game_round.well:
+            return 'stack'
+        turn_set = _turn_set(game_round)
+        hand = game_round.hands[player].cards()
+        with_well = hand + [game_round.peek_well_card()]
+        if solver.missing_cards(with_well, turn_set) < solver.missing_cards(hand, turn_set):
+            return 'well'
+        return 'stack'
+
+    def lower(self, game_round):
+        return _lowering(game_round)
+
+    def give(self, game_round):
+        return _first_give(game_round)
+
+    def discard(self, game_round):
+        hand = game_round.hands[game_round.player_in_turn].cards()
+        keep = []
+        if not game_round.did_lower[game_round.player_in_turn]:
+            partition = solver.solve(hand, _turn_set(game_round))
+            keep = [card for melds in partition[1:4] for cards in melds for card in cards]
+        spare = list(hand)
+        for card in keep:
+            spare.remove(card)
+        return max(spare or hand, key=value)
+
+def _turn_set(game_round):
+    return (game_round.nr_trios, game_round.nr_straights,
+            game_round.nr_royal_straights)
+
+def _lowering(game_round):
+    player = game_round.player_in_turn
+    if game_round.did_lower[player] or not game_round.played_first_turn[player]:
+        return None
+    hand, turn_set = game_round.hands[player], _turn_set(game_round)
+    if not solver.can_lower(hand, turn_set):
+        return None
+    return solver.solve(hand, turn_set)
+
+def _first_give(game_round):
+    'First card of the player in turn that fits a lowered set'
+    for card, handle, where in game_round.legal_gives():
+        return card, handle.player, handle, where
+    return None
+
+
+##############
+# Simulation #
+##############
+class Stats(object):
+    'Aggregated results of several games, which can be merged together'
+
+    def __init__(self, nr_players):
+        self.games = 0
+        self.rounds = 0
+        self.blocked_rounds = 0
+        self.turns = 0
+        self.wins = [0] * nr_players
+        self.scores = [0] * nr_players
+        self.elapsed = 0.0
+
+    def add_game(self, scores, rounds, blocked_rounds, turns):
+        self.games += 1
+        self.rounds += rounds
+        self.blocked_rounds += blocked_rounds
+        self.turns += turns
+        self.wins[scores.index(min(scores))] += 1
+        for player, score in enumerate(scores):
+            self.scores[player] += score
+
+    def merge(self, other):
+        self.games += other.games
+        self.rounds += other.rounds
+        self.blocked_rounds += other.blocked_rounds
+        self.turns += other.turns
+        self.wins = [a + b for a, b in zip(self.wins, other.wins)]
+        self.scores = [a + b for a, b in zip(self.scores, other.scores)]
+        return self
+
+    def games_per_second(self):
+        return self.games / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<Stats %d games, %d rounds (%d blocked), wins %s, %.1f games/s>' % (
+                self.games, self.rounds, self.blocked_rounds, self.wins,
+                self.games_per_second())
+
+
+def play_round(game_round, policies, max_turns=1000):
+    '''Play a round until a player runs out of cards. Returns the number of
+    turns played and whether the round got blocked (nothing left to draw
+    from the stack, even recycling the well, or too many turns) before
+    anybody finished'''
+
+    turns = 0
+    while not game_round.is_over():
+        if turns >= max_turns or not game_round.can_take_from_stack():
+            return turns, True
+        policy = policies[game_round.player_in_turn]
+        player = game_round.player_in_turn
+
+        if game_round.well and policy.draw(game_round) == 'well':
+            game_round.take_from_well()
+        else:
+            game_round.take_from_stack()
+
+        partition = policy.lower(game_round)
+        if partition is not None:
+            game_round.lower(trios=partition.trios, straights=partition.straights,
+                             royal_straights=partition.royal_straights)
+
+        if game_round.did_lower[player]:
+            give = policy.give(game_round)
+            while give is not None and game_round.hands[player]:
+                game_round.give_to(*give)
+                give = policy.give(game_round)
+
+        if game_round.hands[player]:
+            game_round.drop_to_well(policy.discard(game_round))
+        turns += 1
+    return turns, False
+
+def play_game(policies, seed, nr_decks=2, max_turns=1000, lazy=False):
+    '''Play the 9 rounds of a game. Returns the total score of every player,
+    the number of blocked rounds and the number of turns played. The cards
+    are dealt from the 'deck' stream of seed. With lazy, rounds only shuffle
+    the cards they draw (see carioca.LazyStack).'''
+
+    game = CariocaGame(len(policies), nr_decks, lazy, seeds.stream(seed, 'deck'))
+    totals = [0] * len(policies)
+    blocked_rounds = turns = 0
+    while not game.is_over():
+        game_round = game.go_to_next_round()
+        round_turns, blocked = play_round(game_round, policies, max_turns)
+        turns += round_turns
+        blocked_rounds += blocked
+        for player, hand in enumerate(game_round.hands):
+            totals[player] += get_score(hand)
+    return totals, blocked_rounds, turns
+
+def game_seed(seed, number):
+    'Seed of game number (from 0) of a simulation run with seed'
+    return seeds.derive_seed(seed, 'game', number)
+
+def _run_games(args):
+    policy_classes, run_seed, first_game, nr_games, nr_decks, lazy = args
+    stats = Stats(len(policy_classes))
+    for number in xrange(first_game, first_game + nr_games):
+        seed = game_seed(run_seed, number)
+        policies = [cls(seeds.derive_seed(seed, 'player', n))
+                    for n, cls in enumerate(policy_classes)]
+        scores, blocked, turns = play_game(policies, seed, nr_decks, lazy=lazy)
+        stats.add_game(scores, len(TURN_SETS), blocked, turns)
+    return stats
+
+def simulate(nr_games, policy_classes, nr_decks=2, processes=None,
+             seed=0, chunk_size=10, lazy=False):
+    '''Play nr_games games with one player per policy class, spreading them
+    over a pool of processes (or in this process, if processes is 1).
+    Game i is played with game_seed(seed, i), whichever process runs it,
+    and its player n with a policy seeded with derive_seed(that seed,
+    'player', n).'''
+
+    tasks = [(policy_classes, seed, first, min(chunk_size, nr_games - first), nr_decks, lazy)
+             for first in xrange(0, nr_games, chunk_size)]
+    stats = Stats(len(policy_classes))
+    start = time.time()
+    if processes == 1:
+        results = map(_run_games, tasks)
+    else:
+        # Imported here, workers that play games alone do not need it
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            results = pool.imap_unordered(_run_games, tasks)
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    for partial in results:
+        stats.merge(partial)
+    stats.elapsed = time.time() - start
+    return stats
+
+
+POLICIES = {'random': RandomPolicy, 'greedy': GreedyPolicy}
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('-g', '--games', type='int', default=100)
+    parser.add_option('-p', '--players', type='int', default=4)
+    parser.add_option('-d', '--decks', type='int', default=2)
+    parser.add_option('-j', '--processes', type='int', default=None)
+    parser.add_option('-s', '--seed', type='int', default=0)
+    parser.add_option('--policy', choices=POLICIES.keys(), default='greedy')
+    parser.add_option('--lazy', action='store_true', default=False,
+                      help='shuffle only the cards that get drawn')
+    options, args = parser.parse_args()
+
+    stats = simulate(options.games, [POLICIES[options.policy]] * options.players,
+                     options.decks, options.processes, options.seed, lazy=options.lazy)
+    print stats
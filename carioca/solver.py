@@ -0,0 +1,671 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab:
+
+u'''Hand-partition solver for the round requirements.
+
+Given a hand and an entry of TURN_SETS, find the melds that let the hand
+lower while leaving the lowest score in hand, or, when that is not
+possible, the fewest cards that are still missing to lower.
+
+>>> p = solve(Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ J♥ J♦  10♦ Q♠ A♣'), (2,1,0))
+>>> p.missing, p.residue
+(0, 40)
+>>> missing_cards(Cs(u'5♣ 6♣ 8♣  2♥ 2♠  J♦ Q♠ A♣'), (2,1,0))
+4
+
+The search works on card counts: royal straights and straights are chosen
+first over the windows of four ranks of each suit that touch the hand,
+then trios over the remaining count of each rank. Results of subproblems
+are memoized, so repeated card counts are only explored once, and so are
+the results of the last SOLVED_SIZE hands solved. Windows that touch the
+same cards of the hand are searched once, and the last trio is picked by
+a plain loop over the ranks.
+
+This is pure Python: a hand of 12 cards takes from about 0.1 ms (trios
+only) to 2-3 ms (1 trio and 2 straights) the first time it is solved,
+and microseconds when it is solved again.
+
+useful_cards runs the same search once with an extra card of any code,
+instead of solving the hand once for each card that could be added, and
+follows only the best partitions of the hand, since a card more can only
+shorten those.
+'''
+
+from collections import namedtuple
+from itertools import combinations_with_replacement
+from operator import itemgetter
+
+from carioca import (Hand, JOKER_CODE, NR_CODES, CARDS, CARD_CODES, CODE_VALUES,
+                     Cs)
+
+class Partition(namedtuple('Partition',
+                           'missing trios straights royal_straights residue')):
+    '''Result of solve().
+
+    missing is the number of cards still needed to lower, and residue the
+    score of the cards that would stay in hand. When missing is not zero,
+    each meld only lists the cards that the hand already has for it.
+    '''
+    __slots__ = ()
+
+VALUE_OF = CODE_VALUES
+RANK_VALUES = VALUE_OF[:13]
+JOKER_VALUE = VALUE_OF[JOKER_CODE]
+
+# Windows of four consecutive ranks (with wrap-around) for every suit
+WINDOWS = tuple(tuple(suit * 13 + (start + n) % 13 for n in range(4))
+                for suit in range(4) for start in range(13))
+
+def _better(a, b):
+    'Fewer missing cards first, then more value taken out of the hand'
+    return b is None or a[0] < b[0] or (a[0] == b[0] and a[1] > b[1])
+
+def _no_codes(naturals):
+    return ()
+
+def _rank_totals(naturals):
+    return tuple(sum(naturals[rank::13]) for rank in range(13))
+
+
+class _Search(object):
+
+    def __init__(self, counts, turn_set, complete=False):
+        '''With complete set, only melds that need no more cards are tried:
+        much faster, and enough to find the best partition when the hand
+        can lower'''
+        self.nr_trios, self.nr_straights, self.nr_royal_straights = turn_set
+        self.complete = complete
+        self.jokers = counts[JOKER_CODE]
+        self.naturals = tuple(counts[:JOKER_CODE])
+        needed = 4 - min(self.jokers, 1) if complete else 1
+        # Windows that touch the same cards of the hand offer the same
+        # straights, so only the last one is searched (the one that the
+        # search would keep among equal ones); window_codes has the codes
+        # of all of them, for the cards a straight could lack
+        touched = {}
+        for index, window in enumerate(WINDOWS if self.nr_straights else ()):
+            present = tuple(code for code in window if self.naturals[code])
+            if len(present) >= needed:
+                touched.setdefault(present, []).append((index, window))
+        groups = sorted(touched.itervalues(), key=lambda group: group[-1][0])
+        self.windows = [group[-1][1] for group in groups]
+        self.window_codes = [frozenset(code for index, window in group for code in window)
+                             for group in groups]
+        # Counts of the codes that the windows from each index onwards can
+        # still take
+        pending = set()
+        self.pending = [_no_codes]
+        for window in reversed(self.windows):
+            pending.update(window)
+            self.pending.append(itemgetter(*sorted(pending)))
+        self.pending.reverse()
+        self.trio_memo = {}
+        self.straight_memo = {}
+        self.royal_memo = {}
+
+    def run(self):
+        return self.royal_straights(0, self.nr_royal_straights,
+                                    self.naturals, self.jokers)
+
+    # Every step returns (missing, value, plan), where plan is a linked list
+    # of (kind, meld) pairs describing the chosen melds.
+
+    def royal_straights(self, suit, left, naturals, jokers):
+        if left == 0:
+            return self.straights(0, self.nr_straights, naturals,
+                                  _rank_totals(naturals), jokers)
+
+        key = (suit, left, naturals, jokers)
+        if key in self.royal_memo:
+            return self.royal_memo[key]
+
+        if suit == 4:
+            # Royal straights made of a joker and missing cards only
+            best = None
+            for used in range(min(jokers, left) + 1):
+                missing, val, plan = self.straights(0, self.nr_straights, naturals,
+                                                    _rank_totals(naturals), jokers - used)
+                for n in range(left):
+                    plan = (('R', (None, (), n < used)), plan)
+                cand = (missing + 13 * left - used, val + JOKER_VALUE * used, plan)
+                if _better(cand, best):
+                    best = cand
+            self.royal_memo[key] = best
+            return best
+
+        best = self.royal_straights(suit + 1, left, naturals, jokers)
+        codes = range(suit * 13, suit * 13 + 13)
+        present = [code for code in codes if naturals[code]]
+        if present:
+            # A joker can only stand for the ace or the king (see
+            # carioca.is_royal_straight, which sorts jokers first)
+            options = [(present, False)]
+            if jokers:
+                for end in (codes[0], codes[-1]):
+                    options.append(([code for code in present if code != end], True))
+            for used, joker in options:
+                if self.complete and len(used) + joker < 13:
+                    continue
+                rest = list(naturals)
+                for code in used:
+                    rest[code] -= 1
+                missing, val, plan = self.royal_straights(suit, left - 1,
+                                                          tuple(rest), jokers - joker)
+                cand = (missing + 13 - len(used) - joker,
+                        val + sum(VALUE_OF[code] for code in used) + JOKER_VALUE * joker,
+                        (('R', (None, used, joker)), plan))
+                if _better(cand, best):
+                    best = cand
+        self.royal_memo[key] = best
+        return best
+
+    def straights(self, i, left, naturals, totals, jokers):
+        if left == 0:
+            return self.trios(0, self.nr_trios, totals, jokers)
+
+        # Only the cards that later windows can take matter, plus the rank
+        # totals when trios will be formed from what is left
+        key = (i, left, jokers, self.pending[i](naturals),
+               self.nr_trios and totals)
+        if key in self.straight_memo:
+            return self.straight_memo[key]
+
+        if i == len(self.windows):
+            # Straights made of a joker and missing cards only
+            best = None
+            for used in range(min(jokers, left) + 1):
+                missing, val, plan = self.trios(0, self.nr_trios, totals, jokers - used)
+                for n in range(left):
+                    plan = (('S', (None, (), n < used)), plan)
+                cand = (missing + 4 * left - used, val + JOKER_VALUE * used, plan)
+                if _better(cand, best):
+                    best = cand
+        else:
+            best = self.straights(i + 1, left, naturals, totals, jokers)
+            window = self.windows[i]
+            # Giving a card to one meld instead of another never lowers the
+            # number of missing cards, so a straight takes every card of its
+            # window that is still available. A joker either fills a gap or
+            # stands for one of the cards, which is then left for trios.
+            available = [code for code in window if naturals[code]]
+            options = [(available, False)]
+            if jokers:
+                if len(available) < 4:
+                    options.append((available, True))
+                else:
+                    options.extend(([c for c in available if c != code], True)
+                                   for code in available)
+            for used, joker in options:
+                if not used or (self.complete and len(used) + joker < 4):
+                    continue
+                rest, rest_totals = list(naturals), list(totals)
+                for code in used:
+                    rest[code] -= 1
+                    rest_totals[code % 13] -= 1
+                missing, val, plan = self.straights(i, left - 1, tuple(rest),
+                                                    tuple(rest_totals), jokers - joker)
+                cand = (missing + 4 - len(used) - joker,
+                        val + sum(VALUE_OF[code] for code in used) + JOKER_VALUE * joker,
+                        (('S', (window, used, joker)), plan))
+                if _better(cand, best):
+                    best = cand
+
+        self.straight_memo[key] = best
+        return best
+
+    def trios(self, rank, left, totals, jokers):
+        if left == 0:
+            return (0, 0, None)
+        while rank < 13 and not totals[rank]:
+            rank += 1
+
+        key = (rank, left, totals[rank:], jokers)
+        if key in self.trio_memo:
+            return self.trio_memo[key]
+
+        if rank == 13:
+            # Trios made of a joker and missing cards only
+            used = min(jokers, left)
+            plan = None
+            for n in range(left):
+                plan = (('T', (None, 0, n < used)), plan)
+            best = (3 * left - used, JOKER_VALUE * used, plan)
+        elif left == 1:
+            best = self._last_trio(rank, totals, jokers)
+        else:
+            best = self.trios(rank + 1, left, totals, jokers)
+            available = totals[rank]
+            if available:
+                # Taking as many cards of the rank as possible is always
+                # best, since all of them are worth the same
+                for joker in ((False, True) if jokers else (False,)):
+                    used = min(3 - joker, available)
+                    if self.complete and used + joker < 3:
+                        continue
+                    rest = list(totals)
+                    rest[rank] -= used
+                    missing, val, plan = self.trios(rank, left - 1, tuple(rest),
+                                                    jokers - joker)
+                    cand = (missing + 3 - used - joker,
+                            val + RANK_VALUES[rank] * used + JOKER_VALUE * joker,
+                            (('T', (rank, used, joker)), plan))
+                    if _better(cand, best):
+                        best = cand
+
+        self.trio_memo[key] = best
+        return best
+
+    def _last_trio(self, first, totals, jokers):
+        '''trios() for a single trio, as a loop over the ranks from the
+        highest down, which keeps the same best of equal candidates'''
+        joker_options = (False, True) if jokers else (False,)
+        used = min(jokers, 1)
+        best = (3 - used, JOKER_VALUE * used, (('T', (None, 0, used == 1)), None))
+        for rank in range(12, first - 1, -1):
+            available = totals[rank]
+            if not available:
+                continue
+            for joker in joker_options:
+                used = min(3 - joker, available)
+                if self.complete and used + joker < 3:
+                    continue
+                cand = (3 - used - joker, RANK_VALUES[rank] * used + JOKER_VALUE * joker,
+                        (('T', (rank, used, joker)), None))
+                if _better(cand, best):
+                    best = cand
+        return best
+
+
+def _counts(hand):
+    if isinstance(hand, Hand):
+        return hand.counts
+    counts = [0] * NR_CODES
+    for card in hand:
+        counts[CARD_CODES[card]] += 1
+    return counts
+
+def _build_partition(missing, plan, counts):
+    'Turn a plan into lists of cards, taking them out of counts'
+    melds = {'T': [], 'S': [], 'R': []}
+    trios = []
+    while plan is not None:
+        (kind, meld), plan = plan
+        if kind == 'T':
+            # Suits are chosen once straights took their cards
+            trios.append(meld)
+            continue
+        window, used, joker = meld
+        cards = []
+        for code in (window or used):
+            if code in used:
+                cards.append(CARDS[code])
+                counts[code] -= 1
+            elif joker:
+                cards.append(CARDS[JOKER_CODE])
+                counts[JOKER_CODE] -= 1
+                joker = False
+        if joker:
+            # Royal straights: the joker stands for the ace or the king,
+            # and is sorted first when validating
+            cards.insert(0, CARDS[JOKER_CODE])
+            counts[JOKER_CODE] -= 1
+        melds[kind].append(cards)
+
+    for rank, used, joker in trios:
+        cards = []
+        if rank is not None:
+            for code in range(rank, JOKER_CODE, 13):
+                while counts[code] and len(cards) < used:
+                    cards.append(CARDS[code])
+                    counts[code] -= 1
+        if joker:
+            cards.append(CARDS[JOKER_CODE])
+            counts[JOKER_CODE] -= 1
+        melds['T'].append(cards)
+
+    residue = sum(VALUE_OF[code] * n for code, n in enumerate(counts))
+    return Partition(missing, melds['T'], melds['S'], melds['R'], residue)
+
+
+# Best (missing, value, plan) of the hands solved lately, by card counts
+# and requirement: players and trackers ask about the same hands again
+_SOLVED = {}
+SOLVED_SIZE = 4096
+
+def _run(counts, turn_set, search=None):
+    '''Best partition of the counts, with the given _Search of them when the
+    hand cannot lower (so that its memo can be used again)'''
+    key = (tuple(counts), tuple(turn_set))
+    result = _SOLVED.get(key)
+    if result is None:
+        result = _Search(counts, turn_set, complete=True).run()
+        if result[0]:
+            result = (search or _Search(counts, turn_set)).run()
+        if len(_SOLVED) >= SOLVED_SIZE:
+            _SOLVED.clear()
+        _SOLVED[key] = result
+    return result
+
+def solve(hand, turn_set):
+    '''Best partition of a hand (a Hand or a list of cards) for the given
+    (nr_trios, nr_straights, nr_royal_straights) requirement'''
+    counts = _counts(hand)
+    missing, val, plan = _run(counts, turn_set)
+    return _build_partition(missing, plan, list(counts))
+
+def missing_cards(hand, turn_set):
+    'Number of cards still needed before the hand can lower'
+    return _missing(_counts(hand), turn_set)
+
+def _missing(counts, turn_set):
+    return _run(counts, turn_set)[0]
+
+def can_lower(hand, turn_set):
+    return _Search(_counts(hand), turn_set, complete=True).run()[0] == 0
+
+
+def _complete_melds(kind, key, counts):
+    '''Complete melds, as tuples of codes in a valid order, of the given
+    royal straight suit, straight window or trio rank'''
+    def available(codes):
+        needed = {}
+        for code in codes:
+            needed[code] = needed.get(code, 0) + 1
+        return all(counts[code] >= n for code, n in needed.iteritems())
+
+    if kind == 'T':
+        suits = [key + 13 * suit for suit in range(4)]
+        melds = [codes for codes in combinations_with_replacement(suits, 3)]
+        melds += [codes + (JOKER_CODE,) for codes in combinations_with_replacement(suits, 2)]
+    else:
+        if kind == 'S':
+            codes = WINDOWS[key]
+            positions = range(4)
+        else:
+            codes = tuple(range(13 * key, 13 * key + 13))
+            # see carioca.is_royal_straight
+            positions = (0, 12)
+        melds = [codes] + [codes[:n] + (JOKER_CODE,) + codes[n + 1:] for n in positions]
+    return [meld for meld in melds if available(meld)]
+
+def iter_lowerings(hand, turn_set):
+    '''Generate every distinct way of lowering the hand for the requirement,
+    as Partitions with no missing cards'''
+    counts = list(_counts(hand))
+    nr_trios, nr_straights, nr_royal_straights = turn_set
+    slots = ['R'] * nr_royal_straights + ['S'] * nr_straights + ['T'] * nr_trios
+    keys = {'R': range(4), 'S': range(len(WINDOWS)), 'T': range(13)}
+    chosen = []
+
+    def search(slot, lowest):
+        if slot == len(slots):
+            melds = {'T': [], 'S': [], 'R': []}
+            for kind, key, meld in chosen:
+                melds[kind].append([CARDS[code] for code in meld])
+            residue = sum(VALUE_OF[code] * n for code, n in enumerate(counts))
+            yield Partition(0, melds['T'], melds['S'], melds['R'], residue)
+            return
+        kind = slots[slot]
+        if slot and slots[slot - 1] != kind:
+            lowest = None
+        # Melds of a kind are generated in increasing order, so that each
+        # combination shows up once
+        for key in keys[kind]:
+            if lowest is not None and key < lowest[0]:
+                continue
+            for meld in _complete_melds(kind, key, counts):
+                if lowest is not None and (key, meld) < lowest:
+                    continue
+                for code in meld:
+                    counts[code] -= 1
+                chosen.append((kind, key, meld))
+                for partition in search(slot + 1, (key, meld)):
+                    yield partition
+                chosen.pop()
+                for code in meld:
+                    counts[code] += 1
+
+    return search(0, None)
+
+
+NATURALS = frozenset(range(JOKER_CODE))
+NO_CODES = frozenset()
+
+class _GapSearch(_Search):
+    '''Search of the partitions of the hand plus one natural card, the
+    "free" card, which must go to a meld.
+
+    A card more lowers the number of missing cards by one at most, and a
+    partition that places the free card leaves one card less to get than
+    the same partition without it. So the free card can only help in the
+    best partitions of the hand, and only make new best ones out of those
+    that miss one card more. Every step gets the slack allowed over the
+    best that _Search finds from there, follows only the options of
+    _Search that stay within it, and returns (codes, taken): the codes the
+    free card can be in those partitions, and the codes that they take
+    from the hand (JOKER_CODE for jokers).
+    '''
+
+    def __init__(self, counts, turn_set):
+        _Search.__init__(self, counts, turn_set)
+        self.trio_gap_memo = {}
+        self.straight_gap_memo = {}
+
+    def gaps(self, naturals, jokers, slack=0):
+        '''(codes, taken) of the partitions of the given cards, which must be
+        in the windows of the hand searched, that miss at most slack cards
+        more than the best ones'''
+        return self.royal_gaps(0, self.nr_royal_straights, naturals, jokers, slack)
+
+    def useful_codes(self, naturals, jokers, missing):
+        '''Codes that leave less than missing cards to get when added to the
+        given cards, which must be in the windows of the hand searched and
+        miss that many cards'''
+        if not missing:
+            return []
+        codes = list(self.gaps(naturals, jokers)[0])
+        if not jokers and not self.nr_royal_straights:
+            # No meld has a joker yet, so a joker can fill the gap of any
+            codes.append(JOKER_CODE)
+        elif self.royal_straights(0, self.nr_royal_straights, naturals,
+                                  jokers + 1)[0] < missing:
+            # Otherwise just try it
+            codes.append(JOKER_CODE)
+        return codes
+
+    def royal_gaps(self, suit, left, naturals, jokers, slack):
+        if left == 0:
+            return self.straight_gaps(0, self.nr_straights, naturals,
+                                      _rank_totals(naturals), jokers, slack)
+
+        budget = self.royal_straights(suit, left, naturals, jokers)[0] + slack
+        codes, taken = set(), set()
+        if suit == 4:
+            totals = _rank_totals(naturals)
+            for used in range(min(jokers, left) + 1):
+                missing = 13 * left - used
+                rest = self.straights(0, self.nr_straights, naturals, totals, jokers - used)
+                if missing + rest[0] > budget:
+                    continue
+                found = self.straight_gaps(0, self.nr_straights, naturals, totals,
+                                           jokers - used, budget - missing - rest[0])
+                codes.update(NATURALS)
+                taken.update(found[1])
+                if used:
+                    taken.add(JOKER_CODE)
+            return frozenset(codes), frozenset(taken)
+
+        after = self.royal_straights(suit + 1, left, naturals, jokers)[0]
+        if after <= budget:
+            found = self.royal_gaps(suit + 1, left, naturals, jokers, budget - after)
+            codes.update(found[0])
+            taken.update(found[1])
+        suit_codes = range(suit * 13, suit * 13 + 13)
+        present = [code for code in suit_codes if naturals[code]]
+        if not present:
+            return frozenset(codes), frozenset(taken)
+
+        lacking = frozenset(code for code in suit_codes if not naturals[code])
+        options = [(present, False, None)]
+        if jokers:
+            for end in (suit_codes[0], suit_codes[-1]):
+                options.append(([code for code in present if code != end], True, end))
+        for used, joker, end in options:
+            rest = list(naturals)
+            for code in used:
+                rest[code] -= 1
+            rest = tuple(rest)
+            missing = 13 - len(used) - joker
+            after = self.royal_straights(suit, left - 1, rest, jokers - joker)[0]
+            if missing + after > budget:
+                continue
+            found = self.royal_gaps(suit, left - 1, rest, jokers - joker,
+                                    budget - missing - after)
+            codes.update(found[0])
+            taken.update(found[1])
+            taken.update(used)
+            if joker:
+                taken.add(JOKER_CODE)
+            if missing:
+                # The free card goes to this royal straight, as any card the
+                # suit lacks but the end the joker stands for
+                codes.update(lacking - frozenset((end,)))
+        return frozenset(codes), frozenset(taken)
+
+    def straight_gaps(self, i, left, naturals, totals, jokers, slack):
+        if left == 0:
+            return self.trio_gaps(0, self.nr_trios, totals, jokers, slack)
+
+        key = (i, left, jokers, self.pending[i](naturals),
+               self.nr_trios and totals, slack)
+        if key in self.straight_gap_memo:
+            return self.straight_gap_memo[key]
+
+        budget = self.straights(i, left, naturals, totals, jokers)[0] + slack
+        codes, taken = set(), set()
+        if i == len(self.windows):
+            for used in range(min(jokers, left) + 1):
+                missing = 4 * left - used
+                rest = self.trios(0, self.nr_trios, totals, jokers - used)
+                if missing + rest[0] > budget:
+                    continue
+                found = self.trio_gaps(0, self.nr_trios, totals, jokers - used,
+                                       budget - missing - rest[0])
+                codes.update(NATURALS)
+                taken.update(found[1])
+                if used:
+                    taken.add(JOKER_CODE)
+        else:
+            after = self.straights(i + 1, left, naturals, totals, jokers)[0]
+            if after <= budget:
+                found = self.straight_gaps(i + 1, left, naturals, totals, jokers,
+                                           budget - after)
+                codes.update(found[0])
+                taken.update(found[1])
+            window = self.windows[i]
+            available = [code for code in window if naturals[code]]
+            options = [(available, False)]
+            if jokers:
+                if len(available) < 4:
+                    options.append((available, True))
+                else:
+                    options.extend(([c for c in available if c != code], True)
+                                   for code in available)
+            lacking = frozenset(code for code in self.window_codes[i] if not naturals[code])
+            if jokers and len(available) == 3:
+                # With the free card the window is full, so the joker can
+                # also stand for one of its cards, which is left for trios
+                options.extend(([c for c in available if c != code], True)
+                               for code in available)
+            for used, joker in options:
+                if not used:
+                    continue
+                rest, rest_totals = self._take(used, naturals, totals)
+                missing = 4 - len(used) - joker
+                after = self.straights(i, left - 1, rest, rest_totals, jokers - joker)[0]
+                if missing + after > budget:
+                    continue
+                found = self.straight_gaps(i, left - 1, rest, rest_totals,
+                                           jokers - joker, budget - missing - after)
+                codes.update(found[0])
+                taken.update(found[1])
+                taken.update(used)
+                if joker:
+                    taken.add(JOKER_CODE)
+                if missing:
+                    # The free card goes to this straight, as any card one
+                    # of the windows lacks
+                    codes.update(lacking)
+
+        found = (frozenset(codes), frozenset(taken))
+        self.straight_gap_memo[key] = found
+        return found
+
+    @staticmethod
+    def _take(used, naturals, totals):
+        rest, rest_totals = list(naturals), list(totals)
+        for code in used:
+            rest[code] -= 1
+            rest_totals[code % 13] -= 1
+        return tuple(rest), tuple(rest_totals)
+
+    def trio_gaps(self, rank, left, totals, jokers, slack):
+        if left == 0:
+            return NO_CODES, NO_CODES
+
+        key = (rank, left, totals[rank:], jokers, slack)
+        if key in self.trio_gap_memo:
+            return self.trio_gap_memo[key]
+
+        codes, taken = set(), set()
+        if rank == 13:
+            # The free card makes a trio with jokers and missing cards only
+            codes.update(NATURALS)
+            if jokers:
+                taken.add(JOKER_CODE)
+        else:
+            budget = self.trios(rank, left, totals, jokers)[0] + slack
+            after = self.trios(rank + 1, left, totals, jokers)[0]
+            if after <= budget:
+                found = self.trio_gaps(rank + 1, left, totals, jokers, budget - after)
+                codes.update(found[0])
+                taken.update(found[1])
+            available = totals[rank]
+            rank_codes = range(rank, JOKER_CODE, 13)
+            for joker in ((False, True) if jokers else (False,)):
+                used = min(3 - joker, available)
+                rest = list(totals)
+                rest[rank] -= used
+                rest = tuple(rest)
+                missing = 3 - used - joker
+                after = self.trios(rank, left - 1, rest, jokers - joker)[0]
+                if missing + after > budget:
+                    continue
+                found = self.trio_gaps(rank, left - 1, rest, jokers - joker,
+                                       budget - missing - after)
+                codes.update(found[0])
+                taken.update(found[1])
+                if used:
+                    taken.update(rank_codes)
+                if joker:
+                    taken.add(JOKER_CODE)
+                if missing:
+                    codes.update(rank_codes)
+
+        found = (frozenset(codes), frozenset(taken))
+        self.trio_gap_memo[key] = found
+        return found
+
+
+def useful_cards(hand, turn_set):
+    '''Cards that lower by one the number of missing cards of the hand
+    (see missing_cards) when added to it, as a frozenset'''
+    return _useful_cards(_counts(hand), turn_set)
+
+def _useful_cards(counts, turn_set, missing=None):
+    search = _GapSearch(counts, turn_set)
+    if missing is None:
+        # The gap search only looks into the best partitions, which solving
+        # the hand with the same search already found
+        missing = _run(counts, turn_set, search)[0]
+    codes = search.useful_codes(search.naturals, search.jokers, missing)
+    return frozenset(CARDS[code] for code in codes)
@@ -1,8 +1,42 @@
 # vim: set fileencoding=utf-8 tabstop=4 expandtab:
 
 from carioca import *
+import intcards
+import melds
+import solver
+import analysis
+import moves
+import ismcts
+import codec
+import movelog
+import analytics
+import server
+import loadgen
+import benchmarks
+import instrumentation
+import carioca
+import json
+import socket
+import threading
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+import simulation
+import seeds
+import random
 import unittest
 
+try:
+    import numpy
+    import batch
+    import roundbatch
+except ImportError:
+    numpy = None
+
 class Trios(unittest.TestCase):
     # valid trios
     def test_trio_different_suits(self):
@@ -242,6 +276,20 @@ class ConstructorAndRepr(unittest.TestCase):
     def test_invertability(self):
         self.assertEqual(self.deck, [C(card_repr(card)) for card in self.deck])
 
+    def test_shared_instances(self):
+        for card in self.deck:
+            self.assertTrue(C(card_repr(card)) is card)
+        self.assertTrue(C(u'jkr') is C(u'JOKER') is C(u' Joker ') is self.deck[-1])
+        for spelling in (u'10♦', u'T♦', u'D♦', u't♦', u'd♦', u' 10♦', u'010♦'):
+            self.assertTrue(C(spelling) is C(u'10♦'))
+        self.assertTrue(C(u'a♠') is C(u'1♠') is C(u'A♠'))
+        self.assertTrue(all(a is b for a, b in zip(2 * create_deck(), create_deck() * 2)))
+        hand = Cs(u'A♠  k♥\t10♣ jkr\n Q♦')
+        self.assertEqual(hand, [C(u'A♠'), C(u'K♥'), C(u'10♣'), C(u'jkr'), C(u'Q♦')])
+        self.assertRaises(InvalidSuit, Cs, u'A♠ AX')
+        self.assertRaises(InvalidRank, C, u'14♠')
+        self.assertRaises(InvalidRank, C, u' ')
+
 
 class Decks(unittest.TestCase):
     def setUp(self):
@@ -260,6 +308,450 @@ class Decks(unittest.TestCase):
         self.assertEqual(len(suits), 4)
 
 
+class LazyDealing(unittest.TestCase):
+    def test_every_order_equally_likely(self):
+        rng = random.Random(7)
+        orders = {}
+        for n in range(6000):
+            stack = LazyStack('abc', rng)
+            order = stack.pop() + stack.pop() + stack.pop()
+            orders[order] = orders.get(order, 0) + 1
+        self.assertEqual(len(orders), 6)
+        for count in orders.values():
+            self.assertTrue(900 < count < 1100, orders)
+
+    def test_shuffles_only_what_is_read(self):
+        stack = LazyStack(2 * DECK, random.Random(1))
+        hand = stack.take(12)
+        self.assertEqual(len(hand), 12)
+        self.assertEqual(stack._hidden, 108 - 12)
+        card = stack[-1]
+        self.assertEqual(stack._hidden, 108 - 13)
+        self.assertEqual(stack.pop(), card)
+        self.assertEqual(sorted(hand + [card] + list(stack)), sorted(2 * DECK))
+
+    def test_behaves_like_a_list(self):
+        stack = LazyStack(DECK, random.Random(2))
+        stack.append(C(u'jkr'))
+        self.assertEqual(len(stack), 55)
+        self.assertEqual(stack[-1], C(u'jkr'))
+        self.assertEqual(stack.pop(), C(u'jkr'))
+        cards = stack[:]
+        self.assertEqual(sorted(cards), sorted(DECK))
+        stack[:] = cards[:3]
+        self.assertEqual(list(stack), cards[:3])
+
+    def test_lazy_round(self):
+        random.seed(3)
+        game_round = GameRound(4, 1, 1, 0, lazy=True)
+        self.assertEqual([len(hand) for hand in game_round.hands], [12] * 4)
+        self.assertEqual(len(game_round.well), 1)
+        self.assertEqual(len(game_round.stack), 108 - 49)
+        dealt = [card for hand in game_round.hands for card in hand]
+        self.assertEqual(sorted(dealt + game_round.well + game_round.stack[:]),
+                         sorted(2 * DECK))
+        random.seed(3)
+        again = GameRound(4, 1, 1, 0, lazy=True)
+        self.assertEqual(map(list, again.hands), map(list, game_round.hands))
+
+    def test_pickle(self):
+        stack = LazyStack(DECK, random.Random(4))
+        stack.take(5)
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(stack, protocol))
+            self.assertEqual(copy._hidden, stack._hidden)
+            self.assertEqual(copy._cards, stack._cards)
+        self.assertEqual(len(pickle.loads(pickle.dumps(GameRound(2, 1, 0, 0, lazy=True))).stack),
+                         108 - 25)
+
+    def test_lazy_game(self):
+        def play():
+            policies = [simulation.RandomPolicy(n) for n in range(3)]
+            return simulation.play_game(policies, seed=5, lazy=True)
+        self.assertEqual(play(), play())
+
+
+class IntegerEncoding(unittest.TestCase):
+    def test_codes_roundtrip(self):
+        for card in create_deck():
+            self.assertEqual(decode_card(encode_card(card)), card)
+        self.assertEqual(encode_card(C(u'jkr')), JOKER_CODE)
+        self.assertEqual(len(set(map(encode_card, create_deck()))), NR_CODES)
+
+    def test_constructors_and_repr(self):
+        self.assertEqual(intcards.Cs(u'A♠ jkr'), encode_cards(Cs(u'A♠ jkr')))
+        self.assertEqual(map(intcards.card_repr, intcards.create_deck()),
+                         map(card_repr, create_deck()))
+        self.assertEqual(intcards.get_score(intcards.Cs(u'A♥ 3♣ Q♥ jkr jkr 8♦ J♠')), 111)
+
+    def test_predicates_match_card_predicates(self):
+        rng = random.Random(0)
+        deck = create_deck()
+        for _ in range(2000):
+            # Draw from a narrow window so that valid melds are frequent
+            suit = rng.choice(SUITS)
+            pool = [Card(rank, suit) for rank in rng.sample(RANKS, 5)]
+            pool += [Card(pool[0].rank, s) for s in SUITS] + [Card(JOKER, None)]
+            for size in (3, 4):
+                cards = [rng.choice(pool) for _ in range(size)]
+                codes = encode_cards(cards)
+                self.assertEqual(intcards.is_trio(codes), is_trio(cards))
+                self.assertEqual(intcards.is_straight(codes), is_straight(cards))
+            card = rng.choice(deck)
+            code = encode_card(card)
+            self.assertEqual(intcards.can_give_to_straight_at_left(code, codes),
+                             can_give_to_straight_at_left(card, cards))
+            self.assertEqual(intcards.can_give_to_straight_at_right(code, codes),
+                             can_give_to_straight_at_right(card, cards))
+            self.assertEqual(intcards.is_card_subset(codes[:2], codes[1:]),
+                             is_card_subset(cards[:2], cards[1:]))
+
+    def test_royal_straight(self):
+        self.assertTrue(intcards.is_royal_straight(intcards.Cs(u'K♣ A♣ Q♣ 3♣ 4♣ 5♣ 6♣ 7♣ 8♣ 9♣ 10♣ J♣ 2♣')))
+        self.assertFalse(intcards.is_royal_straight(intcards.Cs(u'A♥ 2♥ 3♥ 4♥ 5♥ 6♥ 7♥ 8♥ 9♥ 10♥ J♥ Q♥ K♣')))
+
+
+class HandMultiset(unittest.TestCase):
+    def setUp(self):
+        self.hand = Hand(Cs(u'A♠ 5♦ Q♣ A♠ 10♥ jkr'))
+
+    def test_membership_and_counts(self):
+        self.assertEqual(len(self.hand), 6)
+        self.assertTrue(C(u'A♠') in self.hand)
+        self.assertFalse(C(u'A♥') in self.hand)
+        self.assertEqual(self.hand.count(C(u'A♠')), 2)
+        self.assertEqual(self.hand.count(C(u'jkr')), 1)
+
+    def test_add_and_remove(self):
+        self.hand.add(C(u'A♥'))
+        self.hand.remove(C(u'A♠'))
+        self.assertEqual(len(self.hand), 6)
+        self.assertEqual(self.hand.count(C(u'A♠')), 1)
+        self.assertTrue(C(u'A♥') in self.hand)
+        self.assertRaises(ValueError, self.hand.remove, C(u'2♣'))
+
+    def test_subset(self):
+        self.assertTrue(self.hand.contains_all(Cs(u'10♥ A♠ A♠')))
+        self.assertFalse(self.hand.contains_all(Cs(u'jkr jkr')))
+
+    def test_list_view(self):
+        self.assertEqual(sorted(self.hand), sorted(Cs(u'A♠ 5♦ Q♣ A♠ 10♥ jkr')))
+        self.assertEqual(self.hand[-1], C(u'jkr'))
+
+    def test_index(self):
+        self.assertEqual(self.hand.score, get_score(Cs(u'A♠ 5♦ Q♣ A♠ 10♥ jkr')))
+        self.assertEqual(self.hand.rank_counts[A], 2)
+        self.assertEqual(self.hand.rank_counts[JOKER], 1)
+        self.assertEqual(self.hand.count_of(A, SPADES), 2)
+        self.hand.remove(C(u'A♠'))
+        self.hand.add(C(u'7♥'))
+        self.assertEqual(self.hand.score, get_score(self.hand.cards()))
+        self.assertEqual(self.hand.rank_counts[A], 1)
+        self.assertEqual(self.hand.count_of(7, HEARTS), 1)
+
+    def test_pickle(self):
+        g = GameRound(3, 1, 1, 0)
+        g.take_from_stack()
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(g, protocol))
+            self.assertEqual(round_state(copy), round_state(g))
+            hand = copy.hands[0]
+            self.assertEqual((hand.size, hand.score, hand.rank_counts),
+                             (g.hands[0].size, g.hands[0].score, g.hands[0].rank_counts))
+            hand.add(C(u'jkr'))
+            self.assertEqual(hand.count(C(u'jkr')), g.hands[0].count(C(u'jkr')) + 1)
+
+    def test_game_round_wraps_lists(self):
+        g = GameRound(nr_players=2)
+        g.hands = [Cs(u'2♥ 3♥'), Cs(u'jkr')]
+        self.assertTrue(isinstance(g.hands[0], Hand))
+        self.assertTrue(C(u'3♥') in g.hands[0])
+
+
+class MeldTables(unittest.TestCase):
+    def test_tables_match_reference(self):
+        rng = random.Random(1)
+        codes = range(NR_CODES)
+        for _ in range(5000):
+            trio = [rng.choice(codes) for _ in range(3)]
+            straight = [rng.choice(codes) for _ in range(4)]
+            self.assertEqual(melds.is_trio(trio), intcards.is_trio(trio))
+            self.assertEqual(melds.is_straight(straight), intcards.is_straight(straight))
+        for trio in melds.TRIOS:
+            self.assertTrue(intcards.is_trio(list(trio)))
+        self.assertEqual(len(melds.STRAIGHTS), 4 * 13 * 5)
+
+    def test_extensions_match_reference(self):
+        for straight in map(list, melds.STRAIGHTS):
+            for code in range(NR_CODES):
+                self.assertEqual(melds.can_give_to_straight_at_left(code, straight),
+                                 intcards.can_give_to_straight_at_left(code, straight))
+                self.assertEqual(melds.can_give_to_straight_at_right(code, straight),
+                                 intcards.can_give_to_straight_at_right(code, straight))
+
+    def test_extensions_of_longer_straights(self):
+        straight = intcards.Cs(u'jkr 5♣ 6♣ 7♣ 8♣ 9♣ 10♣')
+        self.assertEqual(melds.left_extensions(straight), frozenset([intcards.C(u'3♣')]))
+        self.assertEqual(melds.right_extensions(straight),
+                         frozenset(intcards.Cs(u'J♣ jkr')))
+
+    def test_trio_extensions(self):
+        self.assertTrue(melds.can_give_to_trio(intcards.C(u'4♠'), intcards.Cs(u'jkr 4♦ 4♥')))
+        self.assertTrue(melds.can_give_to_trio(intcards.C(u'jkr'), intcards.Cs(u'jkr 4♦ 4♥')))
+        self.assertFalse(melds.can_give_to_trio(intcards.C(u'5♦'), intcards.Cs(u'jkr 4♦ 4♥')))
+
+
+class Solver(unittest.TestCase):
+    def assertLowers(self, hand, turn_set, residue):
+        p = solver.solve(Cs(hand), turn_set)
+        self.assertEqual(p.missing, 0)
+        self.assertEqual(p.residue, residue)
+        self.assertEqual(len(p.trios), turn_set[0])
+        self.assertEqual(len(p.straights), turn_set[1])
+        self.assertTrue(all(is_trio(cards) for cards in p.trios))
+        self.assertTrue(all(is_straight(cards) for cards in p.straights))
+        self.assertTrue(all(is_royal_straight(cards) for cards in p.royal_straights))
+        lowered = [card for melds in p[1:4] for cards in melds for card in cards]
+        self.assertTrue(is_card_subset(lowered, Cs(hand)))
+
+    def test_lowering_partitions(self):
+        self.assertLowers(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ J♥ J♦  10♦ Q♠ A♣', (2,1,0), 40)
+        self.assertLowers(u'K♥ A♥ 2♥ 3♥  3♠ 4♠ 5♠ 6♠  9♦', (0,2,0), 9)
+        self.assertLowers(u'A♥ 2♥ 3♥ 4♥ 5♥ 6♥ 7♥ 8♥ 9♥ 10♥ J♥ Q♥ jkr 4♣', (0,0,1), 4)
+
+    def test_joker_goes_where_it_leaves_less_score(self):
+        # Putting the joker in the straight instead of 3♦ lets the third
+        # ace complete the trio
+        self.assertLowers(u'A♠ A♥ jkr  3♦ 4♦ 5♦ 6♦  A♦', (1,1,0), 3)
+
+    def test_shared_cards(self):
+        # 7♣ is needed by both the straight and the trio
+        self.assertEqual(solver.missing_cards(Cs(u'5♣ 6♣ 7♣ 8♣ 7♥ 7♠'), (1,1,0)), 1)
+        self.assertLowers(u'5♣ 6♣ 7♣ 8♣ 7♥ 7♠ 7♦', (1,1,0), 0)
+
+    def test_missing_cards(self):
+        self.assertEqual(solver.missing_cards(Cs(u''), (2,1,0)), 10)
+        self.assertEqual(solver.missing_cards(Cs(u'jkr'), (2,1,0)), 9)
+        self.assertEqual(solver.missing_cards(Cs(u'4♣ 4♦ 9♠ 10♠ Q♠'), (1,1,0)), 2)
+        self.assertTrue(solver.can_lower(Cs(u'2♥ 2♠ jkr jkr'), (1,0,0)))
+        self.assertFalse(solver.can_lower(Cs(u'2♥ jkr jkr'), (1,0,0)))
+
+    def test_accepts_hands(self):
+        self.assertEqual(solver.solve(Hand(Cs(u'Q♠ Q♥ Q♥ 3♦')), (1,0,0)).residue, 3)
+
+    def test_remembers_solved_hands(self):
+        hand = Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ J♥ J♦  10♦ Q♠ A♣')
+        p = solver.solve(hand, (2,1,0))
+        self.assertTrue((tuple(solver._counts(hand)), (2,1,0)) in solver._SOLVED)
+        p.trios[0].pop()
+        self.assertEqual(solver.solve(Hand(hand), [2,1,0]), solver.solve(list(hand), (2,1,0)))
+        self.assertEqual(len(solver.solve(hand, (2,1,0)).trios[0]), 3)
+
+    def test_useful_cards(self):
+        self.assertEqual(solver.useful_cards(Cs(u'4♣ 4♦ 9♠ 10♠ Q♠'), (1,1,0)),
+                         frozenset(Cs(u'4♥ 4♠ 4♣ 4♦ J♠ jkr')))
+        self.assertEqual(solver.useful_cards(Cs(u'2♥ 2♠ jkr'), (1,0,0)), frozenset())
+        # Adding any other card never shortens the distance
+        rng = random.Random(11)
+        deck = 2 * create_deck()
+        for turn_set in ((2,0,0), (1,1,0), (0,2,0), (0,0,1), (1,2,0)):
+            for n in range(6):
+                # Half of the hands with a joker, that some meld may already use
+                hand = rng.sample(deck, 9) + [JOKER_CARD] * (n % 2)
+                missing = solver.missing_cards(hand, turn_set)
+                self.assertEqual(solver.useful_cards(hand, turn_set),
+                                 frozenset(card for card in set(deck)
+                                           if solver.missing_cards(hand + [card], turn_set) < missing))
+
+    def test_iter_lowerings(self):
+        lowerings = list(solver.iter_lowerings(Cs(u'7♠ 7♥ 7♦ 7♣ jkr 2♦'), (1,0,0)))
+        # 4 trios of naturals, 6 with the joker
+        self.assertEqual(len(lowerings), 10)
+        self.assertEqual(len(set(tuple(map(tuple, p.trios)) for p in lowerings)), 10)
+        # the best one keeps a 7 and the joker out of the trio
+        self.assertEqual(min(p.residue for p in lowerings), 2 + 7 + 7)
+        self.assertEqual(list(solver.iter_lowerings(Cs(u'7♠ 7♥ 2♦'), (1,0,0))), [])
+
+    def test_iter_lowerings_finds_the_solution(self):
+        hand = Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ J♥ J♦  10♦ Q♠ A♣')
+        lowerings = list(solver.iter_lowerings(hand, (2,1,0)))
+        self.assertEqual(len(lowerings), 1)
+        self.assertEqual(lowerings[0].residue, solver.solve(hand, (2,1,0)).residue)
+        royal = Cs(u'A♥ 2♥ 3♥ 4♥ 5♥ 6♥ 7♥ 8♥ 9♥ 10♥ J♥ Q♥ K♥ jkr')
+        # all naturals, or the joker instead of the ace or the king
+        self.assertEqual(len(list(solver.iter_lowerings(royal, (0,0,1)))), 3)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class BatchValidation(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(2)
+        pool = range(NR_CODES)
+        self.rows = {}
+        for size in (3, 4):
+            rows = []
+            for _ in range(3000):
+                # Mostly windows of a suit or cards of a rank with some
+                # noise, so that a fair share of the rows are valid melds
+                suit, rank = rng.randrange(4), rng.randrange(13)
+                if size == 4:
+                    row = [suit * 13 + (rank + n) % 13 for n in range(4)]
+                else:
+                    row = [rng.randrange(4) * 13 + rank for n in range(3)]
+                for _ in range(rng.randrange(3)):
+                    row[rng.randrange(size)] = rng.choice([JOKER_CODE, rng.choice(pool)])
+                rows.append(row)
+            self.rows[size] = rows
+
+    def test_trios_and_straights(self):
+        for size in (3, 4):
+            rows = self.rows[size]
+            self.assertEqual(list(batch.is_trio_batch(rows)), map(intcards.is_trio, rows))
+            self.assertEqual(list(batch.is_straight_batch(rows)), map(intcards.is_straight, rows))
+
+    def test_can_give(self):
+        rows = [row for row in self.rows[4] if intcards.is_straight(row)]
+        rows += [row for row in self.rows[3] if intcards.is_trio(row)]
+        cards = [(n * 7) % NR_CODES for n in range(len(rows))]
+        sets = [row + [batch.PAD] * (4 - len(row)) for row in rows]
+        for where, fn in (('trio', intcards.can_give_to_trio),
+                          ('left', intcards.can_give_to_straight_at_left),
+                          ('right', intcards.can_give_to_straight_at_right)):
+            self.assertEqual(list(batch.can_give_batch(cards, sets, where)),
+                             [fn(card, row) for card, row in zip(cards, rows)])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class RoundBatches(unittest.TestCase):
+
+    def random_move(self, g, rng):
+        'A legal move most of the time, or some move that may be refused'
+        if rng.random() < 0.8:
+            legal = list(g.legal_moves())
+            special = [move for move in legal if not isinstance(move, (moves.Draw, moves.Drop))]
+            return rng.choice(special or legal)
+        card = rng.choice(CARDS)
+        handle = SetHandle(rng.randrange(g.nr_players), rng.choice(['trio', 'straight']), 0)
+        return rng.choice([moves.Draw('well'), moves.Draw('stack'), moves.Drop(card),
+                           moves.Give(card, handle, rng.choice([None, 'left', 'right']))])
+
+    def batch_move(self, g, move):
+        'Arguments of GameRoundBatch.step for a move'
+        kind, card, melds, player, index, where = roundbatch.PASS, 0, None, 0, 0, 0
+        if isinstance(move, moves.Draw):
+            kind = roundbatch.WELL if move.source == 'well' else roundbatch.STACK
+        elif isinstance(move, moves.Drop):
+            kind, card = roundbatch.DROP, CARD_CODES[move.card]
+        elif isinstance(move, moves.Give):
+            kind, card, player = roundbatch.GIVE, CARD_CODES[move.card], move.handle.player
+            index = move.handle.index + (g.nr_trios if move.handle.kind == 'straight' else 0)
+            where = {None: roundbatch.ANYWHERE, 'trio': roundbatch.ANYWHERE, 'left': roundbatch.LEFT,
+                     'right': roundbatch.RIGHT}[move.where]
+        elif isinstance(move, moves.Lower):
+            kind = roundbatch.LOWER
+            melds = [CARD_CODES[c] for meld in move.trios + move.straights + move.royal_straights
+                                   for c in meld]
+        return kind, card, melds, player, index, where
+
+    def assertSameState(self, rounds, n, g):
+        for player, hand in enumerate(g.hands):
+            self.assertEqual(list(rounds.counts[n, player]), hand.counts)
+        self.assertEqual(list(rounds.well[n, :rounds.well_size[n]]),
+                         [CARD_CODES[card] for card in g.well])
+        self.assertEqual(rounds.stack_size[n], len(g.stack))
+        self.assertEqual(rounds.player_in_turn[n], g.player_in_turn)
+        self.assertEqual(rounds.card_taken[n], g.card_taken)
+        self.assertEqual(list(rounds.did_lower[n]), g.did_lower)
+        for handle, cards in g.board.sets.items():
+            index = handle.index + (g.nr_trios if handle.kind == 'straight' else 0)
+            size = rounds.set_sizes[n, handle.player, index]
+            self.assertEqual(list(rounds.sets[n, handle.player, index, :size]),
+                             [CARD_CODES[card] for card in cards])
+
+    def test_same_rules_as_game_round(self):
+        rng = random.Random(8)
+        for turn_set in ((1,1,0), (2,0,0), (0,0,1)):
+            random.seed(rng.random())
+            games = [GameRound(3, *turn_set) for n in range(12)]
+            rounds = roundbatch.GameRoundBatch.from_rounds(games)
+            meld_cards = sum(rounds.meld_sizes)
+            for step in range(150):
+                args = []
+                expected = []
+                for g in games:
+                    if g.is_over():
+                        args.append(self.batch_move(g, None))
+                        expected.append(True)
+                        continue
+                    move = self.random_move(g, rng)
+                    args.append(self.batch_move(g, move))
+                    try:
+                        move.apply(g)
+                        expected.append(True)
+                    except (GameRoundException, InvalidMoveException, IndexError):
+                        expected.append(False)
+                kinds, cards, melds, players, indexes, where = zip(*args)
+                melds = [row or [0] * meld_cards for row in melds]
+                valid = rounds.step(kinds, numpy.array(cards), melds, numpy.array(players),
+                                    numpy.array(indexes), numpy.array(where))
+                self.assertEqual(list(valid), expected)
+                for n, g in enumerate(games):
+                    self.assertSameState(rounds, n, g)
+            if turn_set != (0,0,1):
+                self.assertTrue((rounds.set_sizes > 4).any())
+
+    def test_deal(self):
+        rounds = roundbatch.GameRoundBatch(50, 4, 1, 1, seed=3)
+        self.assertTrue((rounds.counts.sum(axis=2) == 12).all())
+        total = rounds.counts.sum(axis=1).astype(int)
+        for n in range(50):
+            numpy.add.at(total[n], rounds.stack[n, :rounds.stack_size[n]], 1)
+            numpy.add.at(total[n], rounds.well[n, :rounds.well_size[n]], 1)
+        self.assertTrue((total[:, :JOKER_CODE] == 2).all())
+        self.assertTrue((total[:, JOKER_CODE] == 4).all())
+        again = roundbatch.GameRoundBatch(50, 4, 1, 1, seed=3)
+        self.assertTrue((again.stack == rounds.stack).all())
+        other = roundbatch.GameRoundBatch(50, 4, 1, 1, seed=4)
+        self.assertFalse((other.stack == rounds.stack).all())
+        small = roundbatch.GameRoundBatch(10, 8, nr_decks=3, seed=3, hand_size=10)
+        self.assertTrue((small.counts.sum(axis=2) == 10).all())
+        self.assertTrue((small.stack_size == 3 * 54 - 81).all())
+        self.assertRaises(ValueError, roundbatch.GameRoundBatch, 10, 8, hand_size=14)
+
+    def test_recycle(self):
+        games = [GameRound(3, 1, 1, rng=random.Random(n)) for n in range(4)]
+        for g in games[1:3]:
+            while g.stack:
+                g.take_from_stack()
+                g.drop_to_well(g.hands[g.player_in_turn][0])
+        games[0].stack, games[0].well = [], games[0].well[-1:]
+        rounds = roundbatch.GameRoundBatch.from_rounds(games, seed=2)
+        self.assertEqual(list(rounds.can_take_from_stack()), [False, True, True, True])
+        wells = [sorted(rounds.well[n, :rounds.well_size[n] - 1]) for n in range(4)]
+        before = rounds.hands_in_turn().copy()
+        valid = rounds.step(numpy.full(4, roundbatch.STACK))
+        self.assertEqual(list(valid), [False, True, True, True])
+        self.assertSameState(rounds, 0, games[0])
+        for n in (1, 2):
+            # The drawn card and the new stack are the old well but its top card
+            g = games[n]
+            g.take_from_stack()
+            self.assertEqual(rounds.stack_size[n], len(g.stack))
+            self.assertEqual(list(rounds.well[n, :rounds.well_size[n]]),
+                             [CARD_CODES[card] for card in g.well])
+            drawn = list(rounds.hands_in_turn()[n] - before[n]).index(1)
+            self.assertEqual(sorted(list(rounds.stack[n, :rounds.stack_size[n]]) + [drawn]),
+                             wells[n])
+
+    def test_random_play(self):
+        rounds = roundbatch.GameRoundBatch(200, 4, 2, seed=5)
+        rng = numpy.random.RandomState(5)
+        for step in range(400):
+            roundbatch.random_step(rounds, rng)
+        self.assertTrue(rounds.played_first_turn.all())
+        self.assertEqual(rounds.counts.min(), 0)
+
+
 class GameRoundSimpleOperations(unittest.TestCase):
     def setUp(self):
         self.g = GameRound(nr_players=4,
@@ -337,6 +829,12 @@ class Lowering(unittest.TestCase):
                           **dict(trios=[Cs(u'2♥ 2♠ 2♣')],
                                  straights=[Cs(u'5♣ 6♣ 7♣ 8♣')]))
 
+        # attempt to lower a meld of a kind the round does not ask for
+        self.assertRaises(GameRoundException, self.g.lower,
+                          **dict(trios=[Cs(u'2♠ jkr 2♥'), Cs(u'J♦ J♦ J♥')],
+                                 straights=[Cs(u'5♣ 6♣ 7♣ 8♣')],
+                                 royal_straights=[Cs(u'10♦ Q♠ A♣')]))
+
         # lower as God intended
         self.g.lower(trios=[Cs(u'2♠ jkr 2♥'), Cs(u'J♦ J♦ J♥')],
                      straights=[Cs(u'5♣ 6♣ 7♣ 8♣')])
@@ -489,6 +987,704 @@ class TestGiveCards(unittest.TestCase):
         g.drop_to_well(C(u'7♦'))
         self.assertTrue( len(g.hands[1]) == cards_on_hand[1] - 1 )
 
+class BoardIndex(unittest.TestCase):
+    def setUp(self):
+        g = GameRound(nr_players=2, nr_trios=1, nr_straights=1)
+        g.hands = [Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ 9♣ 4♣ 2♦ jkr'),
+                   Cs(u'3♥ 4♥ 5♥ 6♥  A♠ A♣ A♥  7♠ 7♣ 7♦ 10♥ K♦')]
+        g.well = Cs(u'J♦')
+        g.take_from_well()
+        g.drop_to_well(C(u'J♦'))
+        g.take_from_well()
+        g.drop_to_well(C(u'J♦'))
+        g.take_from_well()
+        g.lower(trios=[Cs(u'2♥ 2♠ jkr')], straights=[Cs(u'5♣ 6♣ 7♣ 8♣')])
+        self.g = g
+
+    def test_places(self):
+        board = self.g.board
+        trio = board.find(0, Cs(u'jkr 2♠ 2♥'))
+        straight = board.find(0, Cs(u'5♣ 6♣ 7♣ 8♣'))
+        self.assertEqual(trio, SetHandle(0, 'trio', 0))
+        self.assertEqual(board.places_for(C(u'2♦')), [(trio, 'trio')])
+        self.assertEqual(board.places_for(C(u'9♣')), [(straight, 'right')])
+        self.assertEqual(sorted(board.places_for(C(u'jkr'))),
+                         sorted([(trio, 'trio'), (straight, 'left'), (straight, 'right')]))
+        self.assertEqual(board.places_for(C(u'J♦')), [])
+
+    def test_gives_update_the_index(self):
+        straight = self.g.board.find(0, Cs(u'5♣ 6♣ 7♣ 8♣'))
+        self.g.give_to(C(u'jkr'), 0, straight, where='right')
+        self.assertEqual(self.g.board.places_for(C(u'9♣')), [])
+        self.assertEqual(self.g.board.places_for(C(u'10♣')), [(straight, 'right')])
+        # the handle is still valid, and the set can still be named by its cards
+        self.g.give_to(C(u'4♣'), 0, Cs(u'5♣ 6♣ 7♣ 8♣ jkr'))
+        self.assertEqual(self.g.lowered_straights[0][0], Cs(u'4♣ 5♣ 6♣ 7♣ 8♣ jkr'))
+
+    def test_legal_gives(self):
+        gives = self.g.legal_gives()
+        self.assertEqual(sorted(set(card for card, handle, where in gives)),
+                         sorted(Cs(u'2♦ 4♣ 9♣ jkr')))
+        for card, handle, where in gives:
+            self.assertTrue(self.g.board.fits(card, handle, where) is not None)
+
+
+class LegalMoves(unittest.TestCase):
+    def setUp(self):
+        g = GameRound(nr_players=2, nr_trios=1, nr_straights=1)
+        g.hands = [Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ 9♣ 4♣ 2♦ 2♦'),
+                   Cs(u'3♥ 4♥ 5♥ 6♥  A♠ A♣ A♥  7♠ 7♣ 7♦ 10♥ K♦')]
+        g.well = Cs(u'J♦')
+        self.g = g
+
+    def test_draws(self):
+        self.assertEqual(list(self.g.legal_moves()),
+                         [moves.Draw('well'), moves.Draw('stack')])
+        self.g.well = []
+        self.assertEqual(list(self.g.legal_moves()), [moves.Draw('stack')])
+
+    def test_first_turn_only_drops(self):
+        moves.Draw('well').apply(self.g)
+        legal = list(self.g.legal_moves())
+        self.assertEqual(legal, [moves.Drop(card) for card in sorted(set(self.g.hands[0]))])
+
+    def test_every_move_is_legal(self):
+        for n in range(2):
+            self.g.take_from_well()
+            self.g.drop_to_well(C(u'J♦'))
+        self.g.take_from_well()
+        legal = list(self.g.legal_moves())
+        lowerings = [move for move in legal if isinstance(move, moves.Lower)]
+        best = solver.solve(self.g.hands[0], (1,1,0)).residue
+        hand_score = get_score(self.g.hands[0])
+        self.assertEqual(min(hand_score - get_score(move.trios[0] + move.straights[0])
+                             for move in lowerings), best)
+        for move in legal:
+            g = GameRound(nr_players=2, nr_trios=1, nr_straights=1)
+            g.hands = [list(hand) for hand in self.g.hands]
+            g.well, g.stack = [], list(self.g.stack)
+            g.played_first_turn = [True, True]
+            g.card_taken = True
+            move.apply(g)
+
+    def test_gives_after_lowering(self):
+        for n in range(2):
+            self.g.take_from_well()
+            self.g.drop_to_well(C(u'J♦'))
+        self.g.take_from_well()
+        lower = next(self.g.legal_moves())
+        lower.apply(self.g)
+        gives = [move for move in self.g.legal_moves() if isinstance(move, moves.Give)]
+        self.assertTrue(gives)
+        gives[0].apply(self.g)
+        self.assertFalse(self.g.is_over())
+
+
+def round_state(g):
+    return (map(list, g.hands), list(g.well), list(g.stack), g.player_in_turn,
+            g.card_taken, list(g.did_lower), list(g.played_first_turn),
+            sorted((handle, list(cards)) for handle, cards in g.board.sets.items()),
+            [sorted(g.board.places_for(card)) for card in CARDS])
+
+def play_moves(g, rng, nr_moves):
+    for n in range(nr_moves):
+        legal = list(g.legal_moves())
+        if not legal:
+            break
+        # prefer lowering and giving, so that they show up more often
+        special = [move for move in legal if not isinstance(move, (moves.Draw, moves.Drop))]
+        rng.choice(special or legal).apply(g)
+
+
+class UndoJournal(unittest.TestCase):
+
+    def test_rollback_restores_the_round(self):
+        rng = random.Random(7)
+        for game in range(10):
+            g = GameRound(nr_players=3, nr_trios=1, nr_straights=1)
+            play_moves(g, rng, rng.randint(0, 60))
+            before = round_state(g)
+            mark = g.checkpoint()
+            play_moves(g, rng, 40)
+            g.rollback(mark)
+            self.assertEqual(round_state(g), before)
+
+    def test_undo(self):
+        g = GameRound(nr_players=2, nr_trios=1, nr_straights=1)
+        g.well = Cs(u'J♦')
+        hand = list(g.hands[0])
+        self.assertRaises(GameRoundException, g.undo)
+        g.take_from_well()
+        g.drop_to_well(hand[0])
+        g.undo()
+        self.assertEqual(g.player_in_turn, 0)
+        self.assertTrue(g.card_taken)
+        self.assertFalse(g.played_first_turn[0])
+        g.undo()
+        self.assertEqual(list(g.hands[0]), hand)
+        self.assertEqual(g.well, Cs(u'J♦'))
+        self.assertEqual(g.checkpoint(), 0)
+
+
+class WellRecycling(unittest.TestCase):
+    def setUp(self):
+        self.g = GameRound.from_cards(2, 1, 1, 0, stack=[], well=Cs(u'3♣ 5♦ K♥ 7♠'),
+                                      hands=[Cs(u'2♠ 9♥ Q♣'), Cs(u'4♥ 4♦ 8♣')],
+                                      nr_decks=1)
+        self.g.rng = random.Random(3)
+
+    def test_recycle_when_the_stack_runs_out(self):
+        before = round_state(self.g)
+        self.assertEqual(list(self.g.legal_moves()), [moves.Draw('well'), moves.Draw('stack')])
+        card = self.g.take_from_stack()
+        self.assertTrue(card in Cs(u'3♣ 5♦ K♥'))
+        self.assertEqual(self.g.well, Cs(u'7♠'))
+        self.assertEqual(sorted(self.g.stack + [card]), sorted(Cs(u'3♣ 5♦ K♥')))
+        self.assertEqual([record[0] for record in self.g.moves_since()], ['recycle', 'stack'])
+        self.g.undo()
+        self.assertEqual(len(self.g.stack), 3)
+        self.g.undo()
+        self.assertEqual(round_state(self.g), before)
+
+    def test_nothing_to_recycle(self):
+        self.g.well = Cs(u'7♠')
+        self.assertFalse(self.g.can_take_from_stack())
+        self.assertEqual(list(self.g.legal_moves()), [moves.Draw('well')])
+        self.assertRaises(GameRoundException, self.g.take_from_stack)
+        self.g.stack = Cs(u'A♠')
+        self.assertRaises(GameRoundException, self.g.recycle_well)
+
+    def test_logs_replay_recycles(self):
+        log = movelog.MoveLog.start(self.g)
+        self.g.drop_to_well(self.g.take_from_stack())
+        self.g.take_from_stack()
+        log.update(self.g)
+        log = movelog.loads(movelog.dumps(log))
+        self.assertEqual(log.records, self.g.moves_since())
+        for validate in (False, True):
+            self.assertEqual(round_state(movelog.replay(log, validate=validate)),
+                             round_state(self.g))
+
+    def test_large_tables(self):
+        g = GameRound(8, 1, 1, 0, nr_decks=3, rng=random.Random(3), hand_size=10)
+        self.assertEqual([len(hand) for hand in g.hands], [10] * 8)
+        self.assertEqual(len(g.stack), 3 * 54 - 81)
+        policies = [simulation.RandomPolicy(n) for n in range(8)]
+        turns, blocked = simulation.play_round(g, policies, max_turns=500)
+        self.assertTrue('recycle' in [record[0] for record in g.moves_since()])
+        self.assertFalse(blocked and turns < 500)
+        self.assertRaises(GameRoundException, GameRound, 8, nr_decks=2, hand_size=14)
+
+
+class DistanceTracking(unittest.TestCase):
+
+    def assertTracks(self, g):
+        turn_set = (g.nr_trios, g.nr_straights, g.nr_royal_straights)
+        for player, hand in enumerate(g.hands):
+            if g.did_lower[player]:
+                self.assertEqual(g.distances.distance(player), 0)
+                continue
+            self.assertEqual(g.distances.distance(player), solver.missing_cards(hand, turn_set))
+            self.assertEqual(g.distances.useful(player), solver.useful_cards(hand, turn_set))
+
+    def test_follows_moves_and_undos(self):
+        rng = random.Random(3)
+        for game in range(6):
+            g = GameRound(nr_players=2, nr_trios=1, nr_straights=1)
+            tracker = g.track_distances()
+            self.assertTrue(g.track_distances() is tracker)
+            self.assertTracks(g)
+            for n in range(30):
+                play_moves(g, rng, 1)
+                self.assertTracks(g)
+            for n in range(10):
+                g.undo()
+                self.assertTracks(g)
+
+    def test_solves_less_than_once_per_change(self):
+        for turn_set in ((2, 0, 0), (1, 1, 0), (0, 2, 0)):
+            g = GameRound(4, *turn_set, rng=random.Random(5))
+            tracker = g.track_distances()
+            policy = simulation.GreedyPolicy(5)
+            self.assertTracks(g)
+            changes = 0
+            while changes < 80 and not g.is_over() and g.can_take_from_stack():
+                if policy.draw(g) == 'well':
+                    g.take_from_well()
+                else:
+                    g.take_from_stack()
+                self.assertTracks(g)
+                partition = policy.lower(g)
+                if partition is not None:
+                    g.lower(trios=partition.trios, straights=partition.straights,
+                            royal_straights=partition.royal_straights)
+                    self.assertTracks(g)
+                g.drop_to_well(policy.discard(g))
+                self.assertTracks(g)
+                changes += 2
+            # Distances and useful cards were asked after every change, and
+            # only some of the changes needed a search
+            self.assertEqual(changes, 80)
+            self.assertTrue(tracker.solves < changes / 4, tracker.solves)
+            self.assertTrue(tracker.searches < changes / 2, tracker.searches)
+
+    def test_keeps_useful_cards_across_changes(self):
+        g = GameRound.from_cards(2, 2, 0, 0, stack=Cs(u'K♠ 4♥'), well=Cs(u'3♣'),
+                                 hands=[Cs(u'5♣ 5♦ 8♥ 8♣ Q♦'), Cs(u'2♠ 2♥ 9♣ J♦')])
+        tracker = g.track_distances()
+        useful = tracker.useful(0)
+        g.take_from_stack()                 # 4♥ fits no meld
+        self.assertEqual(tracker.useful(0), useful)
+        g.drop_to_well(C(u'Q♦'))            # nor does Q♦
+        self.assertEqual(tracker.useful(0), useful)
+        self.assertEqual((tracker.solves, tracker.searches), (1, 1))
+        # The search kept for the hand is left out of copies
+        copied = pickle.loads(pickle.dumps(g, 2)).distances
+        self.assertEqual(copied.useful(0), useful)
+
+    def test_draws_of_useful_cards(self):
+        g = GameRound.from_cards(2, 2, 0, 0, stack=Cs(u'7♠ 5♥'), well=Cs(u'3♣'),
+                                 hands=[Cs(u'5♣ 5♦ 8♥ 8♣'), Cs(u'2♠ 2♥ 9♣ J♦')])
+        tracker = g.track_distances()
+        self.assertTrue(C(u'8♠') in tracker.useful(0))
+        g.take_from_well()
+        g.drop_to_well(C(u'3♣'))
+        self.assertEqual(tracker.distance(0), 2)
+        g.take_from_stack()
+        g.drop_to_well(C(u'5♥'))
+        tracker.useful(0)
+        g.take_from_well()
+        self.assertEqual(tracker.distance(0), 1)
+        self.assertEqual(tracker.solves, 1)
+
+
+class DrawAnalysis(unittest.TestCase):
+
+    def brute_odds(self, view, hand):
+        unseen = analysis.unseen_counts(view)
+        missing = solver.missing_cards(hand, view.turn_set)
+        useful = sum(unseen[code] for code, card in enumerate(CARDS)
+                     if solver.missing_cards(hand + [card], view.turn_set) < missing)
+        return float(useful) / sum(unseen)
+
+    def test_unseen_counts(self):
+        view = analysis.View(Cs(u'5♣ jkr'), Cs(u'5♣'), [Cs(u'2♥ 2♠ jkr')], Cs(u'K♦'), (1,0,0), 2)
+        unseen = analysis.unseen_counts(view)
+        self.assertEqual(unseen[CARD_CODES[C(u'5♣')]], 0)
+        self.assertEqual(unseen[CARD_CODES[C(u'jkr')]], 2)
+        self.assertEqual(sum(unseen), 2 * 54 - 7)
+        view = view._replace(hand=Cs(u'5♣ 5♣'))
+        self.assertRaises(ValueError, analysis.unseen_counts, view)
+
+    def test_odds_and_discards(self):
+        random.seed(4)
+        for turn_set in ((2,0,0), (1,1,0), (0,0,1)):
+            g = GameRound(3, *turn_set)
+            view = analysis.view_of(g, 1, seen=g.hands[0][:3])
+            hand = list(view.hand)
+            self.assertAlmostEqual(analysis.improve_odds(view), self.brute_odds(view, hand))
+            discards = analysis.rank_discards(view)
+            self.assertEqual(sorted(d.card for d in discards), sorted(set(hand)))
+            expected = [d.expected_distance for d in discards]
+            self.assertEqual(expected, sorted(expected))
+            for d in discards[:3]:
+                rest = list(hand)
+                rest.remove(d.card)
+                self.assertEqual(d.distance, solver.missing_cards(rest, turn_set))
+                self.assertAlmostEqual(d.odds, self.brute_odds(view, rest))
+
+    def test_drops_the_useless_high_card(self):
+        view = analysis.View(Cs(u'5♣ 5♦ 8♥ 8♣ K♠ 3♥'), Cs(u'3♣'), [], [], (2,0,0), 2)
+        self.assertEqual(analysis.rank_discards(view)[0].card, C(u'K♠'))
+
+    def test_view_of_lowered_sets(self):
+        g = GameRound.from_cards(2, 1, 1, 0, stack=Cs(u'3♣ 4♦'), well=Cs(u'K♥'),
+                hands=[Cs(u'5♣ 6♣ 7♣ 8♣  2♥ 2♠ jkr  J♦ 9♣ 4♣ 2♦ jkr'),
+                       Cs(u'3♥ 4♥ 5♥ 6♥  A♠ A♣ A♥  7♠ 7♣ 7♦ 10♥ K♦')])
+        g.played_first_turn[0] = True
+        g.take_from_stack()
+        g.lower(trios=[Cs(u'2♥ 2♠ jkr')], straights=[Cs(u'5♣ 6♣ 7♣ 8♣')])
+        view = analysis.view_of(g, 1)
+        self.assertEqual(sorted(map(len, view.lowered)), [3, 4])
+        self.assertEqual(sum(analysis.unseen_counts(view)), 2 * 54 - 12 - 1 - 7)
+
+
+class Codec(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(11)
+        for game in range(10):
+            g = GameRound(nr_players=rng.randint(2, 5), nr_trios=1, nr_straights=1)
+            play_moves(g, rng, rng.randint(0, 80))
+            data = codec.encode(g)
+            for buf in (data, bytearray(data), memoryview(data)):
+                decoded = codec.decode(buf)
+                self.assertEqual(round_state(decoded), round_state(g))
+                self.assertEqual(decoded.lowered_straights, g.lowered_straights)
+            self.assertEqual(codec.encode(codec.decode(data)), data)
+            header, hands = codec.decode_hands(data)
+            self.assertEqual(header.player_in_turn, g.player_in_turn)
+            self.assertEqual([decode_cards(codes) for codes in hands], map(list, g.hands))
+
+    def test_scores(self):
+        g = GameRound(nr_players=2, nr_trios=1)
+        g.hands = [Cs(u''), Cs(u'2♥ K♣')]
+        g.calculate_scores()
+        self.assertEqual(codec.decode(codec.encode(g)).scores, [0, 12])
+
+    def test_invalid_data(self):
+        data = codec.encode(GameRound(nr_players=2, nr_trios=1))
+        self.assertRaises(codec.DecodeError, codec.decode, 'XX' + data[2:])
+        self.assertRaises(codec.DecodeError, codec.decode, data[:2] + '\x09' + data[3:])
+        self.assertRaises(codec.DecodeError, codec.decode, data[:-3])
+        self.assertRaises(codec.DecodeError, codec.decode, data[:5])
+
+
+class MoveLogs(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(13)
+        self.g = GameRound(nr_players=3, nr_trios=1, nr_straights=1)
+        self.log = movelog.MoveLog.start(self.g)
+        self.states = [round_state(self.g)]
+        for n in range(120):
+            play_moves(self.g, self.rng, 1)
+            self.states.append(round_state(self.g))
+        self.log.update(self.g)
+
+    def test_records_cover_every_kind(self):
+        kinds = set(record[0] for record in self.log.records)
+        self.assertEqual(kinds, set(['well', 'stack', 'lower', 'give', 'drop']))
+
+    def test_replay_any_position(self):
+        log = movelog.loads(movelog.dumps(self.log))
+        self.assertEqual(log.records, self.log.records)
+        for nr_moves in (0, 1, 17, 60, len(log)):
+            self.assertEqual(round_state(movelog.replay(log, nr_moves)), self.states[nr_moves])
+        self.assertEqual(round_state(movelog.replay(log, validate=True)), self.states[-1])
+        positions = [round_state(g) for g in movelog.iter_positions(log)]
+        self.assertEqual(positions, self.states[1:])
+
+    def test_validation(self):
+        records = list(self.log.records)
+        records[0], records[1] = records[1], records[0]
+        log = movelog.MoveLog(self.log.initial, records)
+        self.assertRaises(movelog.ReplayError, movelog.replay, log, validate=True)
+        records = list(self.log.records)
+        drop = [n for n, record in enumerate(records) if record[0] == 'drop'][-1]
+        records[drop] = records[drop][:3] + (not records[drop][3],)
+        log = movelog.MoveLog(self.log.initial, records)
+        self.assertRaises(movelog.ReplayError, movelog.replay, log, validate=True)
+
+    def test_lazy_decoding(self):
+        log = movelog.loads(movelog.dumps(self.log))
+        records = iter(log)
+        self.assertEqual(next(records), self.log.records[0])
+        self.assertEqual(log._records, [])
+        self.assertEqual(list(log), self.log.records)
+        self.assertEqual(len(log), len(self.log))
+        truncated = movelog.loads(movelog.dumps(self.log)[:-1])
+        self.assertRaises(movelog.ReplayError, list, truncated)
+
+    def test_writer_appends(self):
+        out = StringIO()
+        g = GameRound(nr_players=2, nr_trios=1)
+        writer = movelog.LogWriter(out, g)
+        g.take_from_stack()
+        writer.flush()
+        g.drop_to_well(g.hands[0][0])
+        writer.flush()
+        log = movelog.loads(out.getvalue())
+        self.assertEqual([record[0] for record in log.records], ['stack', 'drop'])
+        self.assertEqual(round_state(movelog.replay(log)), round_state(g))
+        g.undo()
+        self.assertRaises(movelog.ReplayError, writer.flush)
+        # Records are decoded, and found truncated, when read
+        self.assertRaises(movelog.ReplayError, list, movelog.loads(out.getvalue()[:-1]))
+
+
+class Analytics(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(17)
+        self.logs, self.rounds = [], []
+        for n in range(6):
+            nr_trios, nr_straights, nr_royal_straights = TURN_SETS[n % 2]
+            g = GameRound(3, nr_trios, nr_straights, nr_royal_straights)
+            log = movelog.MoveLog.start(g)
+            play_moves(g, rng, 400)
+            log.update(g)
+            self.logs.append(log)
+            self.rounds.append(g)
+
+    def test_statistics(self):
+        stats = analytics.analyze(iter(self.logs)).rounds[TURN_SETS[0]]
+        rounds = self.rounds[::2]
+        records = [record for log in self.logs[::2] for record in log.records]
+        self.assertEqual(stats.rounds, 3)
+        self.assertEqual(stats.well_draws, sum(record[0] == 'well' for record in records))
+        self.assertEqual(stats.lowerings, sum(record[0] == 'lower' for record in records))
+        self.assertEqual(stats.turns, sum(record[0] == 'drop' for record in records))
+        finished = [g for g in rounds if g.is_over()]
+        self.assertTrue(finished)
+        self.assertEqual(stats.unfinished, 3 - len(finished))
+        self.assertEqual(stats.residue, sum(hand.score for g in finished for hand in g.hands))
+        self.assertEqual(stats.jokers_left, sum(hand.count(C(u'jkr')) for g in finished
+                                                                   for hand in g.hands))
+
+    def test_rounds_of_any_kind(self):
+        g = GameRound(3, 1, 0, 0)
+        log = movelog.MoveLog.start(g)
+        play_moves(g, random.Random(5), 30)
+        log.update(g)
+        stats = analytics.analyze(self.logs + [log])
+        self.assertEqual(stats.rounds[(1, 0, 0)].rounds, 1)
+        self.assertEqual(stats.as_dict()[u'1T 0E 0ER']['rounds'], 1)
+        self.assertEqual(stats.rounds[TURN_SETS[0]].rounds, 3)
+
+    def test_pool_gives_the_same_results(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for n, log in enumerate(self.logs):
+                paths.append(os.path.join(directory, '%d.log' % n))
+                with open(paths[-1], 'wb') as f:
+                    f.write(movelog.dumps(log))
+            expected = analytics.analyze(self.logs).as_dict()
+            self.assertEqual(analytics.analyze_files(paths, processes=1).as_dict(), expected)
+            self.assertEqual(analytics.analyze_files(iter(paths), processes=2, chunk_size=1).as_dict(),
+                             expected)
+        finally:
+            shutil.rmtree(directory)
+
+
+class Server(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(port=0, turn_timeout=5)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs=dict(poll_interval=0.01))
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        for sock, f in self.clients:
+            sock.close()
+        self.server.shutdown()
+        self.thread.join()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.address, timeout=5)
+        self.clients.append((sock, sock.makefile('r')))
+        return len(self.clients) - 1
+
+    def send(self, client, **message):
+        self.clients[client][0].sendall(json.dumps(message) + '\n')
+
+    def receive(self, client, kind):
+        while True:
+            message = json.loads(self.clients[client][1].readline())
+            if message['type'] == kind:
+                return message
+
+    def test_table(self):
+        a, b = self.connect(), self.connect()
+        self.send(a, op='join', table='t', players=2)
+        self.assertEqual(self.receive(a, 'joined')['seat'], 0)
+        self.send(b, op='join', table='t', players=2)
+        self.assertEqual(self.receive(b, 'joined')['seat'], 1)
+        first = self.receive(a, 'turn')['player']
+        self.send(1 - first, op='move', move='stack')
+        self.assertTrue('not in turn' in self.receive(1 - first, 'error')['error'])
+        self.send(first, op='move', move='stack')
+        result = self.receive(first, 'result')
+        self.assertEqual(len(result['hand']), 13)
+        self.assertTrue(result['in_turn'])
+        self.send(first, op='move', move='drop', card=result['hand'][0])
+        self.assertFalse(self.receive(first, 'result')['in_turn'])
+        dropped = self.receive(1 - first, 'move')
+        self.assertEqual(dropped['move'], {'move': 'stack'})
+        self.send(first, op='state')
+        state = self.receive(first, 'state')
+        self.assertEqual(state['well'], [result['hand'][0]])
+        self.assertEqual(state['player_in_turn'], 1 - first)
+
+    def test_shutdown_before_serving(self):
+        early = server.Server(port=0)
+        early.shutdown()
+        thread = threading.Thread(target=early.serve_forever)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_result_comes_before_the_next_round(self):
+        class Seat(object):
+            def __init__(self):
+                self.messages = []
+            def send_message(self, message):
+                self.messages.append(message)
+        # A table of a server that is not running, played directly
+        idle = server.Server(port=0)
+        try:
+            table = idle.get_table(u'r', 2)
+            seats = [Seat(), Seat()]
+            for seat in seats:
+                table.sit(seat)
+            table.start_if_full()
+            table.round = GameRound.from_cards(2, 1, 0, 0, stack=Cs(u'3♣ 4♦'), well=Cs(u'K♥'),
+                                               hands=[Cs(u'2♥ 2♠ jkr'), Cs(u'5♣ 5♦ 8♥')])
+            table.round.played_first_turn[0] = True
+            table.play(0, moves.Draw('stack'))
+            table.play(0, moves.Lower((tuple(Cs(u'2♥ 2♠ jkr')),), (), ()))
+            table.play(0, moves.Drop(C(u'4♦')))
+        finally:
+            idle.close()
+        kinds = [message['type'] for message in seats[0].messages]
+        last = len(kinds) - 1 - kinds[::-1].index('result')
+        self.assertEqual(seats[0].messages[last], {'type': 'result', 'hand': [], 'in_turn': False})
+        self.assertEqual(kinds[last + 1], 'round_over')
+
+    def test_turn_timeout(self):
+        self.server.turn_timeout = 0.2
+        a, b = self.connect(), self.connect()
+        self.send(a, op='join', table='t', players=2)
+        self.send(b, op='join', table='t', players=2)
+        first = self.receive(a, 'turn')['player']
+        self.assertEqual(self.receive(a, 'timeout')['player'], first)
+        self.assertEqual(self.receive(a, 'turn')['player'], 1 - first)
+        self.assertEqual(self.server.stats['timeouts'], 1)
+
+    def test_invalid_messages(self):
+        a = self.connect()
+        self.send(a, op='move', move='stack')
+        self.receive(a, 'error')
+        self.clients[a][0].sendall('not json\n')
+        self.receive(a, 'error')
+        self.send(a, op='join', table='t', players=2)
+        self.send(a, op='move', move='fly')
+        self.assertTrue('Unknown move' in self.receive(a, 'error')['error'])
+        for card in (u'', u'  ', u'♥', u'X♥'):
+            self.send(a, op='move', move='drop', card=card)
+            self.assertTrue('Invalid drop move' in self.receive(a, 'error')['error'])
+        # Still seated
+        self.send(a, op='state')
+        self.assertEqual(self.receive(a, 'state')['table'], 't')
+
+    def test_load_generator(self):
+        stats = loadgen.run(self.server.address, nr_tables=3, nr_players=2, duration=0.5)
+        self.assertTrue(stats.moves > 0)
+        self.assertEqual(stats.errors, 0)
+        self.assertTrue(stats.percentile(0.99) is not None)
+
+
+class Benchmarks(unittest.TestCase):
+    def test_every_benchmark_runs(self):
+        state = random.getstate()
+        report = benchmarks.run(repeat=1, scale=0.001)
+        self.assertEqual(random.getstate(), state)
+        self.assertEqual(sorted(report['results']),
+                         sorted(bench.name for bench in benchmarks.BENCHMARKS))
+        for result in report['results'].values():
+            self.assertTrue(result['seconds_per_op'] > 0)
+        json.dumps(report)
+
+    def test_regressions(self):
+        report = {'results': {'a': {'seconds_per_op': 1.0}, 'b': {'seconds_per_op': 1.3},
+                              'new': {'seconds_per_op': 5.0}}}
+        baseline = {'results': {'a': {'seconds_per_op': 1.1}, 'b': {'seconds_per_op': 1.0}}}
+        self.assertEqual(benchmarks.compare(report, baseline, 0.2), [('b', 1.0, 1.3)])
+        self.assertEqual(benchmarks.compare(report, baseline, 0.5), [])
+
+
+class HeadlessImport(unittest.TestCase):
+    def test_no_gui_libraries(self):
+        # Importing a GUI library would fail in the child
+        code = ('import sys\n'
+                'for name in ("gtk", "pygtk", "cairo", "gui", "carioca.gui"):\n'
+                '    sys.modules[name] = None\n'
+                'import carioca, carioca.simulation, carioca.server, carioca.ismcts\n'
+                'print carioca.GameRound(4, 1, 1, 0).nr_players')
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', code], cwd=package), '4\n')
+
+
+class Instrumentation(unittest.TestCase):
+    def test_counts_calls_and_exceptions(self):
+        with instrumentation.instrumented():
+            g = GameRound(nr_players=2, nr_trios=1)
+            self.assertRaises(InvalidMoveException, g.drop_to_well, g.hands[0][0])
+            g.take_from_stack()
+            missing = [card for card in CARDS if card not in g.hands[0]][0]
+            self.assertRaises(GameRoundException, g.drop_to_well, missing)
+            self.assertFalse(carioca.is_trio(Cs(u'2♥ 3♥ 4♥')))
+        stats = instrumentation.snapshot()
+        drop = stats['GameRound.drop_to_well']
+        self.assertEqual(drop['calls'], 2)
+        self.assertEqual(drop['exceptions'], {'InvalidMoveException': 1,
+                                              'GameRoundException': 1, 'other': 0})
+        self.assertEqual(stats['GameRound.take_from_stack']['calls'], 1)
+        self.assertEqual(sum(stats['is_trio']['buckets'].values()), 1)
+        text = instrumentation.prometheus()
+        self.assertTrue('carioca_calls_total{function="GameRound.__init__"} 1' in text)
+        self.assertTrue('carioca_exceptions_total{function="GameRound.drop_to_well",'
+                        'type="InvalidMoveException"} 1' in text)
+
+    def test_disabled_restores_the_originals(self):
+        original = GameRound.__dict__['lower'], carioca.is_trio
+        with instrumentation.instrumented():
+            self.assertTrue(instrumentation.is_enabled())
+            self.assertNotEqual((GameRound.__dict__['lower'], carioca.is_trio), original)
+        self.assertFalse(instrumentation.is_enabled())
+        self.assertEqual((GameRound.__dict__['lower'], carioca.is_trio), original)
+
+
+class ISMCTS(unittest.TestCase):
+    def setUp(self):
+        random.seed(5)
+        self.g = GameRound(nr_players=3, nr_trios=2)
+
+    def test_guesses_keep_what_the_player_sees(self):
+        g = self.g
+        g.take_from_stack()
+        determinizer = ismcts.Determinizer(g, 0)
+        cards = sorted(g.stack + [card for hand in g.hands for card in hand])
+        rng = random.Random(1)
+        for n in range(5):
+            guess = determinizer.sample(rng)
+            self.assertEqual(list(guess.hands[0]), list(g.hands[0]))
+            self.assertEqual(guess.well, g.well)
+            self.assertEqual(map(len, guess.hands), map(len, g.hands))
+            self.assertEqual(sorted(guess.stack + [card for hand in guess.hands for card in hand]),
+                             cards)
+
+    def test_search_reproducible_with_recycling(self):
+        g = GameRound.from_cards(2, 1, 0, 0, stack=[], well=Cs(u'3♣ 5♦ K♥ 7♠ 9♠ Q♦'),
+                                 hands=[Cs(u'2♥ 2♠ 8♣ J♦'), Cs(u'4♥ 4♦ 8♥ 10♠')])
+        results = []
+        for seed in (1, 2):
+            random.seed(seed)
+            results.append(ismcts.search(g, iterations=20, rollout_turns=6, seed=3))
+        self.assertEqual(results[0], results[1])
+
+    def test_search(self):
+        stats = ismcts.search(self.g, iterations=30, seed=2)
+        self.assertEqual(sorted(stats), sorted(self.g.legal_moves()))
+        self.assertEqual(sum(visits for visits, reward in stats.values()), 30)
+        # the round is left untouched
+        self.assertEqual(self.g.checkpoint(), 0)
+
+    def test_play_turn(self):
+        bot = ismcts.ISMCTSBot(iterations=20, seed=3)
+        played = bot.play_turn(self.g)
+        self.assertEqual(self.g.player_in_turn, 1)
+        self.assertTrue(isinstance(played[0], moves.Draw))
+        self.assertTrue(isinstance(played[-1], moves.Drop))
+
+    def test_root_parallelization(self):
+        bot = ismcts.ISMCTSBot(iterations=10, processes=2, seed=4)
+        try:
+            stats = bot.statistics(self.g)
+        finally:
+            bot.close()
+        self.assertEqual(sum(visits for visits, reward in stats.values()), 20)
+
+
 class TestFullGameRound(unittest.TestCase):
     def setUp(self):
         g = GameRound(nr_players=2, nr_trios=3, nr_straights=0)
@@ -575,6 +1771,88 @@ class TestFullGameRound(unittest.TestCase):
 
         # Game is over!
         self.assertTrue(self.g.is_over())
+        self.g.calculate_scores()
+        self.assertEqual(self.g.scores, [0, get_score(self.g.hands[1].cards())])
+
+class CariocaGameRounds(unittest.TestCase):
+    def test_nine_rounds(self):
+        game = CariocaGame(3)
+        rounds = []
+        while not game.is_over():
+            rounds.append(game.go_to_next_round())
+        self.assertEqual(len(rounds), len(TURN_SETS))
+        self.assertEqual([r.player_in_turn for r in rounds[:4]], [1, 2, 0, 1])
+        self.assertRaises(GameException, game.go_to_next_round)
+
+
+class Simulation(unittest.TestCase):
+    def test_games_are_reproducible(self):
+        policies = lambda: [simulation.RandomPolicy(n) for n in range(2)]
+        first = simulation.play_game(policies(), seed=3)
+        self.assertEqual(first, simulation.play_game(policies(), seed=3))
+
+    def test_simulate(self):
+        stats = simulation.simulate(3, [simulation.RandomPolicy] * 2,
+                                    processes=1, chunk_size=2)
+        self.assertEqual(stats.games, 3)
+        self.assertEqual(stats.rounds, 3 * len(TURN_SETS))
+        self.assertEqual(sum(stats.wins), 3)
+
+    def test_same_results_with_any_pool(self):
+        policies = [simulation.RandomPolicy] * 2
+        alone = simulation.simulate(4, policies, processes=1, seed=9, chunk_size=4)
+        pooled = simulation.simulate(4, policies, processes=2, seed=9, chunk_size=1)
+        self.assertEqual((alone.scores, alone.wins, alone.turns),
+                         (pooled.scores, pooled.wins, pooled.turns))
+
+    def test_replay_one_game_of_a_run(self):
+        stats = simulation.simulate(2, [simulation.RandomPolicy] * 2, processes=1, seed=4)
+        scores = [0, 0]
+        for number in range(2):
+            seed = simulation.game_seed(4, number)
+            policies = [simulation.RandomPolicy(seeds.derive_seed(seed, 'player', n))
+                        for n in range(2)]
+            game_scores = simulation.play_game(policies, seed)[0]
+            scores = [a + b for a, b in zip(scores, game_scores)]
+        self.assertEqual(scores, stats.scores)
+
+
+class RandomStreams(unittest.TestCase):
+    def test_derived_seeds(self):
+        self.assertEqual(seeds.derive_seed(1, 'game', 2), seeds.derive_seed(1, u'game', 2L))
+        derived = set(seeds.derive_seed(seed, 'game', n) for seed in range(20) for n in range(20))
+        self.assertEqual(len(derived), 400)
+        self.assertNotEqual(seeds.derive_seed(1, 'game', 2), seeds.derive_seed(2, 'game', 1))
+
+    def test_rounds_deal_from_their_rng(self):
+        for lazy in (False, True):
+            random.seed(0)
+            first = GameRound(3, 2, 0, 0, lazy=lazy, rng=seeds.stream(5, 'deck'))
+            state = random.getstate()
+            second = GameRound(3, 2, 0, 0, lazy=lazy, rng=seeds.stream(5, 'deck'))
+            self.assertEqual(random.getstate(), state)
+            self.assertEqual(map(list, first.hands), map(list, second.hands))
+            self.assertEqual(first.well, second.well)
+            self.assertEqual(first.stack[:], second.stack[:])
+
+    def test_games_deal_from_their_rng(self):
+        deal = lambda game: [list(game.go_to_next_round().hands[0]) for n in range(3)]
+        self.assertEqual(deal(CariocaGame(2, rng=seeds.stream(1))),
+                         deal(CariocaGame(2, rng=seeds.stream(1))))
+        self.assertNotEqual(deal(CariocaGame(2, rng=seeds.stream(1))),
+                            deal(CariocaGame(2, rng=seeds.stream(2))))
+
+    def test_server_tables(self):
+        hands = []
+        for n in range(2):
+            seeded = server.Server(port=0, seed=3)
+            try:
+                table = seeded.get_table(u't1', 2)
+                hands.append(list(table.game.go_to_next_round().hands[0]))
+            finally:
+                seeded.close()
+        self.assertEqual(hands[0], hands[1])
+
 
 if __name__ == "__main__":
     unittest.main()